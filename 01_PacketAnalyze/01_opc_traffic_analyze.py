@@ -1,95 +1,175 @@
+import os
 import csv
 import sys
 import json
+import bisect
+import math
 import logging
-import pyshark
-import matplotlib.pyplot as plt
-from collections import defaultdict
+import itertools
+import numpy as np
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pcap_reader
+import opcua_decoder
+import latency_sketch
+import flow_sampling
+import shared_packets
 
 #? 請在03_Programs資料夾下執行此程式
 #? 這支程式在自動化流程中有大改，部分註解與測試集可能有錯誤
 
-# PART 1: 依照時間間隔取得封包物件
-def update_time_interval(packet, start_time, end_time):
-    """輔助函式, 更新 read_pcapng_file 時間區間
+# PART 1: 依照時間間隔取得封包陣列
+# 時間間隔固定在 grid_origin + k*time_interval 的格線上 (左閉右開), 不隨封包到達時間漂移, 沒有封包的時間間隔也會回傳
+def window_number(timestamp, grid_origin, time_interval):
+    """輔助函式, 時間戳記所在的時間間隔編號 k, 以格線邊界 grid_origin + k*time_interval 校正浮點誤差
     """
-    start_time = packet.sniff_time.timestamp()
-    end_time = start_time + time_interval
-    return start_time, end_time
+    number = int(np.floor((timestamp - grid_origin) / time_interval))
+    while grid_origin + (number + 1) * time_interval <= timestamp:
+        number += 1
+    while grid_origin + number * time_interval > timestamp:
+        number -= 1
+    return number
+
+def iter_time_windows(packet_chunks, time_interval, grid_origin=None):
+    """依固定格線切出各時間間隔的封包陣列, 最後一個時間間隔會等到下一段封包讀入後才確定是否結束
 
-def read_pcapng_file(capture_file):
-    """批次取得時間間隔內的封包物件
+    同一段封包內的時間間隔為原陣列的 view (不複製), 只有跨段的時間間隔需要合併
+
+    Args:
+        packet_chunks (iterable): 依順序的封包陣列 (可以只有一段)
+        grid_origin (float, optional): 格線起點 (epoch 秒), 預設為第一個封包的時間
 
     Yields:
-        [packet_object]: 時間間隔內的封包物件
+        (int, np.ndarray): 時間間隔編號 k (起點為 grid_origin + k*time_interval), 該時間間隔內的所有frame
     """
-    with pyshark.FileCapture(capture_file, keep_packets=True) as cap:
-        packet_list = []
-        start_time, end_time = None, None
+    current = None # 目前 (尚未結束) 的時間間隔編號
+    pending = [] # 目前時間間隔中, 來自前幾段封包的部分
+    
+    for chunk in packet_chunks:
+        if len(chunk) == 0:
+            continue
+        timestamps = chunk['timestamp']
+        if grid_origin is None:
+            grid_origin = float(timestamps[0])
+        if current is None:
+            current = window_number(timestamps[0], grid_origin, time_interval)
         
+        # 這段封包中每個時間間隔的結束位置
+        last = window_number(timestamps[-1], grid_origin, time_interval)
+        boundaries = grid_origin + time_interval * np.arange(current + 1, last + 1)
+        ends = np.searchsorted(timestamps, boundaries, side='left').tolist()
         
+        start_index = 0
+        for end_index in ends:
+            packet_list = chunk[start_index:end_index]
+            if pending:
+                packet_list = np.concatenate([*pending, packet_list])
+                pending = []
+            yield current, packet_list
+            current += 1
+            start_index = end_index
+        pending.append(chunk[start_index:])
         
-        for packet in cap:
-            if start_time is None:
-                start_time, end_time = update_time_interval(packet, start_time, end_time)
-
-            packet_time = packet.sniff_time.timestamp()
-            if packet_time <= end_time:
-                if 'IP' in packet:
-                    packet_list.append(packet)
-            else:
-                yield packet_list
-                packet_list = [packet]
-                start_time, end_time = update_time_interval(packet, start_time, end_time)
-
-        if packet_list:
-            yield packet_list
+    if current is not None:
+        yield current, np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+def read_pcapng_file(capture_file, time_interval, cache_dir=None, use_cache=True, streaming=False, grid_origin=None, packet_filter=None):
+    """批次取得時間間隔內的封包陣列
+
+    Args:
+        cache_dir (str, optional): 解碼結果的快取資料夾, 預設為擷取檔旁的 .capture_cache
+        streaming (bool): True 時逐段解碼擷取檔 (不使用快取), 記憶體用量不隨擷取檔長度增加
+        grid_origin (float, optional): 時間間隔格線的起點 (epoch 秒), 見 iter_time_windows
+        packet_filter (dict, optional): pcap_reader.new_packet_filter 的篩選條件, 解碼時只保留符合的封包
+
+    Yields:
+        (int, np.ndarray): 時間間隔編號, 時間間隔內的frame (pcap_reader.PACKET_DTYPE), 非IP的frame其IP欄位為0
+    """
+    if streaming:
+        packet_chunks = pcap_reader.iter_capture_chunks(capture_file, packet_filter=packet_filter)
+    else:
+        packet_chunks = [pcap_reader.load_capture(capture_file, cache_dir, use_cache, packet_filter)]
+    
+    yield from iter_time_windows(packet_chunks, time_interval, grid_origin)
 
 # PART 2-1: 進行分類前置(蒐集、整理、重組)
+# flow 以整數 flow_id 表示: client_port<<48 | server_ip<<16 | server_port (client_ip 由分析狀態決定)
+# session 以 session編號 (int) 表示, 只在輸出時才轉成 "Session N: client_ip-server_ip"
+def flow_id_parts(flow_id):
+    """輔助函式, 將 flow_id 拆回 (client_port, server_ip, server_port)
+    """
+    return (flow_id >> 48) & 0xFFFF, (flow_id >> 16) & 0xFFFFFFFF, flow_id & 0xFFFF
+
+def format_flow(client_ip, flow_id):
+    """輔助函式, 將 flow_id 轉成 client_ip:port-server_ip:port (僅供 log 使用)
+    """
+    client_port, server_ip, server_port = flow_id_parts(flow_id)
+    return f"{pcap_reader.ip_to_str(client_ip)}:{client_port}-{pcap_reader.ip_to_str(server_ip)}:{server_port}"
+
+def format_session_key(client_ip, session_key):
+    """輔助函式, 將 (session編號, server_ip) 轉成 data_training.csv 的 Session 欄位
+    """
+    session_number, server_ip = session_key
+    return f"Session {session_number}: {pcap_reader.ip_to_str(client_ip)}-{pcap_reader.ip_to_str(server_ip)}"
+
 def initial_packet_grouping(packet_list, client_ip):
-    grouped_packets = {'background': []}
-    
-    for packet in packet_list:
-        try: # 其實這裡嘗試抓取封包的src_port, dst_port就預設了留下來的封包走TCP/UDP協定
-            src_ip = packet.ip.src
-            dst_ip = packet.ip.dst
-            src_port = packet[packet.transport_layer].srcport
-            dst_port = packet[packet.transport_layer].dstport
-        except AttributeError: # 目前已知ARP,ICMP等控制封包會觸發，至於有沒有行為是unicast但不基於TCP/UDP的封包，還沒有遇到
-            grouped_packets['background'].append(packet)
-            continue
+    """依 (client_port, server_ip, server_port) 將client的TCP封包分組
 
-        if src_ip == client_ip or dst_ip == client_ip:
-            server_ip = dst_ip if src_ip == client_ip else src_ip
-            server_port = dst_port if src_ip == client_ip else src_port
-            client_port = src_port if src_ip == client_ip else dst_port
-            group_key = f"{client_ip}:{client_port}-{server_ip}:{server_port}"
-            
-            if group_key not in grouped_packets:
-                grouped_packets[group_key] = []
-                
-            grouped_packets[group_key].append(packet)
-        else:
-            grouped_packets['background'].append(packet)
+    Returns:
+        np.ndarray: 依flow重新排列的client封包, 同一flow的封包相鄰且保留原本順序
+        dict: flow_id -> [(start, end)] 封包索引範圍, 依各flow第一次出現的順序
+    """
+    is_tcp = packet_list['ip_proto'] == 6 # 只有TCP封包可以組成session, ARP,ICMP等控制封包不屬於任何flow
+    from_client = is_tcp & (packet_list['src_ip'] == client_ip)
+    to_client = is_tcp & (packet_list['dst_ip'] == client_ip) & ~from_client
+    is_client = from_client | to_client
+    
+    client_packets = packet_list[is_client]
+    from_client = from_client[is_client]
+    
+    server_ip = np.where(from_client, client_packets['dst_ip'], client_packets['src_ip']).astype(np.uint64)
+    server_port = np.where(from_client, client_packets['dst_port'], client_packets['src_port']).astype(np.uint64)
+    client_port = np.where(from_client, client_packets['src_port'], client_packets['dst_port']).astype(np.uint64)
+    
+    # 以 flow_id 分組, 並保留各組第一次出現的順序
+    flow_ids = (client_port << np.uint64(48)) | (server_ip << np.uint64(16)) | server_port
+    unique_ids, first_index, inverse = np.unique(flow_ids, return_index=True, return_inverse=True)
+    appearance = np.argsort(first_index, kind='stable')
+    flow_rank = np.empty_like(appearance)
+    flow_rank[appearance] = np.arange(len(appearance))
+    packet_rank = flow_rank[inverse.ravel()]
+    
+    sorted_packets = client_packets[np.argsort(packet_rank, kind='stable')]
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(packet_rank, minlength=len(appearance))))).tolist()
+    flows = {int(flow_id): [(bounds[i], bounds[i + 1])] for i, flow_id in enumerate(unique_ids[appearance].tolist())}
             
-    return grouped_packets
+    return sorted_packets, flows
+
+def flow_size(ranges):
+    return sum(end - start for start, end in ranges)
 
-def collect_grouped_packets_info(grouped_packets):
-    """輔助函式, 紀錄每個session的起點、終點、SYN旗標
+def collect_grouped_packets_info(packets, flows, flow_counts=None):
+    """輔助函式, 紀錄每個flow的起點、終點、SYN旗標
 
     Args:
-        grouped_packets (_type_): _description_
+        packets (np.ndarray): initial_packet_grouping 排列後的封包陣列
+        flows (dict): flow_id -> 封包索引範圍
+        flow_counts (dict, optional): 抽樣分析時抽樣前的統計 (見 unsampled_flow_counts), 起點、終點與SYN旗標以抽樣前的封包為準
     """
     grouped_packets_info = {}
     
-    for group_ip_port, packets in grouped_packets.items():
-        if group_ip_port == 'background':
-            continue
-
-        grouped_packets_info[group_ip_port] = {
-            'First Packet Order': int(packets[0].number),
-            'Last Packet Order': int(packets[-1].number),
-            'SYN Flag': get_tcp_flags(packets[0].tcp.flags)['SYN'] # 有該旗標的封包，代表是新的正常session
+    for flow_id, ranges in flows.items():
+        if flow_counts is None:
+            first, last = ranges[0][0], ranges[-1][1] - 1
+            first_order, last_order, syn = int(packets['number'][first]), int(packets['number'][last]), bool(packets['flags'][first] & pcap_reader.SYN)
+        else:
+            _, _, first_order, last_order, syn = flow_counts[flow_id]
+        grouped_packets_info[flow_id] = {
+            'First Packet Order': first_order,
+            'Last Packet Order': last_order,
+            'SYN Flag': syn, # 有該旗標的封包，代表是新的正常session
+            'IP Pair': flow_id_parts(flow_id)[1] # client_ip固定, 以server_ip代表不分方向的IP組合
         }
         
     return grouped_packets_info
@@ -97,39 +177,37 @@ def collect_grouped_packets_info(grouped_packets):
 def find_reconnect_sessions(sessions, expected_session_count):
     """輔助函式, 找到可能是斷線重聯的兩段session, 將其記錄下來
 
+    依結束順序處理每個session, 在同一對IP、以SYN開始的session中, 用 bisect 找出最早在其結束後開始的一個
+
     Args:
-        sessions (_type_): _description_
-        expected_session_count (_type_): _description_
+        sessions (dict): collect_grouped_packets_info 的結果, 配對到的session會被移除
+        expected_session_count (int): 預期的session數量
 
     Returns:
-        _type_: _description_
+        dict: 舊session -> 重聯後的新session
     """
     sorted_sessions = sorted(sessions.items(), key=lambda x: x[1]['Last Packet Order'])
     reconnect_pairs = {}
     total_session_count = len(sessions)
     
-    for i, (session1, data1) in enumerate(sorted_sessions):
+    # 同一對IP中以SYN開始的session (即新的正常session)，依第一個封包順序排列
+    syn_sessions = defaultdict(lambda: ([], []))
+    for session, data in sorted(sessions.items(), key=lambda x: x[1]['First Packet Order']):
+        if data['SYN Flag']:
+            first_orders, candidates = syn_sessions[data['IP Pair']]
+            first_orders.append(data['First Packet Order'])
+            candidates.append(session)
+    
+    for session1, data1 in sorted_sessions:
         if session1 not in sessions:
             continue
 
-        min_gap = float('inf')
-        reconnect_candidate = None
-
-        for j, (session2, data2) in enumerate(sorted_sessions[i+1:]):
-            if session2 not in sessions:
-                continue
-            
-            session1_ip = '-'.join([part.split(':')[0] for part in session1.split('-')])
-            session2_ip = '-'.join([part.split(':')[0] for part in session2.split('-')])
-            if session1_ip == session2_ip: # 代表是同一對IP
-                if data2['First Packet Order'] > data1['Last Packet Order'] and data2['SYN Flag']: # 代表 data2 順序上是在 data1 之後，且是新的正常session
-                    gap = data2['First Packet Order'] - data1['Last Packet Order']
-                    
-                    if gap < min_gap:
-                        min_gap = gap
-                        reconnect_candidate = session2
-
-        if reconnect_candidate:
+        first_orders, candidates = syn_sessions.get(data1['IP Pair'], ([], []))
+        position = bisect.bisect_right(first_orders, data1['Last Packet Order']) # 第一個在 session1 結束後才開始的session
+        
+        if position < len(candidates):
+            first_orders.pop(position)
+            reconnect_candidate = candidates.pop(position)
             reconnect_pairs[session1] = reconnect_candidate
             del sessions[session1]
             del sessions[reconnect_candidate]
@@ -141,167 +219,185 @@ def find_reconnect_sessions(sessions, expected_session_count):
 
     return reconnect_pairs
 
-def handle_reconnect_sessions(initial_packet_groups, reconnect_pairs):
-    """輔助函式, 將斷線重聯的兩段session組合起來
+def handle_reconnect_sessions(flows, reconnect_pairs):
+    """輔助函式, 將斷線重聯的兩段flow組合起來
+
+    Args:
+        flows (dict): flow_id -> 封包索引範圍
+        reconnect_pairs (dict): 舊flow -> 重聯後的新flow
+    """
+    for old_flow, new_flow in reconnect_pairs.items():
+            flows[new_flow] = flows.pop(old_flow) + flows.pop(new_flow) # 按順序組合兩個flow的封包範圍, 並保留新的flow
+
+def record_reconnections(reconnect_pairs, flow_table, client_ip):
+    """輔助函式, 在flow table記錄重聯來源
 
     Args:
-        initial_packet_groups (_type_): _description_
-        reconnect_pairs (_type_): _description_
+        flow_table (dict): 跨時間間隔的flow紀錄
+        client_ip (int): 伺服器/主機IP
     """
-    for old_key, new_key in reconnect_pairs.items():
-            logging.info(f"Reconnect: {old_key} -> {new_key}")
-            initial_packet_groups[old_key].extend(initial_packet_groups[new_key]) # 按順序組合兩個session的封包
-            del initial_packet_groups[new_key]
-            initial_packet_groups[new_key] = initial_packet_groups.pop(old_key) # 重新命名以保留新的session名稱
+    for old_flow, new_flow in reconnect_pairs.items():
+        logging.info(f"Reconnect: {format_flow(client_ip, old_flow)} -> {format_flow(client_ip, new_flow)}")
+        flow_entry(flow_table, new_flow)['reconnected_from'] = old_flow
 
 # PART 2-2: 依照分類結果追蹤sessions
-def sort_and_filter_sessions(initial_packet_groups, exclude_keywords, ip_quota):
+def flow_entry(flow_table, flow_id):
+    """輔助函式, 取得flow table中的flow紀錄
+
+    Returns:
+        dict: 'session' 為最後一次指派到的session編號, 'reconnected_from' 為重聯前的flow
+    """
+    return flow_table.setdefault(flow_id, {'session': None, 'reconnected_from': None})
+
+def sort_and_filter_sessions(flows, client_ip, ip_quota, sizes=None):
     ip_count = {}
-    filtered_pairs = []
-    
-    filtered_keys = [
-        key for key in initial_packet_groups.keys()
-        if all(exclude_keyword not in key for exclude_keyword in exclude_keywords)
-    ]
+    filtered_flows = []
     
-    sorted_keys = sorted(filtered_keys, key=lambda key: len(initial_packet_groups[key]), reverse=True)
+    # 抽樣分析時以抽樣前的封包數 (sizes) 排序
+    sorted_flows = sorted(flows, key=lambda flow_id: flow_size(flows[flow_id]) if sizes is None else sizes.get(flow_id, 0), reverse=True)
     
-    for pair in sorted_keys:
-        ip1, ip2 = pair.split('-')
-        ip1 = ip1.split(':')[0]
-        ip2 = ip2.split(':')[0]
-        
-        for ip in [ip1, ip2]:
+    for flow_id in sorted_flows:
+        for ip in (client_ip, flow_id_parts(flow_id)[1]):
             if ip in ip_quota:
                 ip_count[ip] = ip_count.get(ip, 0) + 1
                 
                 if ip_count[ip] <= ip_quota[ip]:
-                    filtered_pairs.append(pair)
+                    filtered_flows.append(flow_id)
                     break
     
-    return filtered_pairs
+    return filtered_flows
     
 
-def initialize_session_tracking(packet_groups, session_track, sorted_group_keys, session_key_history):
-    for i, session_name in enumerate(session_track.keys()):
-            try:
-                top_session_info = sorted_group_keys[i]
-                session_track[session_name] = top_session_info
-                packet_groups[f"{session_name}: {top_session_info}"] = packet_groups.pop(top_session_info)
-                session_key_history[top_session_info] = session_name
-            except IndexError: # 連線數比預期少，可能條件錯誤，也可能一開始就斷線了
-                top_session_info = None
-                
-            logging.info(f"{session_name} assigned to {top_session_info}")
+def initialize_session_tracking(flows, sessions, session_track, sorted_flows, flow_table, client_ip):
+    for i, session_number in enumerate(session_track.keys()):
+            if i < len(sorted_flows):
+                flow_id = sorted_flows[i]
+                session_track[session_number] = flow_id
+                sessions[session_number] = (flow_id, flows.pop(flow_id))
+                flow_entry(flow_table, flow_id)['session'] = session_number
+                logging.info(f"Session {session_number} assigned to {format_flow(client_ip, flow_id)}")
+            else: # 連線數比預期少，可能條件錯誤，也可能一開始就斷線了
+                logging.info(f"Session {session_number} assigned to None")
 
-def update_session_tracking(initial_packet_groups, session_track, reconnect_pairs, sorted_group_keys, session_key_history):
-    for session_name, old_key in session_track.items():
-        if old_key in initial_packet_groups: # 這個session沒有變動
-            initial_packet_groups[f"{session_name}: {old_key}"] = initial_packet_groups.pop(old_key)
+def update_session_tracking(flows, sessions, session_track, reconnect_pairs, sorted_flows, flow_table, client_ip):
+    for session_number, old_flow in session_track.items():
+        if old_flow in flows: # 這個session沒有變動
+            sessions[session_number] = (old_flow, flows.pop(old_flow))
             continue
 
-        new_key = reconnect_pairs.get(old_key, None) 
-        if new_key: # 這個session有變動，且有可能的對應reconnect session
-            session_track[session_name] = new_key
-            initial_packet_groups[f"{session_name}: {new_key}"] = initial_packet_groups.pop(new_key)
+        new_flow = reconnect_pairs.get(old_flow, None)
+        if new_flow in flows: # 這個session有變動，且有可能的對應reconnect session
+            session_track[session_number] = new_flow
+            sessions[session_number] = (new_flow, flows.pop(new_flow))
         else: # 這個session有變動，但沒有對應的reconnect session
-            if session_track[session_name] != 'NONE':
-                logging.info(f"Unable to track {session_name}: {old_key}") # 斷線宣告
-            session_track[session_name] = 'NONE'
+            if old_flow is not None:
+                logging.info(f"Unable to track Session {session_number}: {format_flow(client_ip, old_flow)}") # 斷線宣告
+            session_track[session_number] = None
             
-    if any(val == 'NONE' for val in session_track.values()): # 有session斷線
-        remaining_keys = sorted_group_keys.copy()
-        for session_name, val in session_track.items():
-            if val == 'NONE':
-                try: # 嘗試重新配對 (高風險)
-                    for top_session_info in remaining_keys:
-                        prev_assigned_session = session_key_history.get(top_session_info, None)
-                        if prev_assigned_session and prev_assigned_session != session_name:
-                            continue
-                        
-                        session_track[session_name] = top_session_info
-                        initial_packet_groups[f"{session_name}: {top_session_info}"] = initial_packet_groups.pop(top_session_info)
-                        session_key_history[top_session_info] = session_name
-                        
-                        logging.info(f"{session_name} re-assigned to {top_session_info}")
-                        
-                        remaining_keys.remove(top_session_info)
-                        break
+    if any(val is None for val in session_track.values()): # 有session斷線
+        remaining_flows = sorted_flows.copy()
+        for session_number, val in session_track.items():
+            if val is None: # 嘗試重新配對 (高風險)
+                for flow_id in remaining_flows:
+                    prev_assigned_session = flow_table.get(flow_id, {}).get('session')
+                    if prev_assigned_session is not None and prev_assigned_session != session_number:
+                        continue
+                    if flow_id not in flows: # 已由其他session追蹤
+                        continue
+                    
+                    session_track[session_number] = flow_id
+                    sessions[session_number] = (flow_id, flows.pop(flow_id))
+                    flow_entry(flow_table, flow_id)['session'] = session_number
+                    
+                    logging.info(f"Session {session_number} re-assigned to {format_flow(client_ip, flow_id)}")
                     
-                except StopIteration:
-                    pass       
+                    remaining_flows.remove(flow_id)
+                    break
 
-def session_tracking(initial_packet_groups, session_track, reconnect_pairs, session_key_history, ip_quota):
+def session_tracking(flows, session_track, reconnect_pairs, flow_table, ip_quota, client_ip, sizes=None):
     """更新各session的狀態
 
     Args:
-        initial_packet_groups (_type_): _description_
-        session_track (_type_): _description_
-        reconnect_pairs (_type_): _description_
+        flows (dict): flow_id -> 封包索引範圍, 被指派到session的flow會被移除
+        session_track (dict): session編號 -> 目前追蹤的flow_id, 未追蹤時為 None
+        reconnect_pairs (dict): 舊flow -> 重聯後的新flow
+        sizes (dict, optional): 抽樣分析時 flow_id -> 抽樣前的封包數
 
     Returns:
-        _type_: _description_
+        dict: session編號 -> (flow_id, 封包索引範圍), 依指派順序
     """
-    if all(val == 'NONE' for val in session_track.values()): # 首次執行
-        sorted_group_keys = sort_and_filter_sessions(initial_packet_groups, 'background', ip_quota)
-        initialize_session_tracking(initial_packet_groups, session_track, sorted_group_keys, session_key_history)
-        
-        return initial_packet_groups
-        
+    sessions = {}
+    sorted_flows = sort_and_filter_sessions(flows, client_ip, ip_quota, sizes)
+    
+    if all(val is None for val in session_track.values()): # 首次執行
+        initialize_session_tracking(flows, sessions, session_track, sorted_flows, flow_table, client_ip)
     else: # 非首次執行，確認session是否有變動
-        sorted_group_keys = sort_and_filter_sessions(initial_packet_groups, ['background', 'Session'], ip_quota)
-        update_session_tracking(initial_packet_groups, session_track, reconnect_pairs, sorted_group_keys, session_key_history)
+        update_session_tracking(flows, sessions, session_track, reconnect_pairs, sorted_flows, flow_table, client_ip)
         
-        return initial_packet_groups
+    return sessions
 
 # PART 2: 依照 session/訂閱關係 做分類
-def classify_packets(packet_list, client_ip, expected_session_count, ip_quota, session_track, session_key_history):
-    """將封包分類成不同的session
+# group_window_flows 只依賴該時間間隔的封包 (可以平行處理), session_tracking 需要依時間順序更新追蹤狀態
+def group_window_flows(packet_list, client_ip, expected_session_count, flow_counts=None):
+    """將時間間隔內client的封包分成flow, 並合併斷線重聯的兩段flow
 
     Args:
-        packet_list (_type_): _description_
-        session_track (_type_): _description_
+        flow_counts (dict, optional): 抽樣分析時抽樣前的統計, 見 collect_grouped_packets_info;
+                                      抽樣前有封包的flow都會出現 (依抽樣前第一個封包的順序), 沒有封包被抽中的flow其索引範圍為空
 
     Returns:
-        _type_: _description_
+        np.ndarray: 依flow重新排列的client封包
+        dict: flow_id -> 封包索引範圍 (已合併重聯的flow)
+        dict: 舊flow -> 重聯後的新flow
     """
-    initial_packet_groups = initial_packet_grouping(packet_list, client_ip)
-    grouped_packets_info = collect_grouped_packets_info(initial_packet_groups)
+    packets, flows = initial_packet_grouping(packet_list, client_ip)
+    if flow_counts is not None:
+        flows = {flow_id: flows.get(flow_id, []) for flow_id in sorted(flow_counts, key=lambda flow_id: flow_counts[flow_id][2])}
+    grouped_packets_info = collect_grouped_packets_info(packets, flows, flow_counts)
     reconnect_pairs = {}
     
     if len(grouped_packets_info) > expected_session_count: # 有多餘的session，可能是異常，也可能是reconnect
         reconnect_pairs = find_reconnect_sessions(grouped_packets_info, expected_session_count)
-        handle_reconnect_sessions(initial_packet_groups, reconnect_pairs)
+        handle_reconnect_sessions(flows, reconnect_pairs)
         
+    return packets, flows, reconnect_pairs
+
+def classify_packets(packet_list, client_ip, expected_session_count, ip_quota, session_track, flow_table):
+    """將封包分類成不同的session
+
+    Args:
+        packet_list (np.ndarray): 時間間隔內的封包陣列
+        client_ip (int): 伺服器/主機IP
+        ip_quota (dict): server_ip (int) -> session中該ip可以分配到的數量
+        session_track (dict): session編號 -> 目前追蹤的flow_id
+        flow_table (dict): 跨時間間隔的flow紀錄
+
+    Returns:
+        np.ndarray: 依flow重新排列的client封包
+        dict: session編號 -> (flow_id, 封包索引範圍)
+    """
+    packets, flows, reconnect_pairs = group_window_flows(packet_list, client_ip, expected_session_count)
+    record_reconnections(reconnect_pairs, flow_table, client_ip)
+    sessions = session_tracking(flows, session_track, reconnect_pairs, flow_table, ip_quota, client_ip)
     
-    sessions = session_tracking(initial_packet_groups, session_track, reconnect_pairs, session_key_history, ip_quota)
-    
-    return sessions
+    return packets, sessions
 
 # PART 3: 計算通訊指標
-def unilateral_metrics(packet_list, client_ip):
+def unilateral_metrics(packet_list, client_ip, time_interval):
     """計算單向通訊指標: 平均單包吞吐量、平均總吞吐量、平均發送頻率 #! 目前已經不再使用了
 
     Args:
-        packet_list [packet_object]: 時間間隔內、同一個session的封包物件
+        packet_list (np.ndarray): 時間間隔內、同一個session的封包陣列
 
     Returns:
         defaultdict(dict): 通訊指標*2 (請求/回應)
     """
-    request_group = []
-    response_group = []
-    
-    for packet in packet_list:
-        src_ip = packet.ip.src
-        dst_ip = packet.ip.dst
-
-        if src_ip == client_ip:
-            response_group.append(packet)
-        elif dst_ip == client_ip:
-            request_group.append(packet)
+    client_ip = pcap_reader.ip_to_int(client_ip)
+    response_group = packet_list[packet_list['src_ip'] == client_ip]
+    request_group = packet_list[(packet_list['src_ip'] != client_ip) & (packet_list['dst_ip'] == client_ip)]
             
     def calculate(group):
-        total_bytes = sum(int(packet.length) for packet in group)
+        total_bytes = int(group['length'].sum())
         total_packets = len(group)
         
         avg_load = 0 if total_packets == 0 else round(total_bytes / total_packets, 2)
@@ -320,156 +416,200 @@ def unilateral_metrics(packet_list, client_ip):
     
     return u_metrics
 
-def get_tcp_flags(flag_hex):
-    """輔助函式, 將TCP Flags轉換成dict
-    """
-    # Convert hex to binary and pad with leading zeroes to 8 bits
-    flag_bin = bin(int(flag_hex, 16))[2:].zfill(8)
-    
-    # Define flags according to their bit position
-    flags = ['FIN', 'SYN', 'RST', 'PSH', 'ACK', 'URG', 'ECE', 'CWR']
-    flag_dict = {flag: bool(int(flag_bin[bit])) for bit, flag in enumerate(reversed(flags))}
+# 分開計算Request-Response延遲的 OPC UA service, 其餘歸到 Other
+DELAY_SERVICES = ('Read', 'Write', 'Browse', 'Call', 'CreateSession', 'ActivateSession', 'CreateSubscription', 'CreateMonitoredItems', 'Publish', 'Other')
 
-    return flag_dict
+def service_groups(type_ids):
+    """輔助函式, 將 OPC UA body 的 TypeId 轉成 DELAY_SERVICES 的索引
+    """
+    other = DELAY_SERVICES.index('Other')
+    unique_ids, inverse = np.unique(type_ids, return_inverse=True)
+    groups = [DELAY_SERVICES.index(name) if name in DELAY_SERVICES else other
+              for name in (opcua_decoder.SERVICE_NAMES.get(type_id) for type_id in unique_ids.tolist())]
+    return np.array(groups, dtype=np.int64)[inverse.ravel()] if len(type_ids) else np.zeros(0, dtype=np.int64)
 
-def bilateral_metrics(packet_list, session_pair):
-    """_summary_
+def window_bilateral_metrics(packet_list, session_ranges, session_ips, client_ports=None, sampled=False):
+    """計算雙向通訊指標, 一次處理整個時間間隔內所有session的封包
 
     Args:
-        packet_list [packet_object]: 時間間隔內、同一個session的封包物件
-        sub_key (int): client的連線port, 用來區分不同的session, server-opc-app的連線port固定為4840
+        packet_list (np.ndarray): 時間間隔內的封包陣列 (通常為 classify_packets 依flow排列後的封包)
+        session_ranges ([[(int, int)]]): 各session在 packet_list 中的封包索引範圍
+        session_ips ([(int, int)]): 各session的 (client_ip, server_ip), server-opc-app的連線port固定為4840
+        client_ports ([int], optional): 各session現行的client port, 指定時其他port的封包視為不屬於現行session
+        sampled (bool): 封包為抽樣分析的結果時, 另外依抽樣單位彙整樣本 ('unit_totals', 見 flow_sampling.unit_totals)
 
     Returns:
-        defaultdict(dict): 通訊指標 & 異常封包列表
+        [dict]: 各session的通訊指標 & 異常封包列表
     """
+    session_count = len(session_ranges)
+    if session_count == 0:
+        return []
     
-    rtt_list = []
-    req_resp_delay_list = []
-    track_packets = {}
-    session_indexes = {'max_req_seq': 0, 'max_resp_seq': 0, 'client_port': None, 'opc_req_handle': None, 'holding_SYN_flag': False}
-    h_messages = []
-    e_messages = []
+    session_sizes = [flow_size(ranges) for ranges in session_ranges]
+    session_ids = np.repeat(np.arange(session_count), session_sizes)
+    session_ips = np.array(session_ips, dtype=np.int64)
     
-    for packet in packet_list:
-        
-        # 基本封包資訊
-        order = packet.number
-        timestamp = float(packet.sniff_timestamp)
-        
-        src_ip = packet.ip.src
-        dst_ip = packet.ip.dst
-        src_port = packet[packet.transport_layer].srcport
-        dst_port = packet[packet.transport_layer].dstport
-        
-        server_ip = session_pair.split('-')[1]
-        server_port = 4840
-        client_ip = session_pair.split('-')[0]
-        client_port = src_port if src_ip == client_ip else dst_port
-        
-        flags = get_tcp_flags(packet.tcp.flags)
-        seq = int(packet.tcp.seq)
-        ack = int(packet.tcp.ack)
-        tcp_segment_len = int(packet.tcp.len)
-        
-        # 進階封包資訊
-        try:
-            rtt = float(packet.tcp.analysis_ack_rtt)
-            rtt_list.append(rtt) # 紀錄rtt
-        except AttributeError:
-            pass
-        try:
-            opc_req_handle = packet.opcua.RequestHandle
-        except AttributeError:
-            opc_req_handle = None
-        try:
-            opc_message_type = packet.opcua.transport_type
-            
-            if opc_message_type == 'HEL': # 紀錄Hello封包 (即新的session開啟) #TODO: 考慮新增一項檢查機制，確認是否接上之前的SYN-SNY/ACK
-                h_messages.append(order)
-        except AttributeError:
-            opc_message_type = None
-            
-        # 異常封包檢測
-        if flags['RST']: # 重置請求
-            e_messages.append(order)
-            continue
-        
-        if session_indexes['client_port'] and client_port != session_indexes['client_port']: # 不屬於現行的session
-            if flags['SYN']: # 可能是剛開啟的新session
-                session_indexes['holding_SYN_flag'] = True
-                e_messages.append(order) # 但是這裡先當作異常封包
-                continue 
-            else:
-                e_messages.append(order)
-                continue
-        elif session_indexes['holding_SYN_flag'] and flags['SYN'] and flags['ACK']: # 確定是剛開啟的新session
-            e_messages.pop() # 將上次加入的異常封包移除
-            session_indexes['holding_SYN_flag'] = False
-        
-        if src_ip == server_ip and seq <= session_indexes['max_resp_seq']: # 多種原因，高機率是某種retransmission
-            e_messages.append(order)
-            continue
-        elif src_ip != server_ip and seq <= session_indexes['max_req_seq']:
-            e_messages.append(order)
-            continue
-        
-        
-        # 計算Request-Response延遲
-        if flags['ACK']:
-            if opc_req_handle: # 這是OPC封包
-                if ack in track_packets and track_packets[ack]['opc_req_handle'] == opc_req_handle: # 這是有對應的回應封包
-                    req_resp_delay_list.append(timestamp - track_packets[ack]['timestamp'])
-                    track_packets.pop(ack, None)
-                    
-            if all(val == False for key, val in flags.items() if key != 'ACK'):
-                continue # 這是個純ACK封包，不需要紀錄
-            else:
-                track_packets[seq + tcp_segment_len] = {'timestamp': timestamp, 'seq': seq, 'ack': ack, 'opc_req_handle': opc_req_handle} # 下一個對應的回應封包其ack值會相等此次封包req+tcp_segment_len
-        
-        # 更新session_indexes
-        if src_ip == server_ip: # 這是封回應封包
-            session_indexes['max_resp_seq'] = seq
-        else:
-            session_indexes['max_req_seq'] = seq
-        if opc_req_handle:
-            session_indexes['opc_req_handle'] = opc_req_handle
-
-    avg_rtt = round(sum(rtt_list)*1000 / len(rtt_list), 3) if rtt_list else 0 # 取毫秒
-    avd_req_resp_delay = round(sum(req_resp_delay_list)*1000 / len(req_resp_delay_list), 3) if req_resp_delay_list else 0
+    # 依索引範圍只取出需要的欄位, 避免 structured array 複製的額外成本
+    index = np.concatenate([np.arange(start, end) for ranges in session_ranges for start, end in ranges] + [np.empty(0, dtype=np.int64)])
+    packets = {column: packet_list[column][index] for column in
+               ('number', 'timestamp', 'src_ip', 'src_port', 'dst_port', 'flags', 'seq', 'ack_rtt', 'opc_type', 'opc_channel', 'opc_type_id', 'req_handle',
+                *(('sample_unit', 'rtt_unit') if sampled else ()))}
+    packet_count = len(session_ids)
     
-    b_metrics = {'avg_rtt': avg_rtt, 'avd_req_resp_delay': avd_req_resp_delay, 'h_messages': h_messages, 'e_messages': e_messages}
+    order = packets['number']
+    timestamps = packets['timestamp']
+    flags = packets['flags']
+    seq = packets['seq'].astype(np.int64)
+    opc_channel = packets['opc_channel'].astype(np.int64)
+    opc_req_handle = packets['req_handle'].astype(np.int64)
     
-    return b_metrics
+    # 旗標解碼
+    is_rst = (flags & pcap_reader.RST) != 0
+    is_pure_ack = flags == pcap_reader.ACK # 純ACK封包，不需要紀錄
+    is_response = packets['src_ip'] == session_ips[session_ids, 1]
+    
+    # 進階封包資訊
+    has_rtt = ~np.isnan(packets['ack_rtt'])
+    is_hello = packets['opc_type'] == pcap_reader.OPC_MESSAGE_TYPES.index('HEL') # 紀錄Hello封包 (即新的session開啟) #TODO: 考慮新增一項檢查機制，確認是否接上之前的SYN-SNY/ACK
+    
+    # 異常封包檢測: 重置請求、不屬於現行的session
+    is_out_of_session = np.zeros(packet_count, dtype=bool)
+    if client_ports is not None:
+        expected_ports = np.array([-1 if port is None else port for port in client_ports], dtype=np.int64)[session_ids]
+        ports = np.where(packets['src_ip'] == session_ips[session_ids, 0], packets['src_port'], packets['dst_port'])
+        is_out_of_session = (expected_ports >= 0) & (ports != expected_ports)
+    
+    # 異常封包檢測: seq 不大於同session同方向先前紀錄過的最大seq, 多種原因，高機率是某種retransmission
+    # 只有非RST、非純ACK的封包會更新最大seq, 而被判為retransmission的封包其seq不會超過該值, 故可直接用分段累積最大值
+    segments = session_ids * 2 + is_response
+    segment_order = np.argsort(segments, kind='stable')
+    segment_offset = segments[segment_order] << 33 # seq < 2^32, 加上位移讓累積最大值不會跨段
+    updates = np.where(~is_rst & ~is_out_of_session & ~is_pure_ack, seq, 0)[segment_order] + segment_offset
+    previous_max = np.maximum(np.concatenate(([0], np.maximum.accumulate(updates)[:-1])) - segment_offset, 0)
+    is_retransmission = np.empty(packet_count, dtype=bool)
+    is_retransmission[segment_order] = seq[segment_order] <= previous_max
+    
+    is_error = is_rst | is_out_of_session | is_retransmission
+    
+    # 計算Request-Response延遲: 回應封包與請求封包的 (SecureChannelId, RequestHandle) 相同
+    has_handle = ~is_error & (opc_req_handle != 0)
+    
+    # 依 (session, SecureChannelId, RequestHandle, 封包順序) 排序, 同 key 的請求與回應相鄰, 每個回應往前找最後一個請求
+    candidates = np.flatnonzero(has_handle)
+    candidates = candidates[np.lexsort((candidates, opc_req_handle[candidates], opc_channel[candidates], session_ids[candidates]))]
+    same_key = np.concatenate(([False], (session_ids[candidates][1:] == session_ids[candidates][:-1]) &
+                               (opc_channel[candidates][1:] == opc_channel[candidates][:-1]) & (opc_req_handle[candidates][1:] == opc_req_handle[candidates][:-1])))
+    position = np.arange(len(candidates))
+    key_start = np.maximum.accumulate(np.where(same_key, 0, position))
+    last_request = np.maximum.accumulate(np.where(is_response[candidates], -1, position))
+    responses = np.flatnonzero(is_response[candidates] & (last_request >= key_start))
+    matched = last_request[responses]
+    
+    # 每個請求封包只能被第一個對應的回應封包配對 (配對後即移除), 配對依回應封包的順序排列
+    first_match = np.ones(len(matched), dtype=bool)
+    first_match[1:] = matched[1:] != matched[:-1]
+    pair_responses, pair_requests = candidates[responses[first_match]], candidates[matched[first_match]]
+    pair_order = np.argsort(pair_responses)
+    pair_responses, pair_requests = pair_responses[pair_order], pair_requests[pair_order]
+    if sampled: # 請求與回應需屬於同一個抽樣單位 (只因ACK而被保留的封包所組成的配對不是依抽樣比例選出的)
+        same_unit = packets['sample_unit'][pair_requests] == packets['sample_unit'][pair_responses]
+        pair_responses, pair_requests = pair_responses[same_unit], pair_requests[same_unit]
+    pair_sessions = session_ids[pair_responses]
+    req_resp_delays = timestamps[pair_responses] - timestamps[pair_requests]
+    
+    # 依session彙整 (bincount 依輸入順序累加, 與逐一相加的結果一致)
+    rtt_counts = np.bincount(session_ids[has_rtt], minlength=session_count)
+    rtt_sums = np.bincount(session_ids[has_rtt], weights=packets['ack_rtt'][has_rtt], minlength=session_count)
+    delay_counts = np.bincount(pair_sessions, minlength=session_count)
+    delay_sums = np.bincount(pair_sessions, weights=req_resp_delays, minlength=session_count)
+    
+    # 依請求封包的 service 分開彙整 (回應可能是 ServiceFault, 故以請求為準)
+    pair_services = service_groups(packets['opc_type_id'][pair_requests])
+    service_pairs = pair_sessions * len(DELAY_SERVICES) + pair_services
+    service_counts = np.bincount(service_pairs, minlength=session_count * len(DELAY_SERVICES)).reshape(session_count, -1)
+    service_sums = np.bincount(service_pairs, weights=req_resp_delays * 1000, minlength=session_count * len(DELAY_SERVICES)).reshape(session_count, -1)
+    
+    def split_by_session(mask):
+        orders = order[mask].tolist()
+        bounds = np.concatenate(([0], np.cumsum(np.bincount(session_ids[mask], minlength=session_count)))).tolist()
+        return [orders[bounds[i]:bounds[i + 1]] for i in range(session_count)]
+    
+    # 延遲分佈 (可合併的 sketch) 與抖動, 單位為毫秒
+    rtt_sessions, rtt_samples = session_ids[has_rtt], packets['ack_rtt'][has_rtt] * 1000
+    delay_samples = req_resp_delays * 1000
+    if sampled: # 依抽樣單位彙整; 分佈只包含抽中的單位的樣本 (一律保留的樣本權重不同, 不放入 sketch)
+        rtt_units, pair_units = packets['rtt_unit'][has_rtt], packets['sample_unit'][pair_requests]
+        unit_totals = {
+            'RTT': flow_sampling.unit_totals(rtt_sessions, rtt_units, rtt_samples, session_count),
+            'Req Resp Delay': flow_sampling.unit_totals(pair_sessions, pair_units, delay_samples, session_count),
+            'Error Packets Count': flow_sampling.unit_totals(session_ids[is_error], packets['sample_unit'][is_error], np.ones(np.count_nonzero(is_error)), session_count),
+        }
+        service_units = flow_sampling.unit_totals(service_pairs, pair_units, delay_samples, session_count * len(DELAY_SERVICES)).reshape(session_count, len(DELAY_SERVICES), -1)
+        rtt_sketches = latency_sketch.group_sketches(rtt_sessions[rtt_units != 0], rtt_samples[rtt_units != 0], session_count)
+        delay_sketches = latency_sketch.group_sketches(pair_sessions[pair_units != 0], delay_samples[pair_units != 0], session_count)
+    else:
+        rtt_sketches = latency_sketch.group_sketches(rtt_sessions, rtt_samples, session_count)
+        delay_sketches = latency_sketch.group_sketches(pair_sessions, delay_samples, session_count)
+    rtt_jitter_sums, rtt_jitter_counts = (column.tolist() for column in latency_sketch.group_jitter(rtt_sessions, rtt_samples, session_count))
+    delay_jitter_sums, delay_jitter_counts = (column.tolist() for column in latency_sketch.group_jitter(pair_sessions, delay_samples, session_count))
+    
+    # 轉成 list 後依session索引組成各session的dict
+    rtt_sums, rtt_counts = rtt_sums.tolist(), rtt_counts.tolist()
+    delay_sums, delay_counts = delay_sums.tolist(), delay_counts.tolist()
+    service_sums, service_counts = service_sums.tolist(), service_counts.tolist()
+    h_messages, e_messages = split_by_session(is_hello), split_by_session(is_error)
+    
+    b_metrics_list = []
+    for i in range(session_count):
+        b_metrics_list.append({
+            'rtt_sum': rtt_sums[i], 'rtt_count': rtt_counts[i], 'delay_sum': delay_sums[i], 'delay_count': delay_counts[i], # 秒, 供合併時間間隔使用
+            'avg_rtt': average_ms(rtt_sums[i], rtt_counts[i]), 'avd_req_resp_delay': average_ms(delay_sums[i], delay_counts[i]),
+            'service_delays': {service: (total, count) for service, total, count in zip(DELAY_SERVICES, service_sums[i], service_counts[i])}, # 毫秒總和, 配對數
+            'h_messages': h_messages[i], 'e_messages': e_messages[i],
+            'sketches': {'RTT': rtt_sketches[i], 'Req Resp Delay': delay_sketches[i]}, # latency_sketch
+            'jitter': {'RTT': (rtt_jitter_sums[i], rtt_jitter_counts[i]), 'Req Resp Delay': (delay_jitter_sums[i], delay_jitter_counts[i])}, # (相鄰樣本差的總和, 個數)
+        })
+        if sampled: # 毫秒; 異常封包的樣本值為1
+            b_metrics_list[-1]['unit_totals'] = {**{metric: totals[i] for metric, totals in unit_totals.items()}, 'services': service_units[i]} # services 依 DELAY_SERVICES 的順序
+    
+    return b_metrics_list
+
+def average_ms(total, count):
+    """輔助函式, 秒的總和 -> 平均毫秒, 沒有樣本時為0
+    """
+    return round(total*1000 / count, 3) if count else 0
+
+def bilateral_metrics(packet_list, session_pair, client_port=None):
+    """計算單一session的雙向通訊指標
+
+    Args:
+        packet_list (np.ndarray): 時間間隔內、同一個session的封包陣列
+        session_pair (str): client_ip-server_ip
+
+    Returns:
+        defaultdict(dict): 通訊指標 & 異常封包列表
+    """
+    session_ips = tuple(pcap_reader.ip_to_int(ip) for ip in session_pair.split('-'))
+    return window_bilateral_metrics(packet_list, [[(0, len(packet_list))]], [session_ips], None if client_port is None else [client_port])[0]
 
 # PART 4-1 指標分組前處理
-def transform_keys(original_dict):
-    new_dict = {}
-    
-    for key in original_dict:
-        
-        if 'Session' not in key:
-                continue
-        
-        session_part, ip_part = key.split(': ', 1)
-        parts = ip_part.split('-')
-        ip_addresses = [part.split(':')[0] for part in parts]
-        new_key = session_part + ': ' + '-'.join(ip_addresses)
-        new_dict[new_key] = original_dict[key]
-        
-    return new_dict
+def transform_keys(sessions):
+    """將 session編號 -> (flow_id, 封包索引範圍) 轉成 (session編號, server_ip) -> flow_id
+    """
+    return {(session_number, flow_id_parts(flow_id)[1]): flow_id for session_number, (flow_id, _) in sessions.items()}
 
-def align_sessions(old_dict, new_dict):
-    record = [(k.split(': ')[1], k.split(': ')[0]) for k in old_dict.keys()]
+def align_sessions(old_keys, new_dict):
+    record = [(server_ip, session_number) for session_number, server_ip in old_keys]
     aligned_dict = {}
     
     for new_key, value in new_dict.items():
-        session, ip_pair = new_key.split(': ')
-        matched_sessions = [sess for ip, sess in record if ip == ip_pair]
+        server_ip = new_key[1]
+        matched_sessions = [sess for ip, sess in record if ip == server_ip]
 
         if matched_sessions:
             # Use the first matched session and remove it from record
-            aligned_key = f"{matched_sessions[0]}: {ip_pair}"
-            record = [(ip, sess) for ip, sess in record if not (ip == ip_pair and sess == matched_sessions[0])]
+            aligned_key = (matched_sessions[0], server_ip)
+            record.remove((server_ip, matched_sessions[0]))
         else:
             aligned_key = new_key
         
@@ -478,180 +618,711 @@ def align_sessions(old_dict, new_dict):
     return aligned_dict
 
 # PART 4 指標分組儲存
-def process_and_save_data(average_rtt, average_req_resp_delay, reconnection_count, error_packets_count, output_file):
-    # Helper function to calculate the average of a list
-    def process_data(data_dict):
-        processed_data = defaultdict(float)
-        for outer_key, inner_dict in data_dict.items():
-            if "Session" in outer_key:
-                total = sum(inner_dict.values())
-                count = len(inner_dict)
-                processed_data[outer_key] = total / count if count > 0 else 0
-        return processed_data
-
-    # Process the defaultdict structures
-    processed_average_rtt = process_data(average_rtt)
-    processed_average_req_resp_delay = process_data(average_req_resp_delay)
-    processed_reconnection_count = process_data(reconnection_count)
-    processed_error_packets_count = process_data(error_packets_count)
+# 各時間間隔的指標欄位 -> data_training.csv 的平均欄位
+WINDOW_METRICS = {
+    'RTT': 'Average RTT',
+    'Req Resp Delay': 'Average Req Resp Delay',
+    'Reconnection Count': 'Average Reconnection Count',
+    'Error Packets Count': 'Average Error Packets Count',
+}
+# 各 service 的Request-Response延遲 -> data_training.csv 的欄位, 以所有配對的平均計算 (不是各時間間隔平均的平均)
+SERVICE_DELAY_COLUMNS = {service: f'Average {service} Delay' for service in DELAY_SERVICES}
+# 延遲分佈的分位數與抖動 (相鄰樣本差的平均), 單位為毫秒; 時間間隔與整段擷取使用相同欄位名稱
+DISTRIBUTION_METRICS = ('RTT', 'Req Resp Delay')
+DISTRIBUTION_QUANTILES = {'P50': 0.5, 'P95': 0.95, 'P99': 0.99}
+DISTRIBUTION_COLUMNS = [f'{metric} {name}' for metric in DISTRIBUTION_METRICS for name in (*DISTRIBUTION_QUANTILES, 'Jitter')]
+WINDOW_HEADERS = ['Session', 'Capture Duration', *WINDOW_METRICS, *DISTRIBUTION_COLUMNS, *(f'{service} Delay' for service in DELAY_SERVICES)]
+# data_training.csv 中由封包分析產生的欄位
+TRAINING_METRIC_COLUMNS = [*WINDOW_METRICS.values(), *DISTRIBUTION_COLUMNS, *SERVICE_DELAY_COLUMNS.values()]
+# 抽樣分析 (sample_rate < 1) 時額外輸出的95%信賴區間半寬, 以抽樣單位 (見 flow_sampling.sampling_mask) 為群集估計變異數:
+# - Reconnection Count: HEL 一律保留, 與不抽樣時相同, 不提供信賴區間
+# - Error Packets Count: 一律保留的 RST/SYN/FIN 為確定值; retransmission 與原本的資料段屬於同一個抽樣單位, 只在抽中的單位中偵測, 以 1/sample_rate 還原
+# - 抖動在抽樣下有偏差 (相鄰樣本不再相鄰), 不提供信賴區間
+CONFIDENCE_METRICS = ['RTT', 'Req Resp Delay']
+CONFIDENCE_COLUMNS = [
+    *(f'{WINDOW_METRICS[metric]} CI' for metric in (*CONFIDENCE_METRICS, 'Error Packets Count')),
+    *(f'{metric} {name} CI' for metric in DISTRIBUTION_METRICS for name in DISTRIBUTION_QUANTILES),
+    *(f'{column} CI' for column in SERVICE_DELAY_COLUMNS.values()),
+]
+
+def is_sampled(sample_rate):
+    return sample_rate is not None and sample_rate < 1
+
+def training_metric_columns(sample_rate=None):
+    """data_training.csv 中由封包分析產生的欄位, 抽樣分析時包含信賴區間
+    """
+    return TRAINING_METRIC_COLUMNS + (CONFIDENCE_COLUMNS if is_sampled(sample_rate) else [])
+
+def distribution_columns(sketches, jitter, digits):
+    """輔助函式, 將各延遲指標的 sketch 與抖動累計值轉成 DISTRIBUTION_COLUMNS 欄位
+
+    Args:
+        sketches (dict): DISTRIBUTION_METRICS -> latency_sketch
+        jitter (dict): DISTRIBUTION_METRICS -> (相鄰樣本差的總和, 個數)
+    """
+    columns = {}
+    for metric in DISTRIBUTION_METRICS:
+        values = latency_sketch.quantiles(sketches[metric], list(DISTRIBUTION_QUANTILES.values()))
+        columns.update({f'{metric} {name}': round(value, digits) for name, value in zip(DISTRIBUTION_QUANTILES, values)})
+        total, count = jitter[metric]
+        columns[f'{metric} Jitter'] = round(total / count, digits) if count else 0
+    return columns
+
+def window_distribution_columns(b_metrics_list, digits):
+    """輔助函式, 與逐一對各flow呼叫 distribution_columns 相同, 分位數一次以 latency_sketch.group_quantiles 計算
+    """
+    columns_list = [{} for _ in b_metrics_list]
+    qs = list(DISTRIBUTION_QUANTILES.values())
+    for metric in DISTRIBUTION_METRICS:
+        values_list = latency_sketch.group_quantiles([b_metrics['sketches'][metric] for b_metrics in b_metrics_list], qs)
+        for columns, values, b_metrics in zip(columns_list, values_list, b_metrics_list):
+            columns.update({f'{metric} {name}': round(value, digits) for name, value in zip(DISTRIBUTION_QUANTILES, values)})
+            total, count = b_metrics['jitter'][metric]
+            columns[f'{metric} Jitter'] = round(total / count, digits) if count else 0
+    return columns_list
+
+def update_metric_totals(metric_totals, key, window_row, b_metrics):
+    """輔助函式, 將單一時間間隔的指標累加到該session的累計值, 不保留各時間間隔的數值
+
+    Args:
+        b_metrics (dict): window_bilateral_metrics 的結果, 使用 service_delays, sketches, jitter, 抽樣分析時另外使用 unit_totals 與 candidates
+    """
+    if key not in metric_totals: # 不用 setdefault, 以免每個時間間隔都建立一次初始值
+        metric_totals[key] = {
+            'count': 0, **{metric: 0 for metric in WINDOW_METRICS},
+            'service_delays': {service: [0.0, 0] for service in DELAY_SERVICES}, # 毫秒總和, 配對數
+            'sketches': {metric: latency_sketch.new_sketch() for metric in DISTRIBUTION_METRICS},
+            'jitter': {metric: [0.0, 0] for metric in DISTRIBUTION_METRICS},
+            'window_means': {metric: flow_sampling.new_window_mean_totals() for metric in CONFIDENCE_METRICS}, # 抽樣分析時的估計 (毫秒)
+            'unit_totals': {metric: flow_sampling.new_unit_totals() for metric in CONFIDENCE_METRICS},
+            'service_units': np.zeros((len(DELAY_SERVICES), len(flow_sampling.UNIT_TOTALS))), # 依 DELAY_SERVICES 的順序
+            'error_variance': 0.0, # 各時間間隔異常封包數估計的變異數總和
+        }
+    totals = metric_totals[key]
+    totals['count'] += 1
+    for metric in WINDOW_METRICS:
+        totals[metric] += window_row[metric]
+    for service, (total, count) in b_metrics['service_delays'].items():
+        totals['service_delays'][service][0] += total
+        totals['service_delays'][service][1] += count
+    if 'unit_totals' in b_metrics: # 抽樣分析
+        for metric in CONFIDENCE_METRICS:
+            flow_sampling.add_window_mean(totals['window_means'][metric], b_metrics['unit_totals'][metric], b_metrics['candidates'], b_metrics['sample_rate'])
+            flow_sampling.add_unit_totals(totals['unit_totals'][metric], b_metrics['unit_totals'][metric])
+        flow_sampling.add_unit_totals(totals['service_units'], b_metrics['unit_totals']['services'])
+        totals['error_variance'] += flow_sampling.total_variance(b_metrics['unit_totals']['Error Packets Count'], b_metrics['sample_rate'])
+    for metric in DISTRIBUTION_METRICS:
+        latency_sketch.merge(totals['sketches'][metric], b_metrics['sketches'][metric])
+        totals['jitter'][metric][0] += b_metrics['jitter'][metric][0]
+        totals['jitter'][metric][1] += b_metrics['jitter'][metric][1]
+
+def window_row(client_ip, key, capture_duration, b_metrics):
+    """輔助函式, 將某個session在一個時間間隔的指標轉成 WINDOW_HEADERS 欄位
+
+    Args:
+        key (tuple): (session編號, server_ip)
+        capture_duration (int): 時間間隔的起點 -秒
+        b_metrics (dict): window_bilateral_metrics 的結果
+    """
+    return {
+        'Session': format_session_key(client_ip, key),
+        'Capture Duration': capture_duration,
+        'RTT': b_metrics['avg_rtt'],
+        'Req Resp Delay': b_metrics['avd_req_resp_delay'],
+        'Reconnection Count': len(b_metrics['h_messages']),
+        'Error Packets Count': b_metrics.get('error_estimate', len(b_metrics['e_messages'])),
+        **(b_metrics.get('window_columns') or distribution_columns(b_metrics['sketches'], b_metrics['jitter'], 3)),
+        **{f'{service} Delay': round(total / count, 3) if count else 0 for service, (total, count) in b_metrics['service_delays'].items()},
+    }
+
+# 多個時間間隔長度 (解析度) 一起計算: 擷取檔只解碼一次, 較長的時間間隔由格線上對應的基本時間間隔 (最短者) 的封包組成,
+# 各解析度再各自分組flow、追蹤session並累計 metric_totals, 結果與只計算該時間間隔長度時相同
+def new_resolution(expected_session_count):
+    """輔助函式, 單一解析度的session追蹤狀態與累計指標
+    """
+    return {
+        'session_track': {i+1: None for i in range(expected_session_count)}, # session編號 -> 目前追蹤的flow_id
+        'flow_table': {}, # flow_id -> 指派過的session、重聯來源
+        'history_session_keys': [], # 上一個時間間隔的 (session編號, server_ip)
+        'metric_totals': {}, # (session編號, server_ip) -> 時間間隔數與各指標的累計值
+    }
+
+def resolution_window_rows(client_ip, time_interval, number, resolution, window_metrics):
+    """輔助函式, 將某個解析度一個時間間隔的各session指標累加到 metric_totals
+
+    Args:
+        number (int): 時間間隔編號
+        window_metrics (dict): (session編號, server_ip) -> window_bilateral_metrics 的結果, 見 track_window_sessions
+
+    Returns:
+        [dict]: 該時間間隔各session的指標, 欄位為 WINDOW_HEADERS
+    """
+    window_rows = []
+    for key, b_metrics in window_metrics.items():
+        row = window_row(client_ip, key, number * time_interval, b_metrics)
+        update_metric_totals(resolution['metric_totals'], key, row, b_metrics)
+        window_rows.append(row)
+    return window_rows
+
+def iter_resolution_windows(windows, time_intervals, sampling=None):
+    """將依序的基本時間間隔組成各解析度的時間間隔, 較長的時間間隔在下一個時間間隔開始 (或封包結束) 時回傳
+
+    Args:
+        windows (iterable): 依序、連續的 (基本時間間隔編號, 封包陣列), 見 iter_time_windows
+        time_intervals ([int]): 由短到長的時間間隔長度 -秒, 都是第一個 (基本時間間隔) 的倍數
+        sampling (dict, optional): 解碼這些封包時的抽樣狀態 (flow_sampling.new_sampling), 取出各時間間隔抽樣前的封包數
+
+    Yields:
+        (int, int, np.ndarray, dict): 時間間隔長度, 時間間隔編號, 時間間隔內的封包陣列, 抽樣前的封包數 (沒有抽樣時為 None)
+    """
+    base_interval = time_intervals[0]
+    current = {time_interval: None for time_interval in time_intervals[1:]} # 目前 (尚未結束) 的時間間隔編號
+    pending = {time_interval: ([], []) for time_interval in time_intervals[1:]} # 目前時間間隔中各基本時間間隔的封包陣列與抽樣前的封包數
     
+    def finish(time_interval):
+        packet_lists, counts_list = pending[time_interval]
+        pending[time_interval] = ([], [])
+        packet_list = packet_lists[0] if len(packet_lists) == 1 else np.concatenate(packet_lists)
+        return time_interval, current[time_interval], packet_list, None if sampling is None else flow_sampling.merge_packet_counts(counts_list)
+    
+    for number, packet_list in windows:
+        packet_counts = None if sampling is None else flow_sampling.pop_packet_counts(sampling, number)
+        for time_interval in current:
+            window = number * base_interval // time_interval
+            if current[time_interval] is not None and window != current[time_interval]:
+                yield finish(time_interval)
+            current[time_interval] = window
+            pending[time_interval][0].append(packet_list)
+            pending[time_interval][1].append(packet_counts)
+        yield base_interval, number, packet_list, packet_counts
+    
+    for time_interval in current:
+        if current[time_interval] is not None:
+            yield finish(time_interval)
+
+def sampled_columns(totals, sample_rate, digits):
+    """輔助函式, 抽樣分析時各指標的信賴區間半寬 (欄位為 CONFIDENCE_COLUMNS), 以及補上沒有樣本的時間間隔後的 Average RTT/Req Resp Delay
+
+    - 時間間隔平均的平均: 見 flow_sampling.window_mean_estimate
+    - 分位數: 見 flow_sampling.quantile_interval, 以抽樣單位的設計效應放大
+    - service 延遲: 所有配對的平均, 見 flow_sampling.ratio_interval
+    - 異常封包數: 各時間間隔估計值的平均, 變異數為各時間間隔 flow_sampling.total_variance 的總和 / 時間間隔數²
+    """
+    columns = {}
+    for metric, window_means in totals['window_means'].items():
+        estimate, interval = flow_sampling.window_mean_estimate(window_means, totals['unit_totals'][metric], totals[metric], totals['count'], sample_rate)
+        columns[WINDOW_METRICS[metric]] = round(float(estimate), digits)
+        columns[f'{WINDOW_METRICS[metric]} CI'] = round(float(interval), digits)
+    columns[f"{WINDOW_METRICS['Error Packets Count']} CI"] = round(flow_sampling.CONFIDENCE_Z * math.sqrt(totals['error_variance']) / totals['count'], digits)
+    for metric in DISTRIBUTION_METRICS:
+        design_effect = flow_sampling.design_effect(totals['unit_totals'][metric])
+        for name, q in DISTRIBUTION_QUANTILES.items():
+            columns[f'{metric} {name} CI'] = round(float(flow_sampling.quantile_interval(totals['sketches'][metric], q, sample_rate, design_effect)), digits)
+    for column, service_totals in zip(SERVICE_DELAY_COLUMNS.values(), totals['service_units']):
+        columns[f'{column} CI'] = round(float(flow_sampling.ratio_interval(service_totals, sample_rate)), digits)
+    return columns
+
+def process_data_rows(client_ip, metric_totals, sample_rate=None):
+    """將各session的累計指標平均成每個session一列
+
+    Args:
+        client_ip (int): 伺服器/主機IP
+        metric_totals (dict): (session編號, server_ip) -> 時間間隔數與各指標的累計值
+        sample_rate (float, optional): 封包抽樣比例, 小於1時加上信賴區間欄位 (CONFIDENCE_COLUMNS)
+
+    Returns:
+        [dict]: 每個session的指標, 欄位名稱與 data_training.csv 相同
+    """
+    return [{
+        'Session': format_session_key(client_ip, session),
+        **{column: round(totals[metric] / totals['count'], 4) for metric, column in WINDOW_METRICS.items()},
+        **distribution_columns(totals['sketches'], totals['jitter'], 4),
+        **{column: round(total / count, 4) if count else 0 for column, (total, count) in
+           zip(SERVICE_DELAY_COLUMNS.values(), totals['service_delays'].values())},
+        **(sampled_columns(totals, sample_rate, 4) if is_sampled(sample_rate) else {}), # 抽樣時取代 Average RTT/Req Resp Delay
+    } for session, totals in metric_totals.items()]
+
+def save_data_rows(session_rows, output_file):
     with open(output_file, mode='r', newline='') as file:
         reader = csv.reader(file)
         existing_headers = next(reader, None)
 
+    # 舊版 data_training.csv 沒有的欄位不寫入
+    missing_headers = [header for header in (session_rows[0] if session_rows else {}) if header not in existing_headers]
+    if missing_headers:
+        logging.warning(f"{output_file} has no columns for {missing_headers}, skipping them")
+
     # Write processed data to CSV
     with open(output_file, mode='a', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=existing_headers)
+        writer = csv.DictWriter(file, fieldnames=existing_headers, extrasaction='ignore')
         
         # Append each session's data
-        for session in processed_average_rtt.keys():
-            writer.writerow({
-                'Session': session,
-                'Average RTT': round(processed_average_rtt[session], 4),
-                'Average Req Resp Delay': round(processed_average_req_resp_delay[session], 4),
-                'Average Reconnection Count': round(processed_reconnection_count[session], 4),
-                'Average Error Packets Count': round(processed_error_packets_count[session], 4)
-            })
-
-# PART 5 繪製圖表
-def plot_metrics(plot_data, title, unit):
-    plt.figure()
-    
-    cool_colors = ['blue', 'turquoise', 'teal', 'cyan', 'royalblue', 'dodgerblue', 'mediumslateblue', 'darkcyan']
-    session_color_map = {}  # A dictionary to map session numbers to colors
-    color_idx = 0
-    
-    # Sort the group names
-    sorted_groups = sorted(plot_data.keys())
-    
-    for group in sorted_groups:
-        duration_data = plot_data[group]
-        x = list(duration_data.keys())
-        y = [sum(values) / len(values) for values in duration_data.values()]  # Average if multiple values
-        
-        if "Session" in group:
-            session_number = group.split(" ")[1]  # Extract session number
-            
-            # Assign a color if not already assigned
-            if session_number not in session_color_map:
-                session_color_map[session_number] = cool_colors[color_idx]
-                color_idx = (color_idx + 1) % len(cool_colors)  # Loop back to the first color if needed
+        writer.writerows(session_rows)
+
+def save_window_rows(window_rows, output_file):
+    """每個時間間隔結束時附加該時間間隔的指標, 檔案為空時先寫入標頭
+    """
+    with open(output_file, mode='a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=WINDOW_HEADERS)
+        if file.tell() == 0:
+            writer.writeheader()
+        writer.writerows(window_rows)
+
+# 主要介面
+def ip_quota_to_int(ip_quota):
+    """輔助函式, 將 ip_quota 的IP字串轉成整數 (空的環境變數會產生空字串, 直接略過)
+    """
+    return {pcap_reader.ip_to_int(ip): quota for ip, quota in ip_quota.items() if ip}
+
+def initialize_client_state(expected_session_count, time_intervals):
+    """建立單一client跨時間間隔的分析狀態, 各解析度只保留追蹤session所需的資訊與累計指標
+
+    Args:
+        time_intervals ([int]): 要計算的時間間隔長度 -秒, 見 iter_resolution_windows
+    """
+    return {
+        'expected_session_count': expected_session_count,
+        'resolutions': {time_interval: new_resolution(expected_session_count) for time_interval in time_intervals}, # 時間間隔長度 -> 該解析度的狀態
+    }
+
+def unsampled_flow_counts(packet_counts, client_ip):
+    """輔助函式, 將各連線抽樣前的統計 (flow_sampling.pop_packet_counts) 轉成以 flow_id 為鍵
+
+    Returns:
+        dict: flow_id -> [封包數, 資料段數, 第一個frame number, 最後一個frame number, 第一個封包是否為SYN]
+    """
+    flow_counts = {}
+    for endpoints, counts in packet_counts.items():
+        for local, remote in (endpoints, endpoints[::-1]):
+            if local >> 16 == client_ip:
+                flow_counts[(local & 0xFFFF) << 48 | remote] = counts
+                break
+    return flow_counts
+
+def window_flow_metrics(packet_list, client_ip, expected_session_count, packet_counts=None, sample_rate=None):
+    """時間間隔中與session追蹤狀態無關的部分: 分組flow、合併重聯的flow、計算每個flow的通訊指標, 可以在子程序中執行
+
+    Args:
+        packet_list (np.ndarray): 時間間隔內的封包陣列
+        client_ip (int): 伺服器/主機IP
+        expected_session_count (int): 預期的session數量
+        packet_counts (dict, optional): 抽樣分析時各連線抽樣前的統計, 見 flow_sampling.pop_packet_counts
+        sample_rate (float, optional): 抽樣分析時的抽樣比例, 與 packet_counts 一起指定
+
+    Returns:
+        dict: 'flows' (flow_id -> 封包索引範圍), 'reconnect_pairs' (舊flow -> 新flow), 'metrics' (flow_id -> window_bilateral_metrics 的結果),
+              'sizes' (抽樣分析時 flow_id -> 抽樣前的封包數, 否則為 None), 沒有封包時回傳 None
+    """
+    flow_counts = None if packet_counts is None else unsampled_flow_counts(packet_counts, client_ip)
+    if len(packet_list) == 0 and not flow_counts: # 抽樣分析時即使沒有封包被抽中, 抽樣前有封包的flow仍需追蹤session
+        return None
+    
+    packets, flows, reconnect_pairs = group_window_flows(packet_list, client_ip, expected_session_count, flow_counts)
+    
+    # 分類封包 -測試        
+    # for flow_id, ranges in flows.items():
+    #     logging.info(f"{format_flow(client_ip, flow_id)}: {flow_size(ranges)} packets")
+    #     for packet in packets[ranges[0][0]:ranges[0][0] + 5]:
+    #         logging.info(f"{pcap_reader.ip_to_str(packet['src_ip'])}:{packet['src_port']} -> {pcap_reader.ip_to_str(packet['dst_ip'])}:{packet['dst_port']}")
+    #     logging.info('---')
+    
+    # 計算每個flow的通訊指標, 被追蹤的flow的指標即為對應session的指標
+    flow_ids = list(flows)
+    b_metrics_list = window_bilateral_metrics(packets, [flows[flow_id] for flow_id in flow_ids], [(client_ip, flow_id_parts(flow_id)[1]) for flow_id in flow_ids], sampled=flow_counts is not None)
+    for b_metrics, columns in zip(b_metrics_list, window_distribution_columns(b_metrics_list, 3)):
+        b_metrics['window_columns'] = columns # 分位數也一併算好
+    
+    sizes = None
+    if flow_counts is not None: # 抽樣分析: 重聯的flow與 group_window_flows 相同地合併, 抽樣前的資料段數判斷沒有樣本的時間間隔是否需要補值 (見 flow_sampling.add_window_mean)
+        for old_flow, new_flow in reconnect_pairs.items():
+            old_counts = flow_counts.pop(old_flow)
+            flow_counts[new_flow] = flow_sampling.merge_packet_counts([{0: old_counts}, {0: flow_counts[new_flow]}])[0]
+        sizes = {flow_id: counts[0] for flow_id, counts in flow_counts.items()}
+        for flow_id, b_metrics in zip(flow_ids, b_metrics_list): # 各時間間隔的指標改為以抽樣比例還原的估計
+            b_metrics['candidates'], b_metrics['sample_rate'] = flow_counts[flow_id][1], sample_rate
+            b_metrics['avg_rtt'] = round(float(flow_sampling.ratio_estimate(b_metrics['unit_totals']['RTT'], sample_rate)), 3)
+            b_metrics['avd_req_resp_delay'] = round(float(flow_sampling.ratio_estimate(b_metrics['unit_totals']['Req Resp Delay'], sample_rate)), 3)
+            b_metrics['error_estimate'] = round(float(flow_sampling.total_estimate(b_metrics['unit_totals']['Error Packets Count'], sample_rate)), 3)
+    return {'flows': flows, 'reconnect_pairs': reconnect_pairs, 'metrics': dict(zip(flow_ids, b_metrics_list)), 'sizes': sizes}
+
+def track_window_sessions(window_flows, client_ip, ip_quota, state):
+    """依時間順序更新session追蹤狀態, 將 window_flow_metrics 中被追蹤的flow指標對應到session
+
+    Args:
+        window_flows (dict): window_flow_metrics 的結果
+        client_ip (int): 伺服器/主機IP
+        ip_quota (dict): server_ip (int) -> session中該ip可以分配到的數量, 見 ip_quota_to_int
+        state (dict): 單一解析度的session追蹤狀態 (見 new_resolution), 會直接更新
+
+    Returns:
+        dict: (session編號, server_ip) -> window_bilateral_metrics 的結果
+    """
+    if window_flows is None: # 沒有封包的時間間隔, 不更新session追蹤狀態, 以免被當成所有session斷線
+        logging.info('No packets in this time interval')
+        return {}
+    
+    record_reconnections(window_flows['reconnect_pairs'], state['flow_table'], client_ip)
+    sessions = session_tracking(window_flows['flows'], state['session_track'], window_flows['reconnect_pairs'], state['flow_table'], ip_quota, client_ip, window_flows['sizes'])
+    session_flows = align_sessions(state['history_session_keys'], transform_keys(sessions)) # 第一個時間間隔沒有歷史紀錄, 不會改變
+    state['history_session_keys'] = list(session_flows.keys())
+    
+    # 計算雙向通訊指標 -測試
+    # for key, flow_id in session_flows.items():
+    #     b_metrics = window_flows['metrics'][flow_id]
+    #     logging.info(f'{format_session_key(client_ip, key)}')
+    #     logging.info(f'RTT: {b_metrics["avg_rtt"]}, Request-Response Delay: {b_metrics["avd_req_resp_delay"]}, Reconnection_count: {len(b_metrics["h_messages"])}, Error_count: {len(b_metrics["e_messages"])}')
+    #     logging.info('---')
+    
+    return {key: window_flows['metrics'][flow_id] for key, flow_id in session_flows.items()}
+
+def analyze_window(packet_list, client_ip, ip_quota, state, time_interval=None):
+    """分類單一時間間隔內某個client的封包, 並計算各session的通訊指標
+
+    Args:
+        packet_list (np.ndarray): 時間間隔內的封包陣列
+        client_ip (int): 伺服器/主機IP
+        ip_quota (dict): server_ip (int) -> session中該ip可以分配到的數量, 見 ip_quota_to_int
+        state (dict): initialize_client_state 建立的分析狀態, 會直接更新
+        time_interval (int, optional): 時間間隔長度 (解析度), 預設為最短者
+
+    Returns:
+        dict: (session編號, server_ip) -> window_bilateral_metrics 的結果
+    """
+    resolution = state['resolutions'][time_interval or min(state['resolutions'])]
+    return track_window_sessions(window_flow_metrics(packet_list, client_ip, state['expected_session_count']), client_ip, ip_quota, resolution)
+
+# 時間片段平行分析: 主程序只走訪封包紀錄與TCP標頭並依時間切成片段, 子程序自行解碼片段內的封包並計算各解析度的 window_flow_metrics,
+# 主程序再依時間順序追蹤session並合併結果; 追蹤狀態只在主程序更新, 因此結果與依序分析相同
+# 片段開始時的TCP分析狀態 (尚未確認的資料段等) 與尚未結束的多chunk message 由主程序只解標頭推進 (見 pcap_reader.advance_tcp_state), 不論相隔多久都與依序解碼相同
+# 已有解碼快取時不再解碼, 快取直接載入 shared memory 交給子程序 (見 shared_packets), 只傳遞 descriptor 與範圍
+SHARD_WINDOWS = 16 # 每個時間片段的時間間隔數
+
+def shard_duration(time_intervals):
+    """輔助函式, 時間片段長度: 至少 SHARD_WINDOWS 個基本時間間隔, 並進位到各時間間隔長度的公倍數, 每個解析度的時間間隔都完整落在一個片段中
+    """
+    step = math.lcm(*time_intervals)
+    return math.ceil(SHARD_WINDOWS * time_intervals[0] / step) * step
+
+def analyze_windows(windows, clients, time_intervals, sampling=None):
+    """依序分析基本時間間隔, 以及由它組成的各解析度時間間隔 (見 iter_resolution_windows)
+
+    Args:
+        windows (iterable): 依序、連續的 (基本時間間隔編號, 封包陣列)
+        clients (dict): client_ip -> (client_ip 整數, 預期的session數量)
+        time_intervals ([int]): 由短到長的時間間隔長度 -秒
+        sampling (dict, optional): 解碼這些封包時的抽樣狀態 (flow_sampling.new_sampling), 取出各時間間隔抽樣前的封包數
+
+    Yields:
+        (int, int, dict): (時間間隔長度, 時間間隔編號, client_ip -> window_flow_metrics 的結果)
+    """
+    for time_interval, number, packet_list, packet_counts in iter_resolution_windows(windows, time_intervals, sampling):
+        sample_rate = None if sampling is None else sampling['sample_rate']
+        yield time_interval, number, {client_ip: window_flow_metrics(packet_list, client_int, expected_session_count, packet_counts, sample_rate)
+                                      for client_ip, (client_int, expected_session_count) in clients.items()}
+
+def convert_sketches(shard_results, convert):
+    """輔助函式, 以 convert (latency_sketch.compact/expand) 轉換時間片段結果中的所有 sketch (直接更新)
+
+    大部分的桶都是0, 子程序只回傳非0的桶, 主程序收到後再還原
+    """
+    for _, _, window_flows in shard_results:
+        for flows in window_flows.values():
+            for b_metrics in (flows or {}).get('metrics', {}).values():
+                b_metrics['sketches'] = {metric: convert(sketch) for metric, sketch in b_metrics['sketches'].items()}
+    return shard_results
+
+def analyze_capture_shard(capture_file, records, tcp_state, open_messages, packet_filter, time_intervals, grid_origin, clients):
+    """子程序執行的時間片段分析: 自行從擷取檔解碼片段內的封包, 再依各解析度的時間間隔計算 window_flow_metrics
+
+    Args:
+        records (np.ndarray): 片段內的封包紀錄 (pcap_reader.RECORD_DTYPE)
+        tcp_state (dict): 片段開始時片段中各flow的TCP分析狀態, 見 pcap_reader.new_tcp_state
+        open_messages (set): 片段開始時尚未結束的多chunk message, 見 pcap_reader.decode_opcua_fields
+        packet_filter (dict): pcap_reader.new_packet_filter 的篩選條件, 抽樣狀態為片段開始時的狀態
+        time_intervals ([int]): 由短到長的時間間隔長度 -秒
+        grid_origin (float): 時間間隔格線的起點
+        clients (dict): 見 analyze_windows
+
+    Returns:
+        [(int, int, dict)]: analyze_windows 的結果, sketch 為 latency_sketch.compact 的形式
+        int, int: 片段內被略過的frame數與沒有被抽中的封包數
+    """
+    with pcap_reader.map_capture(capture_file) as data:
+        packets = pcap_reader.decode_records(data, records, int(records['number'][0]), packet_filter, open_messages)
+    pcap_reader.annotate_tcp_analysis(packets, tcp_state)
+    
+    shard_results = list(analyze_windows(iter_time_windows([packets], time_intervals[0], grid_origin), clients, time_intervals, packet_filter['sampling']))
+    return convert_sketches(shard_results, latency_sketch.compact), packet_filter['background'], packet_filter['unsampled']
+
+def iter_record_shards(data, time_intervals, grid_origin, packet_filter):
+    """主程序依時間將封包紀錄切成時間片段, 並只解標頭推進TCP分析、多chunk message 與抽樣的狀態 (見 pcap_reader.advance_tcp_state)
+
+    Yields:
+        (np.ndarray, dict, set, dict): 片段內的封包紀錄, 以及片段開始時片段中各flow (含反向flow) 的TCP分析狀態 (pcap_reader.new_tcp_state)、
+            尚未結束的多chunk message、抽樣狀態 (沒有抽樣時為 None)
+    """
+    duration = shard_duration(time_intervals)
+    tcp_state, open_messages = pcap_reader.new_tcp_state(), set()
+    record_arrays = pcap_reader.iter_record_arrays(data)
+    try:
+        for _, records in iter_time_windows(record_arrays, duration, grid_origin):
+            if len(records) == 0:
+                continue
+            # 片段開始時的狀態; unacked 中的 deque 只會被換掉, 不會被修改, 複製 dict 即可
+            start_max, start_unacked, start_messages = dict(tcp_state['max_next_seq']), dict(tcp_state['unacked']), set(open_messages)
+            start_sampling = flow_sampling.carry_over(packet_filter['sampling'])
             
-            plt.plot(x, y, label=group, linewidth=1.5, linestyle='-', marker='o', color=session_color_map[session_number])
-        else:
-            plt.plot(x, y, label=group, linewidth=1, linestyle='--', color='gray')
+            flows = pcap_reader.advance_tcp_state(data, records, tcp_state, packet_filter, open_messages)
+            flows += [(dst, src) for src, dst in flows if (dst, src) in tcp_state['bases']] # 反向flow決定相對ack, 其資料段由片段中的ACK確認
+            start_state = pcap_reader.new_tcp_state({flow: tcp_state['bases'][flow] for flow in flows},
+                                                    {flow: start_max[flow] for flow in flows if flow in start_max},
+                                                    {flow: start_unacked[flow] for flow in flows if flow in start_unacked})
+            yield records, start_state, start_messages, start_sampling
+    finally:
+        record_arrays.close() # 先釋放對 mmap 的參考, mmap 才能關閉
+
+def capture_shard_tasks(capture_file, time_intervals, grid_origin, packet_filter, clients):
+    """依時間順序產生由子程序自行解碼的時間片段 (analyze_capture_shard), 子程序只收到封包紀錄位置 (不含封包內容)
+
+    Yields:
+        tuple: (子程序函式, 參數...), 見 iter_shard_results
+    """
+    shard_filter = pcap_reader.restart_filter(packet_filter) # 子程序的計數從0開始, 抽樣狀態為各片段開始時的狀態
+    with pcap_reader.map_capture(capture_file) as data:
+        record_shards = iter_record_shards(data, time_intervals, grid_origin, packet_filter)
+        try:
+            for records, tcp_state, open_messages, sampling in record_shards:
+                yield (analyze_capture_shard, capture_file, records, tcp_state, open_messages, dict(shard_filter, sampling=sampling),
+                       time_intervals, grid_origin, clients)
+        finally:
+            record_shards.close() # 先釋放對 mmap 的參考, mmap 才能關閉
+
+def window_ranges(packets, time_interval, grid_origin):
+    """輔助函式, 各時間間隔在封包陣列中的範圍
+
+    Returns:
+        [(int, int, int)]: (時間間隔編號, 起點, 終點)
+    """
+    ranges = []
+    start = 0
+    for number, packet_list in iter_time_windows([packets], time_interval, grid_origin):
+        ranges.append((number, start, start + len(packet_list)))
+        start += len(packet_list)
+    return ranges
+
+def analyze_shared_shard(descriptor, shard_ranges, clients, time_intervals):
+    """子程序執行的時間片段分析, 封包直接從 shared memory 讀取
+
+    Args:
+        descriptor (dict): shared_packets.create_packets 的 descriptor
+        shard_ranges ([(int, int, int)]): 片段內各基本時間間隔的 (時間間隔編號, 起點, 終點)
+        clients (dict): 見 analyze_windows
+        time_intervals ([int]): 由短到長的時間間隔長度 -秒
+
+    Returns:
+        見 analyze_capture_shard, 快取已記錄略過的frame數 (快取不用於抽樣分析), 因此都為0
+    """
+    def analyze(packets):
+        return list(analyze_windows([(number, packets[start:end]) for number, start, end in shard_ranges], clients, time_intervals))
     
-    plt.title(title)
-    plt.xlabel('Capture Duration')
-    plt.ylabel(unit)
-    plt.legend()
-    plt.show()
+    shard_results = shared_packets.apply_to_packets(descriptor, analyze)
+    return convert_sketches(shard_results, latency_sketch.compact), 0, 0
 
-# 主程式
-def main(client_ip, expected_session_count, ip_quota, capture_file, output_file, time_interval):
+def iter_shard_results(shard_tasks, packet_filter, clients, workers):
+    """將時間片段交給 process pool 分析, 各解析度依時間順序回傳每個時間間隔的結果, 同時最多只有 2*workers 個片段在處理中
+
+    沒有封包的時間間隔結果為 None, 與依序分析相同
+
+    Args:
+        shard_tasks (iterable): 依時間順序的 (子程序函式, 參數...), 函式回傳值見 analyze_capture_shard
+        packet_filter (dict): 累計子程序略過的frame數與沒有被抽中的封包數
+        clients (dict): 見 analyze_windows
+
+    Yields:
+        (int, int, dict): (時間間隔長度, 時間間隔編號, client_ip -> window_flow_metrics 的結果)
+    """
+    def shard_results(future):
+        results, background, unsampled = future.result()
+        packet_filter['background'] += background
+        packet_filter['unsampled'] += unsampled
+        return convert_sketches(results, latency_sketch.expand)
     
-    capture_duration = 0 # 擷取封包的時間長度
-    session_track ={f'Session {i+1}': 'NONE' for i in range(expected_session_count)}
-    session_key_history = {}
+    def fill_windows(results):
+        for time_interval, number, window_flows in results:
+            if time_interval in next_numbers:
+                for empty_number in range(next_numbers[time_interval], number): # 跨片段的空白時間間隔
+                    yield time_interval, empty_number, {client_ip: None for client_ip in clients}
+            yield time_interval, number, window_flows
+            next_numbers[time_interval] = number + 1
     
-    # u_metrics_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(dict))) # 單向通訊指標
+    next_numbers = {} # 時間間隔長度 -> 下一個時間間隔編號
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for function, *args in shard_tasks:
+                pending.append(executor.submit(function, *args))
+                while len(pending) > 2 * workers:
+                    yield from fill_windows(shard_results(pending.popleft()))
+            while pending:
+                yield from fill_windows(shard_results(pending.popleft()))
+        finally:
+            for future in pending: # 提前結束時不再等待尚未開始的片段
+                future.cancel()
+
+def iter_capture_shard_results(capture_file, time_intervals, grid_origin, packet_filter, clients, workers, cache_file=None):
+    """以時間片段平行分析擷取檔, 見 iter_shard_results
+
+    有快取 (cache_file) 時直接載入一塊 shared memory, 子程序只收到 descriptor 與各基本時間間隔的範圍;
+    否則子程序各自從擷取檔解碼時間片段 (不寫入快取)
+    """
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            shm, descriptor = shared_packets.load_cache(cache_file, packet_filter)
+        except (OSError, ValueError, KeyError): # 快取損毀或欄位不符, 改由子程序解碼
+            pass
+        else:
+            try:
+                ranges = shared_packets.apply_to_packets(descriptor, window_ranges, time_intervals[0], grid_origin)
+                duration = shard_duration(time_intervals)
+                shard_tasks = ((analyze_shared_shard, descriptor, list(shard_ranges), clients, time_intervals)
+                               for _, shard_ranges in itertools.groupby(ranges, key=lambda window: window[0] * time_intervals[0] // duration))
+                yield from iter_shard_results(shard_tasks, packet_filter, clients, workers)
+            finally:
+                shared_packets.release(shm) # process pool 已結束, 子程序都不再使用
+            return
     
-    # request_data_load = defaultdict(lambda: defaultdict(float))
-    # request_data_throughput = defaultdict(lambda: defaultdict(float))
-    # request_data_frequency = defaultdict(lambda: defaultdict(float))
+    yield from iter_shard_results(capture_shard_tasks(capture_file, time_intervals, grid_origin, packet_filter, clients),
+                                  packet_filter, clients, workers)
+
+def iter_window_rows(capture_file, clients, time_intervals, states, cache_dir=None, use_cache=True, streaming=False, grid_origin=None, workers=None, sample_rate=None):
+    """依時間順序分析各解析度的時間間隔 (見 iter_resolution_windows), 在時間間隔結束時回傳各client的指標, 封包陣列隨即釋放
+
+    Args:
+        clients (dict): client_ip -> ip_quota (session中每個ip可以分配到的數量)
+        time_intervals ([int]): 由短到長的時間間隔長度 -秒, 都必須是最短者的倍數
+        states (dict): client_ip -> initialize_client_state 建立的分析狀態, 會直接更新
+        grid_origin (float, optional): 時間間隔格線的起點 (epoch 秒), 預設為擷取檔第一個frame的時間
+        workers (int, optional): 大於1時以時間片段平行分析, 見 iter_capture_shard_results
+        sample_rate (float, optional): 小於1時解碼前只保留抽樣的封包 (見 flow_sampling.sampling_mask), 不使用快取
+
+    Yields:
+        dict: client_ip -> {time_interval: 剛結束的時間間隔各session的指標}
+    """
+    base_interval = min(time_intervals)
+    if grid_origin is None:
+        grid_origin = pcap_reader.capture_start_time(capture_file)
     
-    # response_data_load = defaultdict(lambda: defaultdict(float))
-    # response_data_throughput = defaultdict(lambda: defaultdict(float))
-    # response_data_frequency = defaultdict(lambda: defaultdict(float))
+    # IP只在這裡轉成整數一次, 之後的分類與追蹤都以整數比對
+    client_keys = {client_ip: (pcap_reader.ip_to_int(client_ip), ip_quota_to_int(ip_quota)) for client_ip, ip_quota in clients.items()}
+    shard_clients = {client_ip: (client_int, states[client_ip]['expected_session_count']) for client_ip, (client_int, _) in client_keys.items()}
     
-    b_metrics_dict = defaultdict(lambda: defaultdict(lambda: defaultdict(dict))) # 雙向通訊指標
+    # 解碼前只保留與任一client有關的 OPC UA (TCP 4840) 封包, 其他frame只計數; 抽樣分析時其中沒有被抽中的封包也只計數
+    sampling = flow_sampling.new_sampling(sample_rate, base_interval, grid_origin, pcap_reader.OPC_PORT) if is_sampled(sample_rate) else None
+    packet_filter = pcap_reader.new_packet_filter([client_int for client_int, _ in client_keys.values()], pcap_reader.OPC_PORT, sampling)
     
-    average_rtt = defaultdict(lambda: defaultdict(float))
-    average_req_resp_delay = defaultdict(lambda: defaultdict(float))
-    reconnection_count = defaultdict(lambda: defaultdict(float))
-    error_packets_count = defaultdict(lambda: defaultdict(float))
+    if workers and workers > 1: # 子程序讀取 shared memory 中的快取, 或各自解碼時間片段
+        cache_file = pcap_reader.cache_path(capture_file, cache_dir, packet_filter) if use_cache and not streaming and sampling is None else None
+        window_results = iter_capture_shard_results(capture_file, time_intervals, grid_origin, packet_filter, shard_clients, workers, cache_file)
+    else: # 批次讀取封包
+        windows = read_pcapng_file(capture_file, base_interval, cache_dir, use_cache, streaming, grid_origin, packet_filter)
+        window_results = analyze_windows(windows, shard_clients, time_intervals, sampling)
     
-    # 批次讀取封包
-    packet_lists = read_pcapng_file(capture_file)
-    history_classified_packets = {}
-    for packet_list in packet_lists:
-        
-        logging.info(f'Processed Time Interval: {capture_duration} seconds')
-        
-        # 讀取封包 -測試
-        # logging.info(f'New Time Interval: Packets={len(packet_list)}')
-        # for packet in packet_list:
-        #     logging.debug(f'Packet Sniff Time: {packet.sniff_time}')
-        #     logging.debug(f'Packet Length: {len(packet)} bytes')
-        # logging.info('---')
-        
-        # 分類封包
-        classified_packets = classify_packets(packet_list, client_ip, expected_session_count, ip_quota, session_track, session_key_history)
-        classified_packets = transform_keys(classified_packets)
-        if capture_duration != 0:
-            classified_packets = align_sessions(history_classified_packets, classified_packets)
-        history_classified_packets = classified_packets
-        
-        # 分類封包 -測試        
-        # for key, value in classified_packets.items():
-        #     if key != 'background':
-        #         for sub_key, sub_value in value.items():
-        #             logging.info(f"For Client IP: {key}, Client Port: {sub_key}")
-        #             for i, packet in enumerate(sub_value[:5]):
-        #                 logging.info(f'{packet.ip.src}:{packet[packet.transport_layer].srcport} -> {packet.ip.dst}:{packet[packet.transport_layer].dstport}')
-        #     logging.info('---')
-        
-        # 計算通訊指標
-        for key, value in classified_packets.items(): # key為client_ip-client_port, value為[packet1, packet2, ...]
-            
-            # u_metrics = unilateral_metrics(value, client_ip)
-            b_metrics = bilateral_metrics(value, (key.split(': ')[1]).split(':')[0])
-            
-            # 計算單向通訊指標 -測試
-            # logging.info(f'Client IP: {key.split('-')[0]}, Client Port: {key.split('-')[1]}')
-            # logging.info(f'Request: {u_metrics["request"]}')
-            # logging.info(f'Response: {u_metrics["response"]}')
-            # logging.info('---')
-                    
-            # 計算雙向通訊指標 -測試
-            # logging.info(f'Client IP: {key.split('-')[0]}, Client Port: {key.split('-')[1]}')
-            # logging.info(f'RTT: {b_metrics["avg_rtt"]}, Request-Response Delay: {b_metrics["avd_req_resp_delay"]}, Reconnection_count: {len(b_metrics["h_messages"])}, Error_count: {len(b_metrics["e_messages"])}')
-            # logging.info('---')
-            
-            # u_metrics_dict[capture_duration][key] = u_metrics
-            b_metrics_dict[capture_duration][key] = b_metrics
-            
-            # request_data_load[key][capture_duration] = u_metrics['request']['avg_load']
-            # request_data_throughput[key][capture_duration]= u_metrics['request']['avg_throughput']
-            # request_data_frequency[key][capture_duration]= u_metrics['request']['avg_frequency']
-                    
-            # response_data_load[key][capture_duration] = u_metrics['response']['avg_load']
-            # response_data_throughput[key][capture_duration] = u_metrics['response']['avg_throughput']
-            # response_data_frequency[key][capture_duration] = u_metrics['response']['avg_frequency']
-                    
-            average_rtt[key][capture_duration] = b_metrics['avg_rtt']
-            average_req_resp_delay[key][capture_duration] = b_metrics['avd_req_resp_delay']
-            reconnection_count[key][capture_duration] = len(b_metrics['h_messages'])
-            error_packets_count[key][capture_duration] = len(b_metrics['e_messages'])
+    for time_interval, number, window_flows in window_results:
+        logging.info(f'Processed Time Interval: {number * time_interval} seconds ({time_interval}s)') # 時間間隔的起點, 同一個 grid_origin 的擷取檔之間可以互相對照
         
-        capture_duration += time_interval
+        window_rows = {}
+        for client_ip, (client_int, ip_quota) in client_keys.items():
+            resolution = states[client_ip]['resolutions'][time_interval]
+            window_metrics = track_window_sessions(window_flows[client_ip], client_int, ip_quota, resolution)
+            window_rows[client_ip] = {time_interval: resolution_window_rows(client_int, time_interval, number, resolution, window_metrics)}
+        yield window_rows
         logging.info('')
-        
-    # 繪製圖表        
-    # plot_metrics(request_data_load, 'Request Average Load', 'bytes/s')
-    # plot_metrics(request_data_throughput, 'Request Average Throughput', 'bytes/s')
-    # plot_metrics(request_data_frequency, 'Request Average Frequency', 'packets/s')
     
-    # plot_metrics(response_data_load, 'Response Average Load', 'bytes/s')
-    # plot_metrics(response_data_throughput, 'Response Average Throughput', 'bytes/s')
-    # plot_metrics(response_data_frequency, 'Response Average Frequency', 'packets/s')
+    logging.info(f"{capture_file}: skipped {packet_filter['background']} background frames" + (f", {packet_filter['unsampled']} unsampled packets" if sampling else ''))
+
+def analyze_capture_resolutions(capture_file, clients, time_intervals, expected_session_counts=None, cache_dir=None, use_cache=True, streaming=False, window_output_file=None, grid_origin=None, workers=None, sample_rate=None):
+    """只解碼、分類一次擷取檔, 同時分析多個client在多個時間間隔長度下的所有session
+
+    各時間間隔長度各自分組flow、追蹤session, 結果與分別只計算一個時間間隔長度時相同 (見 iter_resolution_windows)
+
+    Args:
+        capture_file (str): 擷取封包檔案路徑
+        clients (dict): client_ip -> ip_quota (session中每個ip可以分配到的數量)
+        time_intervals ([int]): 數據平均的時間間隔 -秒, 都必須是最短者的倍數
+        expected_session_counts (dict, optional): client_ip -> 同時處理的session數量, 預設為各 ip_quota 的總和
+        cache_dir (str, optional): 解碼結果的快取資料夾, 預設為擷取檔旁的 .capture_cache
+        use_cache (bool): 是否使用解碼結果快取
+        streaming (bool): 逐段解碼擷取檔, 記憶體用量固定, 適合長時間的擷取檔
+        window_output_file (str, optional): 最短的時間間隔結束時將各session的指標附加到此csv
+        grid_origin (float, optional): 時間間隔格線的起點 (epoch 秒), 同一個scenario的各擷取檔使用相同值即可對齊時間間隔
+        workers (int, optional): 單一擷取檔的平行分析process數量, 大於1時以時間片段平行分析, 結果與依序分析相同
+        sample_rate (float, optional): 封包抽樣比例 (0~1), 小於1時只分析以雜湊選出的Request-Response配對與segment, 並輸出信賴區間欄位
+
+    Returns:
+        dict: time_interval -> client_ip -> 每個session的指標, 欄位名稱與 data_training.csv 相同
+    """
+    time_intervals = sorted(set(int(time_interval) for time_interval in time_intervals))
+    if any(time_interval % time_intervals[0] for time_interval in time_intervals):
+        raise ValueError(f'Time intervals {time_intervals} must be multiples of {time_intervals[0]}')
     
-    # plot_metrics(average_rtt, 'Average RTT', 'ms')
-    # plot_metrics(average_req_resp_delay, 'Average Request-Response Delay', 'ms')
-    # plot_metrics(reconnection_count, 'Reconnection Count', 'packets')
-    # plot_metrics(error_packets_count, 'Error Packets Count', 'packets')
+    expected_session_counts = expected_session_counts or {}
+    states = {
+        client_ip: initialize_client_state(expected_session_counts.get(client_ip, sum(ip_quota.values())), time_intervals)
+        for client_ip, ip_quota in clients.items()
+    }
     
-    process_and_save_data(average_rtt, average_req_resp_delay, reconnection_count, error_packets_count, output_file)
+    for window_rows in iter_window_rows(capture_file, clients, time_intervals, states, cache_dir, use_cache, streaming, grid_origin, workers, sample_rate):
+        if window_output_file:
+            save_window_rows([row for rows in window_rows.values() for row in rows.get(time_intervals[0], [])], window_output_file)
+        
+    return {
+        time_interval: {
+            client_ip: process_data_rows(pcap_reader.ip_to_int(client_ip), state['resolutions'][time_interval]['metric_totals'], sample_rate)
+            for client_ip, state in states.items()
+        } for time_interval in time_intervals
+    }
+
+def analyze_capture_clients(capture_file, clients, time_interval, expected_session_counts=None, cache_dir=None, use_cache=True, streaming=False, window_output_file=None, grid_origin=None, workers=None, sample_rate=None):
+    """只解碼一次擷取檔, 同時分析多個client的所有session
+
+    Args:
+        time_interval (int): 數據平均的時間間隔 -秒
+        其餘參數見 analyze_capture_resolutions
+
+    Returns:
+        dict: client_ip -> 每個session的指標, 欄位名稱與 data_training.csv 相同
+    """
+    return analyze_capture_resolutions(capture_file, clients, [time_interval], expected_session_counts, cache_dir, use_cache, streaming, window_output_file, grid_origin, workers, sample_rate)[int(time_interval)]
+
+def analyze_capture(capture_file, client_ip, ip_quota, time_interval, expected_session_count=None, cache_dir=None, use_cache=True, streaming=False, window_output_file=None, grid_origin=None, workers=None, sample_rate=None):
+    """分析單一擷取檔中某個client的所有session
+
+    Args:
+        capture_file (str): 擷取封包檔案路徑
+        client_ip (str): 伺服器/主機IP
+        ip_quota (dict): session中每個ip可以分配到的數量
+        time_interval (int): 數據平均的時間間隔 -秒
+        expected_session_count (int, optional): 伺服器/主機同時處理的session數量, 預設為 ip_quota 的總和
+        cache_dir (str, optional): 解碼結果的快取資料夾, 預設為擷取檔旁的 .capture_cache
+        use_cache (bool): 是否使用解碼結果快取
+        streaming (bool): 逐段解碼擷取檔, 記憶體用量固定, 適合長時間的擷取檔
+        window_output_file (str, optional): 每個時間間隔結束時將各session的指標附加到此csv
+        grid_origin (float, optional): 時間間隔格線的起點 (epoch 秒), 同一個scenario的各擷取檔使用相同值即可對齊時間間隔
+        workers (int, optional): 大於1時以時間片段平行分析, 結果與依序分析相同
+        sample_rate (float, optional): 封包抽樣比例 (0~1), 小於1時加上信賴區間欄位
+
+    Returns:
+        [dict]: 每個session的指標, 欄位名稱與 data_training.csv 相同
+    """
+    expected_session_counts = None if expected_session_count is None else {client_ip: expected_session_count}
+    return analyze_capture_clients(capture_file, {client_ip: ip_quota}, time_interval, expected_session_counts, cache_dir, use_cache, streaming, window_output_file, grid_origin, workers, sample_rate)[client_ip]
+
+# 主程式
+def main(client_ip, expected_session_count, ip_quota, capture_file, output_file, time_interval, window_output_file=None, workers=None, sample_rate=None):
+    # 有指定 window_output_file 時以串流方式分析, 適合長時間的擷取檔
+    session_rows = analyze_capture(capture_file, client_ip, ip_quota, time_interval, expected_session_count,
+                                   streaming=window_output_file is not None, window_output_file=window_output_file, workers=workers, sample_rate=sample_rate)
+    save_data_rows(session_rows, output_file)
     
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -663,8 +1334,11 @@ if __name__ == "__main__":
     capture_file = sys.argv[4] # 擷取封包檔案路徑
     output_file = sys.argv[5] # 輸出csv檔案路徑
     time_interval = int(sys.argv[6]) # 數據平均的時間間隔 -秒
+    window_output_file = sys.argv[7] if len(sys.argv) > 7 and sys.argv[7] else None # (選填) 各時間間隔指標的輸出csv, 指定時以串流方式分析, 空字串代表不輸出
+    workers = int(sys.argv[8]) if len(sys.argv) > 8 and sys.argv[8] else None # (選填) 平行分析的process數量, 適合單一長時間的擷取檔, 空字串代表依序分析
+    sample_rate = float(sys.argv[9]) if len(sys.argv) > 9 and sys.argv[9] else None # (選填) 封包抽樣比例 (0~1), 輸出會多出信賴區間欄位, 空字串代表不抽樣
     
-    main(client_ip, int(expected_session_count), ip_quota, capture_file, output_file, time_interval)
+    main(client_ip, int(expected_session_count), ip_quota, capture_file, output_file, time_interval, window_output_file, workers, sample_rate)
     
     # 測試組-1
     # client_ip = '10.0.0.220'
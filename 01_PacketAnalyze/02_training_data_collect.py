@@ -1,14 +1,19 @@
 import os
+import copy
 import re
+import sys
 import csv
-import time
 import glob
-import json
 import logging
-import subprocess
+import importlib
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from pathlib import Path
 
+# 檔名以數字開頭，無法直接 import
+opc_traffic_analyze = importlib.import_module('01_opc_traffic_analyze')
+import pcap_reader
+
 # Precompiled Regular Expressions
 comp_pattern = re.compile(r'comp\d+')
 env_var_pattern = re.compile(r'"([^"]+)":\s*"([^"]+)"')
@@ -61,8 +66,9 @@ def process_scenario_folder(folder):
     return {}
 
 # PART2: 依序進行封包解析，並補上封包的拓樸條件
-def initialize_training_data(csv_file_path):
-    headers = ['Scenario', 'Computer', 'Application', 'Device', 'Subscription Order', 'Weight', 'Session', 'Average RTT', 'Average Req Resp Delay', 'Average Reconnection Count', 'Average Error Packets Count']
+def initialize_training_data(csv_file_path, sample_rate=None):
+    # 抽樣分析時多出各指標的信賴區間欄位
+    headers = ['Scenario', 'Computer', 'Application', 'Device', 'Subscription Order', 'Weight', 'Session', *opc_traffic_analyze.training_metric_columns(sample_rate)]
     with open(csv_file_path, 'a', newline='') as csvfile:
         writer = csv.writer(csvfile)
         if csvfile.tell() == 0:  # File is empty, write headers
@@ -102,101 +108,209 @@ def find_subscription_order(subscription_file, device, app_comp):
                 return row[0], row[3]
     return None
 
-def update_data_training(output_file, scenario, comp, app, device, subscription_order, weight, start_index):
-    # Read the CSV file and store rows in a list
+def load_application_names(applications_file):
+    """輔助函式, 取得 app 名稱縮寫 (例如 js) 與 app 編號 (例如 app2) 的對應
+    """
+    applications_data = pd.read_csv(applications_file)
+    initials = applications_data['name'].apply(lambda x: ''.join(word[0].lower() for word in x.split()))
+    return dict(zip(initials, applications_data['application']))
+
+def append_training_rows(output_file, training_rows):
+    """一次將整個scenario的訓練資料附加到 data_training.csv 後方
+    """
     with open(output_file, 'r', newline='') as file:
-        reader = csv.DictReader(file)
-        rows = list(reader)
-        headers = reader.fieldnames
-
-    # Update the specific row
-    if start_index < len(rows):
-        rows[start_index].update({
-            'Scenario': scenario,
-            'Computer': comp,
-            'Application': app,
-            'Device': device,
-            'Subscription Order': subscription_order,
-            'Weight': weight
-        })
-        start_index += 1  # Increment the start_index for the next call
-
-    # Write the updated rows back to the file
-    with open(output_file, 'w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=headers)
-        writer.writeheader()
-        writer.writerows(rows)
+        headers = next(csv.reader(file), None)
+
+    # 舊版 data_training.csv 沒有的欄位 (例如各 service 的延遲、延遲分佈) 不寫入
+    missing_headers = [header for header in (training_rows[0] if training_rows else {}) if header not in headers]
+    if missing_headers:
+        logging.warning(f"{output_file} has no columns for {missing_headers}, skipping them")
+
+    with open(output_file, 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=headers, extrasaction='ignore')
+        writer.writerows(training_rows)
+
+def prepare_comp_analysis(folder, comp, env_vars, context_adding_containers):
+    """輔助函式, 取得某個comp的封包分析參數
+
+    Returns:
+        dict: analyze_capture 的參數, 該comp沒有擷取封包時回傳 None
+    """
+    capture_file = next(Path(folder).glob(f'{comp}.pcap'), None)
+    if capture_file is None: # 該comp沒有擷取封包
+        logging.info(f"No capture file for {comp} in {folder}")
+        return None
+
+    client_ip_line = next((line for line in context_adding_containers if comp in line), None)
+    client_ip = re.search(r'ip=\'(\d+\.\d+\.\d+\.\d+)\'', client_ip_line).group(1) if client_ip_line else None
+    
+    # 取得預估連線術語dev連線數配額
+    expected_session_count = sum(len(val.split(',')) for val in env_vars.values()) if env_vars else 0
+    ip_quota = count_ip_quota(env_vars)
+    
+    return {'capture_file': str(capture_file), 'client_ip': client_ip, 'ip_quota': ip_quota, 'expected_session_count': expected_session_count}
+
+def collect_analysis_tasks(folder, result_dicts, time_intervals):
+    """列出某個scenario中每個comp的封包分析工作, 各comp的時間間隔對齊同一條格線 (scenario中最早的封包時間)
+
+    Args:
+        time_intervals ([str]): 數據平均的時間間隔 -秒
+
+    Returns:
+        [(str, str, dict)]: (scenario, comp, prepare_comp_analysis 的參數加上 time_intervals, grid_origin)
+    """
+    container_file = Path(folder) / 'containernet_script.py'
+    if not container_file.exists():
+        return []
+    
+    context_adding_containers = extract_context(container_file, 'Adding docker containers as hosts', '#')
+    tasks = []
+    for comp, env_vars in result_dicts[Path(folder).name].items():
+        analysis_args = prepare_comp_analysis(folder, comp, env_vars, context_adding_containers)
+        if analysis_args:
+            tasks.append((Path(folder).name, comp, dict(analysis_args, time_intervals=[int(time_interval) for time_interval in time_intervals])))
+    
+    start_times = [pcap_reader.capture_start_time(analysis_args['capture_file']) for _, _, analysis_args in tasks]
+    start_times = [start_time for start_time in start_times if start_time is not None]
+    for _, _, analysis_args in tasks:
+        analysis_args['grid_origin'] = min(start_times) if start_times else None
+    
+    return tasks
+
+def run_analysis_task(task):
+    """子程序執行的封包分析工作
+    """
+    scenario, comp, analysis_args = task
+    logging.info(f"Analyzing {scenario} {comp}")
+    client_ip = analysis_args['client_ip']
+    results = opc_traffic_analyze.analyze_capture_resolutions(
+        analysis_args['capture_file'], {client_ip: analysis_args['ip_quota']}, analysis_args['time_intervals'],
+        {client_ip: analysis_args['expected_session_count']}, grid_origin=analysis_args['grid_origin'], workers=analysis_args.get('workers'),
+        sample_rate=analysis_args.get('sample_rate'))
+    return {time_interval: session_rows[client_ip] for time_interval, session_rows in results.items()}
+
+def analyze_scenarios(scenario_folders, result_dicts, time_intervals, max_workers=None, capture_workers=None, sample_rate=None):
+    """以 process pool 平行分析所有 (scenario, comp) 的擷取封包, 每個擷取檔只解碼一次就得到所有時間間隔的結果
+
+    子程序之間只傳遞擷取檔路徑與分析結果; capture_workers 的時間片段平行分析中, 子程序也是自行從擷取檔解碼片段內的封包, 已有快取時則讀取載入 shared memory 的快取
+
+    Args:
+        time_intervals ([str]): 數據平均的時間間隔 -秒, 都必須是最短者的倍數
+        max_workers (int, optional): 同時分析的擷取檔數量, 預設為CPU核心數, 1代表依序分析
+        capture_workers (int, optional): 大於1時改為依序分析每個擷取檔, 並在單一擷取檔內以時間片段平行分析 (適合少數長時間的擷取檔)
+        sample_rate (float, optional): 封包抽樣比例 (0~1), 見 opc_traffic_analyze.analyze_capture_resolutions
+
+    Returns:
+        dict: time_interval (int) -> scenario -> comp -> 每個session的指標
+    """
+    tasks = [task for folder in scenario_folders for task in collect_analysis_tasks(folder, result_dicts, time_intervals)]
+    for _, _, analysis_args in tasks:
+        analysis_args['workers'] = capture_workers
+        analysis_args['sample_rate'] = sample_rate
+    
+    if max_workers == 1 or (capture_workers or 1) > 1: # 不在 process pool 中再開 process pool
+        results = map(run_analysis_task, tasks)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(run_analysis_task, tasks)) # map 依 tasks 順序回傳結果
+    
+    analyzed_sessions = {int(time_interval): {Path(folder).name: {} for folder in scenario_folders} for time_interval in time_intervals}
+    for (scenario, comp, _), resolution_rows in zip(tasks, results):
+        for time_interval, session_rows in resolution_rows.items():
+            analyzed_sessions[time_interval][scenario][comp] = session_rows
         
-    time.sleep(0.1)
+    return analyzed_sessions
+
+def training_output_file(output_file, time_interval, time_intervals):
+    """輔助函式, 第一個時間間隔寫入 output_file, 其餘寫入 <檔名>_<秒數>s.csv
+    """
+    if time_interval == time_intervals[0]:
+        return output_file
+    root, extension = os.path.splitext(output_file)
+    return f'{root}_{time_interval}s{extension}'
 
-    return start_index
+def scenario_number(folder):
+    match = re.search(r'scenario_(\d+)', Path(folder).name)
+    return int(match.group(1)) if match else -1
 
 # 主程式
-def main(folder, result_dicts, time_interval, output_file, start_index):
+def main(folder, result_dicts, time_interval, output_file, analyzed_sessions=None, sample_rate=None):
+    """填寫某個scenario的訓練資料
+
+    Args:
+        analyzed_sessions (dict, optional): comp -> 已分析好的session指標, 未提供時在此依序分析
+        sample_rate (float, optional): 封包抽樣比例, 需與 analyzed_sessions 分析時相同
+    """
     subscription_file_path = Path(folder) / 'subscription_paths.csv'
     container_file = Path(folder) / 'containernet_script.py'
+    training_rows = []
     
     # 初次創建data_training.csv
-    initialize_training_data(output_file)
+    initialize_training_data(output_file, sample_rate)
     
     if container_file.exists():
         # 取得該拓墣生成的hosts
         context_adding_containers = extract_context(container_file, 'Adding docker containers as hosts', '#')
+        application_names = load_application_names('03_scenario_generation\\experiment_0\\applications.csv')
+        
+        # 呼叫opc_traffic_analyze，取得一半的訓練資料 (average_rtt, average_req_resp_delay, average_reconnection_count, average_error_packets_count)
+        # 未預先分析時在此依序分析, 同樣讓各comp的時間間隔對齊同一條格線
+        if analyzed_sessions is None:
+            analyzed_sessions = analyze_scenarios([folder], result_dicts, [time_interval], max_workers=1, sample_rate=sample_rate)[int(time_interval)][Path(folder).name]
         
         # 因為t-shark監控點在comp-sw的街線上，所以以comp為單位處理
         for comp, env_vars in result_dicts[Path(folder).name].items():
-            capture_file = next(Path(folder).glob(f'{comp}.pcap'), None)
-            
-            client_ip_line = next((line for line in context_adding_containers if comp in line), None)
-            client_ip = re.search(r'ip=\'(\d+\.\d+\.\d+\.\d+)\'', client_ip_line).group(1) if client_ip_line else None
-            
-            # 取得預估連線術語dev連線數配額
-            expected_session_count = sum(len(val.split(',')) for val in env_vars.values()) if env_vars else 0
-            ip_quota = count_ip_quota(env_vars)
-            
-            # 呼叫opc_traffic_analyze2.py，取得一半的訓練資料 (average_rtt, average_req_resp_delay, average_reconnection_count, average_error_packets_count)
-            subprocess.run(['python', '01_PacketAnalyze\\01_opc_traffic_analyze2.py', client_ip, str(expected_session_count), json.dumps(ip_quota), str(capture_file), str(output_file), str(time_interval)])
+            if comp not in analyzed_sessions:
+                continue
+            session_rows = analyzed_sessions[comp]
 
             # 取得一半的訓練資料後，對應填寫剩下的另一半訓練資料
-            session_data = pd.read_csv(output_file, header=0, skiprows=range(1, start_index + 1), nrows=expected_session_count)
-            
-            if 'Session' in session_data.columns:
-                for _, row in session_data.iterrows():
-                    session = row['Session'] if 'Session' in row else None
-                    if session:
-                        # 由於session的出現順序是隨機的，所以從該session的資訊反推app, device
-                        device_ip = session.split('-')[1]
-                        device, app, env_vars = find_device_and_app(context_adding_containers, device_ip, env_vars, comp)
-                        app = app.split('_')[0].lower() if app else None
-                        
-                        if app:
-                            applications_data = pd.read_csv('03_scenario_generation\\experiment_0\\applications.csv')
-                            applications_data['initials'] = applications_data['name'].apply(lambda x: ''.join(word[0].lower() for word in x.split()))
-                            app_row = applications_data[applications_data['initials'] == app]
-                            if not app_row.empty:
-                                app = app_row.iloc[0]['application']
-                        
-                        # 取得訂閱資訊
-                        subscription_order, weight = find_subscription_order(subscription_file_path, device, f'{app}_{comp}')
-                        
-                        # 填寫剩下的另一半訓練資料
-                        start_index = update_data_training(output_file, Path(folder).name, comp, app, device, subscription_order, weight, start_index)
-            else:
-                # 捕捉例外，目前無用
-                pass
+            for row in session_rows:
+                session = row['Session'] if 'Session' in row else None
+                if session:
+                    # 由於session的出現順序是隨機的，所以從該session的資訊反推app, device
+                    device_ip = session.split('-')[1]
+                    device, app, env_vars = find_device_and_app(context_adding_containers, device_ip, env_vars, comp)
+                    app = app.split('_')[0].lower() if app else None
+                    app = application_names.get(app, app)
+                    
+                    # 取得訂閱資訊
+                    subscription_order, weight = find_subscription_order(subscription_file_path, device, f'{app}_{comp}') or (None, None)
+                    
+                    # 填寫剩下的另一半訓練資料
+                    training_rows.append({
+                        'Scenario': Path(folder).name,
+                        'Computer': comp,
+                        'Application': app,
+                        'Device': device,
+                        'Subscription Order': subscription_order,
+                        'Weight': weight,
+                        **row
+                    })
+    
+    # 整個scenario的訓練資料一次寫入
+    append_training_rows(output_file, training_rows)
             
-    return start_index
+    return training_rows
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     
     base_path = '03_scenario_generation\\experiment_0'
-    time_interval = '10'
-    output_file = '01_PacketAnalyze\\data_training.csv'
-    start_index=0
+    time_intervals = ['10'] # 數據平均的時間間隔 -秒, 可同時列出多個 (例如 ['10', '1', '60']), 擷取檔只解碼一次, 較長者由最短者合併
+    output_file = '01_PacketAnalyze\\data_training.csv' # 第一個時間間隔的輸出, 其餘見 training_output_file
+    max_workers = int(sys.argv[1]) if len(sys.argv) > 1 else None # 平行分析的process數量, 預設為CPU核心數, 1代表依序分析
+    capture_workers = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] else None # (選填) 單一擷取檔內的平行分析process數量, 大於1時擷取檔改為依序分析
+    sample_rate = float(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3] else None # (選填) 封包抽樣比例 (0~1), 輸出會多出信賴區間欄位, 空字串代表不抽樣
     
-    scenario_folders = glob.glob(os.path.join(base_path, f'*scenario*'))
+    scenario_folders = sorted(glob.glob(os.path.join(base_path, f'*scenario*')), key=scenario_number)
     result_dicts = {Path(folder).name: process_scenario_folder(folder) for folder in scenario_folders}
     
-    for folder in scenario_folders:
-        start_index = main(folder, result_dicts, time_interval, output_file, start_index)
\ No newline at end of file
+    # 先平行分析所有擷取封包，再依scenario順序合併，確保輸出順序固定
+    analyzed_sessions = analyze_scenarios(scenario_folders, result_dicts, time_intervals, max_workers, capture_workers, sample_rate)
+    
+    for time_interval in time_intervals:
+        interval_output_file = training_output_file(output_file, time_interval, time_intervals)
+        interval_result_dicts = copy.deepcopy(result_dicts) # main 會從 env_vars 中移除已對應的device
+        for folder in scenario_folders:
+            main(folder, interval_result_dicts, time_interval, interval_output_file, analyzed_sessions[int(time_interval)][Path(folder).name], sample_rate)
\ No newline at end of file
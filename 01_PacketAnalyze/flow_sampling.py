@@ -0,0 +1,397 @@
+import numpy as np
+
+import opcua_decoder
+import latency_sketch
+
+#? 解碼前以雜湊選取的封包抽樣: 只看封包標頭決定保留哪些封包, 沒有被抽中的封包不解碼 OPC UA、不做TCP分析、不進入時間間隔的分組 (省下的時間與抽樣比例成正比)
+#? 同一個抽樣單位 (一次請求及其ACK、回應、回應的ACK) 的封包一起保留或一起略過, 配對不會被拆開; 抽樣單位記錄在 PACKET_DTYPE 的 sample_unit/rtt_unit 欄位
+#? 估計值與信賴區間以抽樣單位為群集 (cluster) 計算, 同一個單位中的樣本不視為獨立; 一律保留的封包 (sample_unit 為0) 視為確定納入, 不貢獻抽樣誤差
+#? 由 pcap_reader.filter_mask 呼叫, 此模組不依賴 pcap_reader (避免循環引用)
+
+CONFIDENCE_Z = 1.96 # 95% 信賴區間
+ACK_HOLD = 120 # 秒, ACK 只比對這段時間內被保留的資料段, 與分段的位置無關 (平行分析的各片段與依序分析選出相同的封包)
+
+# 一定保留的封包: TCP SYN/FIN/RST 與非MSG的OPC UA message (數量少, 且 Reconnection Count 依賴 HEL)
+_CONTROL_FLAGS = 0x01 | 0x02 | 0x04 # FIN | SYN | RST, 與 pcap_reader 的旗標相同
+_CONTROL_MESSAGES = [int.from_bytes(name.encode(), 'big') for name in opcua_decoder.MESSAGE_TYPES if name not in ('', 'MSG')]
+_MSG = int.from_bytes(b'MSG', 'big')
+_SYN_FIN = 0x01 | 0x02
+_ACK_FLAG = 0x10
+
+def _mix(keys):
+    """輔助函式, splitmix64 的混合函式, 將 uint64 鍵值打散成均勻分布
+    """
+    with np.errstate(over='ignore'):
+        keys = (keys ^ (keys >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        keys = (keys ^ (keys >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return keys ^ (keys >> np.uint64(31))
+
+def unit_hash(columns, seed=0):
+    """將多個整數欄位組合成抽樣單位的雜湊值
+
+    Args:
+        columns ([np.ndarray]): 同長度的整數欄位
+
+    Returns:
+        np.ndarray: uint64 雜湊值
+    """
+    keys = np.full(len(columns[0]), seed, dtype=np.uint64)
+    for column in columns:
+        with np.errstate(over='ignore'):
+            keys = _mix(keys + np.asarray(column).astype(np.uint64))
+    return keys
+
+def _no_segments():
+    return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.float64)
+
+def new_sampling(sample_rate, time_interval, grid_origin, port=opcua_decoder.OPC_PORT, seed=0):
+    """建立解碼前抽樣的設定與狀態, 放入 pcap_reader.new_packet_filter 的篩選條件
+
+    Args:
+        sample_rate (float): 0~1 之間的抽樣比例 (不含0)
+        time_interval, grid_origin (float): 分析的時間間隔格線 (與 iter_time_windows 相同), 各時間間隔抽樣前的統計依此分開
+        port (int): server 端的TCP埠, 用來分辨請求與回應的方向
+
+    Returns:
+        dict: 依檔案順序分段抽樣時每段傳入同一個 (見 sampling_mask)
+    """
+    if not 0 < sample_rate <= 1:
+        raise ValueError(f"Sample rate must be in (0, 1], got {sample_rate}")
+    return {'sample_rate': sample_rate, 'time_interval': time_interval, 'grid_origin': grid_origin, 'port': port, 'seed': seed,
+            'segments': _no_segments(), # ACK_HOLD 內被保留的資料段 (單向flow與next seq的雜湊, 抽樣單位, 時間), 供之後的ACK比對
+            'packet_counts': {}} # 時間間隔編號 -> {(client端, server端): 抽樣前的統計}, 見 count_packets
+
+def restart(sampling):
+    """相同設定、從擷取檔開頭重新抽樣的狀態 (同一個檔案走訪第二次時使用, 結果與第一次相同)
+    """
+    return None if sampling is None else dict(sampling, segments=_no_segments(), packet_counts={})
+
+def carry_over(sampling):
+    """目前抽樣狀態的複本 (不含 packet_counts), 從擷取檔中間的這個位置接著抽樣時使用 (見 pcap_reader.advance_tcp_state)
+    """
+    return None if sampling is None else dict(sampling, packet_counts={})
+
+def _endpoints(fields, port):
+    """輔助函式, 每個封包的 client端與server端 (ip<<16 | port), 以 server 端的TCP埠分辨方向
+    """
+    to_server = fields['dst_port'] == port
+    src = (fields['src_ip'].astype(np.uint64) << np.uint64(16)) | fields['src_port'].astype(np.uint64)
+    dst = (fields['dst_ip'].astype(np.uint64) << np.uint64(16)) | fields['dst_port'].astype(np.uint64)
+    return to_server, np.where(to_server, src, dst), np.where(to_server, dst, src)
+
+def window_numbers(timestamps, time_interval, grid_origin):
+    """輔助函式, 每個時間戳記所屬的時間間隔編號, 邊界與 iter_time_windows 的格線相同 (以格線值校正浮點誤差)
+    """
+    numbers = np.floor((timestamps - grid_origin) / time_interval).astype(np.int64)
+    numbers += grid_origin + (numbers + 1) * time_interval <= timestamps
+    numbers -= grid_origin + numbers * time_interval > timestamps
+    return numbers
+
+def _read_payload(buf, fields, offset, size, valid):
+    """輔助函式, 讀取 TCP payload 中 offset 起 size 個位元組 (big-endian), valid 為 False 的封包為0
+    """
+    valid = valid & (fields['payload_offset'] + offset + size <= len(buf))
+    pos = np.where(valid, fields['payload_offset'] + offset, 0)
+    value = np.zeros(len(pos), dtype=np.int64)
+    for i in range(size):
+        value = (value << 8) | buf[pos + i]
+    return np.where(valid, value, 0)
+
+def sampling_mask(buf, fields, timestamps, sampling):
+    """依封包標頭選出要保留的封包, 以及各封包的抽樣單位
+
+    - 抽樣單位: OPC UA MSG chunk 以 (連線, RequestId) 為單位, 請求與回應 (包括多個chunk) 一起保留, pipeline 的請求也不會拆開;
+      其他資料段以 (連線, client 送出資料的位置) 為單位 (client→server 為 seq+len, server→client 為 ack), retransmission 與原本的資料段相同
+    - 一律保留: 控制封包 (SYN/FIN/RST、非MSG的OPC UA message), 數量少且 Reconnection Count 依賴 HEL
+    - ACK 跟著它確認的資料段: 確認了被保留的資料段 (ACK_HOLD 內) 的封包也保留, 因此 RTT 樣本與資料段一起被抽中, 一律保留的資料段的 RTT 也一律保留
+    - session 追蹤需要的各flow統計 (封包數、第一個與最後一個封包) 由 count_packets 以抽樣前的封包計算, 不另外保留封包
+
+    Args:
+        buf (np.ndarray): 整個擷取檔的 uint8 陣列
+        fields (dict): decode_headers 的結果 (只包含通過篩選的TCP封包), 需依檔案順序分段傳入
+        timestamps (np.ndarray): 對應的時間戳記
+        sampling (dict): new_sampling 的狀態, 會直接更新
+
+    Returns:
+        np.ndarray: bool 遮罩
+        np.ndarray: 各封包的抽樣單位 (uint32, 見 PACKET_DTYPE 的 sample_unit): 自己被抽中的單位, 只因確認了資料段而保留時為該資料段的單位, 一律保留的封包為0
+        np.ndarray: 各封包確認的資料段的抽樣單位 (uint32, 即 ack_rtt 樣本所屬的單位, 見 rtt_unit), 確認的是一律保留的資料段時為0
+    """
+    count = len(timestamps)
+    if count == 0:
+        return np.zeros(0, dtype=bool), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.uint32)
+
+    to_server, client, server = _endpoints(fields, sampling['port'])
+    connection = unit_hash([client, server], sampling['seed'])
+    flags = fields['flags']
+    has_payload = fields['tcp_len'] > 0
+    message_type = _read_payload(buf, fields, 0, 3, fields['tcp_len'] >= 8)
+    is_msg = (message_type == _MSG) & (fields['tcp_len'] >= 24)
+    request_id = _read_payload(buf, fields, 20, 4, is_msg).astype(np.uint32).byteswap() # SequenceHeader 的 RequestId (little-endian)
+    position = np.where(to_server, (fields['seq'] + fields['tcp_len']) % (1 << 32), fields['ack'])
+    units = np.where(is_msg, unit_hash([connection, request_id, np.ones(count)]), unit_hash([connection, position, np.full(count, 2)]))
+
+    forced = ((flags & _CONTROL_FLAGS) != 0) | np.isin(message_type, _CONTROL_MESSAGES)
+    threshold = np.uint64(min(int(sampling['sample_rate'] * 2.0**64), 2**64 - 1))
+    sampled = ~forced & has_payload & (units < threshold)
+    unit_ids = np.maximum(units & np.uint64(0xFFFFFFFF), np.uint64(1)).astype(np.uint32) # 0 代表一律保留
+
+    # 被保留的資料段, 與 ACK_HOLD 內之前保留的資料段一起依 (雜湊, 時間) 排列
+    syn_fin = (flags & _SYN_FIN) != 0
+    src, dst = np.where(to_server, client, server), np.where(to_server, server, client)
+    is_segment = (forced | sampled) & (has_payload | syn_fin)
+    next_seq = (fields['seq'].astype(np.int64) + fields['tcp_len'] + syn_fin)[is_segment] % (1 << 32)
+    previous_keys, previous_units, previous_times = sampling['segments']
+    keys = np.concatenate((previous_keys, unit_hash([src[is_segment], dst[is_segment], next_seq])))
+    segment_units = np.concatenate((previous_units, np.where(sampled, unit_ids, 0)[is_segment].astype(np.uint32)))
+    segment_times = np.concatenate((previous_times, timestamps[is_segment]))
+    order = np.lexsort((segment_times, keys))
+    keys, segment_units, segment_times = keys[order], segment_units[order], segment_times[order]
+
+    # 確認了被保留的資料段的ACK: 相同雜湊的資料段 (retransmission) 中最早的在ACK之前, 最晚的在 ACK_HOLD 內
+    is_ack, rtt_units = np.zeros(count, dtype=bool), np.zeros(count, dtype=np.uint32)
+    if len(keys):
+        acks = unit_hash([dst, src, fields['ack']])
+        first = np.minimum(np.searchsorted(keys, acks, side='left'), len(keys) - 1)
+        last = np.maximum(np.searchsorted(keys, acks, side='right') - 1, 0)
+        is_ack = ((flags & _ACK_FLAG) != 0) & (keys[first] == acks) & (segment_times[first] <= timestamps) & (segment_times[last] >= timestamps - ACK_HOLD)
+        rtt_units = np.where(is_ack, segment_units[first], 0).astype(np.uint32)
+    recent = segment_times >= timestamps.max() - ACK_HOLD
+    sampling['segments'] = (keys[recent], segment_units[recent], segment_times[recent])
+
+    sample_units = np.where(sampled, unit_ids, np.where(forced, 0, rtt_units)).astype(np.uint32)
+    return forced | sampled | is_ack, sample_units, rtt_units
+
+def count_packets(fields, timestamps, numbers, sampling):
+    """記錄各時間間隔中每個連線抽樣前的封包數、資料段數、第一個與最後一個封包
+
+    session 追蹤依各flow的封包數排序, 重聯配對依各flow第一個封包 (是否為SYN) 與最後一個封包的順序, 抽樣後的封包會改變這些結果,
+    沒有任何封包被抽中的flow也需要出現在該時間間隔中; 資料段數用來判斷抽樣後沒有樣本的時間間隔是否需要補值
+
+    Args:
+        fields (dict): decode_headers 的結果, 包括沒有被抽中的封包
+        timestamps, numbers (np.ndarray): 對應的時間戳記與 frame number
+        sampling (dict): new_sampling 的狀態, 會直接更新
+    """
+    if len(timestamps) == 0:
+        return
+    _, client, server = _endpoints(fields, sampling['port'])
+    window = window_numbers(timestamps, sampling['time_interval'], sampling['grid_origin'])
+    _, first, inverse, counts = np.unique(unit_hash([client, server, window]), return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    segments = np.bincount(inverse, weights=fields['tcp_len'] > 0, minlength=len(first)).astype(np.int64)
+    last_numbers = np.zeros(len(first), dtype=np.int64)
+    np.maximum.at(last_numbers, inverse, numbers)
+    first_syn = (fields['flags'][first] & 0x02) != 0
+    for number, client_end, server_end, count, segment_count, first_number, last_number, syn in zip(
+            window[first].tolist(), client[first].tolist(), server[first].tolist(), counts.tolist(), segments.tolist(),
+            numbers[first].tolist(), last_numbers.tolist(), first_syn.tolist()):
+        totals = sampling['packet_counts'].setdefault(number, {}).setdefault((client_end, server_end), [0, 0, first_number, 0, syn])
+        totals[0] += count
+        totals[1] += segment_count
+        totals[3] = max(totals[3], last_number)
+
+def pop_packet_counts(sampling, number):
+    """取出 (並移除) 某個時間間隔各連線抽樣前的統計
+
+    Returns:
+        dict: (client端, server端) -> [封包數, 資料段數, 第一個frame number, 最後一個frame number, 第一個封包是否為SYN], 端點為 ip<<16 | port
+    """
+    return sampling['packet_counts'].pop(number, {})
+
+def merge_packet_counts(counts_list):
+    """依時間順序合併連續幾個時間間隔的 pop_packet_counts 結果: 封包數、資料段數相加, 第一個封包取最早的, 最後一個封包取最晚的
+
+    Returns:
+        dict: 與 pop_packet_counts 相同
+    """
+    merged = {}
+    for packet_counts in counts_list:
+        for endpoints, (packets, segments, first_number, last_number, syn) in packet_counts.items():
+            counts = merged.setdefault(endpoints, [0, 0, first_number, 0, syn])
+            counts[0] += packets
+            counts[1] += segments
+            counts[3] = max(counts[3], last_number)
+    return merged
+
+# 估計值與信賴區間 (半寬): 每個抽樣單位以雜湊獨立地以 sample_rate 的機率被抽中, 樣本的權重為 1/sample_rate (一律保留的樣本為1, Horvitz-Thompson),
+# 變異數以抽樣單位為群集計算並乘上有限母體修正 (1 - sample_rate); 抽中的單位不足2個時無法估計群集的變異數, 信賴區間為 NaN
+UNIT_TOTALS = (
+    'certain_sum', 'certain_count', # 確定納入的樣本 (抽樣單位為0) 的總和、個數
+    'sum', 'count', 'units', # 抽中的樣本的總和、個數, 抽中的單位數
+    'unit_sum_squares', 'unit_cross', 'unit_count_squares', # 各單位 Σ(單位總和)², Σ(單位總和·單位樣本數), Σ(單位樣本數)²
+    'sum_squares', # 抽中的樣本的平方和
+)
+
+def new_unit_totals():
+    return np.zeros(len(UNIT_TOTALS))
+
+def unit_totals(groups, units, values, group_count):
+    """依抽樣單位彙整各組 (例如各session) 的樣本, 欄位為 UNIT_TOTALS, 各組的結果可以直接相加合併 (單位不會跨時間間隔重複)
+
+    Args:
+        groups (np.ndarray): 每個樣本所屬的組別
+        units (np.ndarray): 每個樣本的抽樣單位 (PACKET_DTYPE 的 sample_unit 或 rtt_unit), 0代表確定納入
+        values (np.ndarray): 樣本值
+
+    Returns:
+        np.ndarray: (group_count, len(UNIT_TOTALS))
+    """
+    totals = np.zeros((group_count, len(UNIT_TOTALS)))
+    if len(values) == 0:
+        return totals
+    groups, values = np.asarray(groups, dtype=np.int64), np.asarray(values, dtype=np.float64)
+    certain = units == 0
+    totals[:, 0] = np.bincount(groups[certain], weights=values[certain], minlength=group_count)
+    totals[:, 1] = np.bincount(groups[certain], minlength=group_count)
+
+    sampled = ~certain
+    keys = (groups[sampled].astype(np.uint64) << np.uint64(32)) | units[sampled].astype(np.uint64)
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+    unit_sums = np.bincount(inverse, weights=values[sampled], minlength=len(unique_keys))
+    unit_counts = np.bincount(inverse, minlength=len(unique_keys)).astype(np.float64)
+    unit_groups = (unique_keys >> np.uint64(32)).astype(np.int64)
+    for column, weights in enumerate((unit_sums, unit_counts, np.ones(len(unique_keys)), unit_sums ** 2, unit_sums * unit_counts, unit_counts ** 2), start=2):
+        totals[:, column] = np.bincount(unit_groups, weights=weights, minlength=group_count)
+    totals[:, 8] = np.bincount(groups[sampled], weights=values[sampled] ** 2, minlength=group_count)
+    return totals
+
+def add_unit_totals(totals, other):
+    """將 other 的 unit_totals 加到 totals (new_unit_totals 或多組 unit_totals 的陣列, 直接更新)
+    """
+    totals += other
+
+def _expanded_totals(totals, sample_rate):
+    """輔助函式, 以權重還原的 (樣本總和, 樣本數)
+    """
+    return totals[0] + totals[2] / sample_rate, totals[1] + totals[3] / sample_rate
+
+def _residual_squares(totals, ratio):
+    """輔助函式, 各抽樣單位殘差 (單位總和 - ratio·單位樣本數) 的平方和
+    """
+    return max(totals[5] - 2 * ratio * totals[6] + ratio * ratio * totals[7], 0.0)
+
+def ratio_estimate(totals, sample_rate):
+    """平均值 (樣本總和/樣本數) 的估計, 沒有樣本時為0
+    """
+    estimate_sum, estimate_count = _expanded_totals(totals, sample_rate)
+    return estimate_sum / estimate_count if estimate_count else 0.0
+
+def ratio_interval(totals, sample_rate, z=CONFIDENCE_Z):
+    """ratio_estimate 的信賴區間半寬, 線性化的變異數 (1-f)/f² · n/(n-1) · Σe² / (還原的樣本數)², n 為抽中的單位數, e 為各單位的殘差
+    """
+    units = totals[4]
+    if units < 2:
+        return np.nan
+    estimate_sum, estimate_count = _expanded_totals(totals, sample_rate)
+    residuals = _residual_squares(totals, estimate_sum / estimate_count)
+    return z * np.sqrt((1 - sample_rate) / sample_rate ** 2 * units / (units - 1) * residuals) / estimate_count
+
+def total_estimate(totals, sample_rate):
+    """樣本總和的估計 (例如異常封包數)
+    """
+    return _expanded_totals(totals, sample_rate)[0]
+
+def total_variance(totals, sample_rate):
+    """total_estimate 的變異數, 各單位獨立抽樣 (Poisson sampling) 時為 (1-f)/f² · Σ(單位總和)², 沒有抽中任何樣本時為0
+    """
+    return (1 - sample_rate) / sample_rate ** 2 * totals[5]
+
+def design_effect(totals):
+    """抽中的樣本的設計效應: 以抽樣單位為群集時平均值的變異數 / 把樣本視為獨立時的變異數, 抽中的單位或樣本不足2個時為 NaN
+    """
+    units, count = totals[4], totals[3]
+    if units < 2 or count < 2:
+        return np.nan
+    mean = totals[2] / count
+    clustered = units / (units - 1) * _residual_squares(totals, mean)
+    independent = count / (count - 1) * max(totals[8] - count * mean * mean, 0.0)
+    return clustered / independent if independent > 0 else 1.0
+
+def sample_variance(total, sum_squares, count):
+    """輔助函式, 由總和與平方和計算樣本變異數, 樣本數不足2時為 NaN
+    """
+    if count < 2:
+        return np.nan
+    return max((sum_squares - total * total / count) / (count - 1), 0.0)
+
+def quantile_interval(sketch, q, sample_rate, design_effect=1.0, z=CONFIDENCE_Z):
+    """分位數的信賴區間半寬: 以樣本排名的常態近似 q(n-1) ± z·sqrt(n·q(1-q)·(1-sample_rate)·design_effect) 在 sketch 中取上下界, 取較寬的一側
+
+    Args:
+        sketch (np.ndarray): 抽中的樣本的 latency_sketch
+        q (float): 0~1 之間的分位
+        design_effect (float): 見 design_effect, 同一個抽樣單位中的樣本不是獨立的
+    """
+    count = int(np.sum(sketch))
+    if count == 0 or not np.isfinite(design_effect):
+        return np.nan
+    spread = z * np.sqrt(count * q * (1 - q) * (1 - sample_rate) * design_effect)
+    center = q * (count - 1)
+    lower, estimate, upper = latency_sketch.rank_values(sketch, [center - spread, center, center + spread])
+    return max(upper - estimate, estimate - lower)
+
+# 時間間隔平均的平均 (例如 Average RTT): 各時間間隔以 ratio_estimate 估計; 抽樣後某些時間間隔可能沒有留下任何樣本, 直接以0計算會低估,
+# 因此原本有樣本 (candidates > 0) 但抽樣後沒有的時間間隔以整段的合併平均值補上, 信賴區間另外加上補值的不確定性;
+# 各時間間隔抽中的單位通常很少, 單位殘差的變異數合併所有時間間隔估計 (同一個session各時間間隔內的變異數視為相同)
+def new_window_mean_totals():
+    return {
+        'missing': 0, # 需要補值的時間間隔數
+        'pooled': [0.0, 0.0], # 還原的樣本總和, 樣本數
+        'residuals': [0.0, 0], # 各時間間隔內單位殘差的平方和 Σe², 自由度 Σ(n-1)
+        'weights': 0.0, # Σ n/(還原的樣本數)², 各時間間隔平均值的變異數為 (1-f)/f² · 殘差變異數 · n/(還原的樣本數)²
+        'means': [0, 0.0, 0.0], # 有樣本的時間間隔數, 平均值總和, 平均值平方和
+    }
+
+def add_window_mean(totals, window_totals, candidates, sample_rate):
+    """累加單一時間間隔的樣本
+
+    Args:
+        window_totals (list): 該時間間隔的 unit_totals
+        candidates (int): 抽樣前的樣本數 (只需判斷是否大於0, 例如資料段數)
+    """
+    estimate_sum, estimate_count = _expanded_totals(window_totals, sample_rate)
+    if estimate_count == 0:
+        totals['missing'] += candidates > 0
+        return
+    mean = estimate_sum / estimate_count
+    units = window_totals[4]
+    totals['pooled'][0] += estimate_sum
+    totals['pooled'][1] += estimate_count
+    totals['residuals'][0] += _residual_squares(window_totals, mean)
+    totals['residuals'][1] += max(units - 1, 0)
+    totals['weights'] += units / estimate_count ** 2
+    totals['means'][0] += 1
+    totals['means'][1] += mean
+    totals['means'][2] += mean * mean
+
+def window_mean_estimate(totals, unit_totals, window_sum, window_count, sample_rate, z=CONFIDENCE_Z):
+    """估計時間間隔平均的平均與信賴區間半寬
+
+    Args:
+        unit_totals (list): 所有時間間隔合併的 unit_totals, 每個時間間隔都只抽中一個單位時以整段的單位殘差估計變異數
+        window_sum (float): 各時間間隔平均值的總和 (沒有樣本的時間間隔為0)
+        window_count (int): 時間間隔數
+
+    Returns:
+        (float, float): 估計值, 信賴區間半寬 (抽樣前就沒有樣本時為0, 抽中的單位不足2個時為 NaN)
+    """
+    pooled_sum, pooled_count = totals['pooled']
+    estimate = (window_sum + totals['missing'] * (pooled_sum / pooled_count if pooled_count else 0.0)) / window_count
+    if totals['means'][0] == 0 and totals['missing'] == 0:
+        return estimate, 0.0
+    units = unit_totals[4]
+    if units < 2:
+        return estimate, np.nan
+
+    residual_total, dof = totals['residuals']
+    if dof:
+        residual_variance = residual_total / dof
+    else:
+        residual_variance = _residual_squares(unit_totals, ratio_estimate(unit_totals, sample_rate)) / (units - 1)
+    variance = (1 - sample_rate) / sample_rate ** 2 * residual_variance * totals['weights']
+    if totals['missing']: # 補值與實際時間間隔平均值的差異
+        observed, mean_total, mean_squares = totals['means']
+        variance += totals['missing'] * sample_variance(mean_total, mean_squares, observed)
+    return estimate, z * np.sqrt(variance) / window_count
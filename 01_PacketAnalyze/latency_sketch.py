@@ -0,0 +1,128 @@
+import numpy as np
+
+#? 可合併的延遲分佈 sketch (DDSketch 式的對數分桶直方圖)
+#? 每個 sketch 是固定長度的計數陣列，合併只需相加，不保留原始樣本；分位數的相對誤差不超過 RELATIVE_ACCURACY
+
+RELATIVE_ACCURACY = 0.01
+MIN_VALUE = 1e-3 # 毫秒, 小於等於此值的樣本 (含0) 放在第0桶
+MAX_VALUE = 1e5 # 毫秒, 大於此值的樣本放在最後一桶
+
+_GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LOG_GAMMA = np.log(_GAMMA)
+BUCKET_COUNT = int(np.ceil(np.log(MAX_VALUE / MIN_VALUE) / _LOG_GAMMA)) + 2
+
+# 各桶的代表值: 第i桶涵蓋 (MIN_VALUE*γ^(i-1), MIN_VALUE*γ^i], 取 2γ^i/(γ+1) 使相對誤差最小
+_BUCKET_VALUES = MIN_VALUE * 2 * _GAMMA ** np.arange(BUCKET_COUNT) / (_GAMMA + 1)
+_BUCKET_VALUES[0] = 0.0
+_BUCKET_VALUES[-1] = MAX_VALUE
+
+def new_sketch():
+    return np.zeros(BUCKET_COUNT, dtype=np.int64)
+
+def bucket_index(values):
+    """輔助函式, 將樣本 (毫秒) 轉成桶的索引
+    """
+    values = np.asarray(values, dtype=np.float64)
+    index = np.ceil(np.log(np.maximum(values, MIN_VALUE) / MIN_VALUE) / _LOG_GAMMA).astype(np.int64)
+    return np.clip(index, 0, BUCKET_COUNT - 1)
+
+def group_sketches(groups, values, group_count):
+    """一次為多個群組 (例如各session) 建立 sketch
+
+    Args:
+        groups (np.ndarray): 每個樣本所屬的群組編號
+        values (np.ndarray): 樣本 (毫秒)
+
+    Returns:
+        np.ndarray: (group_count, BUCKET_COUNT), 每列為一個 sketch
+    """
+    cells = np.asarray(groups, dtype=np.int64) * BUCKET_COUNT + bucket_index(values)
+    return np.bincount(cells, minlength=group_count * BUCKET_COUNT).reshape(group_count, BUCKET_COUNT)
+
+def merge(sketch, other):
+    """將 other 合併進 sketch (直接更新), 回傳 sketch
+    """
+    sketch += other
+    return sketch
+
+def compact(sketch):
+    """只保留非0的桶, 大部分的桶都是0, 跨process傳遞時使用
+
+    Returns:
+        (np.ndarray, np.ndarray): 桶的索引, 計數
+    """
+    index = np.flatnonzero(sketch)
+    return index.astype(np.int32), sketch[index]
+
+def expand(compacted):
+    """將 compact 的結果還原成 sketch
+    """
+    index, counts = compacted
+    sketch = new_sketch()
+    sketch[index] = counts
+    return sketch
+
+def quantiles(sketch, qs):
+    """估計分位數, 沒有樣本時回傳0
+
+    Args:
+        qs ([float]): 0~1 之間的分位
+
+    Returns:
+        [float]: 各分位的估計值 (毫秒)
+    """
+    cumulative = np.cumsum(sketch)
+    total = int(cumulative[-1])
+    return _cumulative_values(cumulative, [q * (total - 1) for q in qs])
+
+def group_quantiles(sketches, qs):
+    """一次估計多個 sketch (例如 group_sketches 的結果) 的分位數, 與逐一呼叫 quantiles 的結果相同
+
+    Returns:
+        [[float]]: 每個 sketch 各分位的估計值 (毫秒)
+    """
+    sketches = np.asarray(sketches).reshape(-1, BUCKET_COUNT)
+    buckets = np.flatnonzero(sketches.any(axis=0)) # 只需累加有樣本的桶, 排序後第 rank 個樣本一定落在其中
+    if len(buckets) == 0:
+        return [[0.0 for _ in qs] for _ in sketches]
+    cumulative = np.cumsum(sketches[:, buckets], axis=1)
+    totals = cumulative[:, -1]
+    ranks = np.clip(np.multiply.outer(totals - 1, qs), 0, np.maximum(totals - 1, 0)[:, None])
+    # 各列加上不重疊的位移後攤平, 一次 searchsorted
+    offsets = np.arange(len(cumulative)) * (int(totals.max()) + 1)
+    index = np.searchsorted((cumulative + offsets[:, None]).ravel(), (ranks + offsets[:, None]).ravel(), side='right') % len(buckets)
+    values = np.where(totals[:, None] > 0, _BUCKET_VALUES[buckets[index]].reshape(ranks.shape), 0.0)
+    return values.tolist()
+
+def rank_values(sketch, ranks):
+    """估計排序後第 rank 個樣本 (從0開始, 可為小數) 的值, 超出範圍的 rank 取最小/最大的樣本, 沒有樣本時回傳0
+
+    Returns:
+        [float]: 各 rank 的估計值 (毫秒)
+    """
+    return _cumulative_values(np.cumsum(sketch), ranks)
+
+def _cumulative_values(cumulative, ranks):
+    """輔助函式, rank_values 的本體, cumulative 為 sketch 的累積和
+    """
+    total = int(cumulative[-1])
+    if total == 0:
+        return [0.0 for _ in ranks]
+    ranks = np.clip(ranks, 0, total - 1)
+    return _BUCKET_VALUES[np.searchsorted(cumulative, ranks, side='right')].tolist()
+
+def group_jitter(groups, values, group_count):
+    """計算各群組相鄰樣本差的絕對值總和與個數 (平均即為抖動), 同樣可直接相加合併
+
+    Args:
+        groups (np.ndarray): 每個樣本所屬的群組編號, 同群組的樣本需相鄰且依時間排列
+        values (np.ndarray): 樣本 (毫秒)
+
+    Returns:
+        (np.ndarray, np.ndarray): 各群組的差值總和、差值個數
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    same_group = groups[1:] == groups[:-1]
+    differences = np.abs(np.diff(values))[same_group]
+    return (np.bincount(groups[1:][same_group], weights=differences, minlength=group_count),
+            np.bincount(groups[1:][same_group], minlength=group_count))
@@ -0,0 +1,196 @@
+import numpy as np
+
+#? OPC UA TCP 二進位標頭的輕量解碼器，直接在 TCP payload 上以 numpy 向量化解析，不需要 Wireshark 的 OPC UA dissector
+#? 只解每個 TCP payload 開頭的第一個 OPC UA message; 多個chunk的message只有第一個chunk解 body (TypeId, RequestHandle)
+
+OPC_PORT = 4840
+MESSAGE_TYPES = ('', 'HEL', 'ACK', 'OPN', 'MSG', 'CLO', 'ERR', 'RHE')
+CHUNK_TYPES = ('', 'F', 'C', 'A') # Final, Continue (中間的chunk), Abort
+
+_MESSAGE_TYPE_CODES = {name.encode(): code for code, name in enumerate(MESSAGE_TYPES) if name}
+_CHUNK_TYPE_CODES = {name.encode(): code for code, name in enumerate(CHUNK_TYPES) if name}
+
+# body 的 TypeId (namespace 0, DefaultBinary encoding) -> service 名稱, request 與 response 對應同一個 service
+SERVICE_NAMES = {
+    397: 'ServiceFault',
+    422: 'FindServers', 425: 'FindServers',
+    428: 'GetEndpoints', 431: 'GetEndpoints',
+    446: 'OpenSecureChannel', 449: 'OpenSecureChannel',
+    452: 'CloseSecureChannel', 455: 'CloseSecureChannel',
+    461: 'CreateSession', 464: 'CreateSession',
+    467: 'ActivateSession', 470: 'ActivateSession',
+    473: 'CloseSession', 476: 'CloseSession',
+    527: 'Browse', 530: 'Browse',
+    533: 'BrowseNext', 536: 'BrowseNext',
+    554: 'TranslateBrowsePathsToNodeIds', 557: 'TranslateBrowsePathsToNodeIds',
+    560: 'RegisterNodes', 563: 'RegisterNodes',
+    631: 'Read', 634: 'Read',
+    673: 'Write', 676: 'Write',
+    712: 'Call', 715: 'Call',
+    751: 'CreateMonitoredItems', 754: 'CreateMonitoredItems',
+    781: 'DeleteMonitoredItems', 784: 'DeleteMonitoredItems',
+    787: 'CreateSubscription', 790: 'CreateSubscription',
+    826: 'Publish', 829: 'Publish',
+    847: 'DeleteSubscriptions', 850: 'DeleteSubscriptions',
+}
+
+# NodeId 編碼 (低6位元) -> 固定長度, String/ByteString 另外加上字串長度
+_NODE_ID_LENGTHS = {0x00: 2, 0x01: 4, 0x02: 7, 0x03: 7, 0x04: 19, 0x05: 7}
+
+def _code_lookup(codes, size):
+    """輔助函式, 建立 size bytes 的 big-endian 整數 -> 代碼 的查表陣列鍵值
+    """
+    return {int.from_bytes(name, 'big'): code for name, code in codes.items() if len(name) == size}
+
+def _read_le(buf, pos, size, valid, signed=False):
+    """輔助函式, 從 buf 的多個位置讀取 little-endian 整數, 無效位置回傳0
+    """
+    pos = np.where(valid, pos, 0)
+    value = np.zeros(len(pos), dtype=np.int64)
+    for i in reversed(range(size)):
+        value = (value << 8) | buf[pos + i]
+    if signed:
+        value = np.where(value >= 1 << (size * 8 - 1), value - (1 << (size * 8)), value)
+    return np.where(valid, value, 0)
+
+def _skip_node_id(buf, pos, end, valid):
+    """輔助函式, 略過 pos 位置的 NodeId, 回傳下一個欄位位置與是否仍在 payload 範圍內
+    """
+    valid = valid & (pos + 1 <= end)
+    encoding = _read_le(buf, pos, 1, valid) & 0x3F
+    length = np.full(len(pos), -1, dtype=np.int64)
+    for code, node_id_length in _NODE_ID_LENGTHS.items():
+        length[encoding == code] = node_id_length
+
+    is_string = (encoding == 0x03) | (encoding == 0x05)
+    valid &= (length > 0) & ~(is_string & (pos + 7 > end)) # 未知的編碼或字串長度被截斷
+    length += np.maximum(_read_le(buf, pos + 3, 4, valid & is_string, signed=True), 0)
+    return pos + np.maximum(length, 0), valid
+
+def _skip_byte_string(buf, pos, end, valid):
+    """輔助函式, 略過 pos 位置的 String/ByteString (int32 長度, -1 代表 null)
+    """
+    valid = valid & (pos + 4 <= end)
+    length = _read_le(buf, pos, 4, valid, signed=True)
+    return pos + 4 + np.maximum(length, 0), valid
+
+def _numeric_node_id(buf, pos, end, valid):
+    """輔助函式, 讀出 namespace 0 的 TwoByte/FourByte/Numeric NodeId 的識別碼, 其他NodeId回傳0
+    """
+    valid = valid & (pos + 1 <= end)
+    encoding = _read_le(buf, pos, 1, valid) & 0x3F
+    is_two_byte = valid & (encoding == 0x00) & (pos + 2 <= end)
+    is_four_byte = valid & (encoding == 0x01) & (pos + 4 <= end) & (_read_le(buf, pos + 1, 1, valid) == 0)
+    is_numeric = valid & (encoding == 0x02) & (pos + 7 <= end) & (_read_le(buf, pos + 1, 2, valid) == 0)
+    return np.select([is_two_byte, is_four_byte, is_numeric],
+                     [_read_le(buf, pos + 1, 1, is_two_byte), _read_le(buf, pos + 2, 2, is_four_byte), _read_le(buf, pos + 3, 4, is_numeric)], 0)
+
+def message_starts(message_keys, sequence_numbers, chunk_type, open_messages):
+    """標記每個chunk是否為其 message 的第一個chunk, 並更新尚未結束的 message
+
+    同一個 message (同方向的連線、SecureChannelId、RequestId) 的chunk依序傳送, 前一個chunk為 'C' 時這個chunk是後續的chunk;
+    重傳的chunk (SequenceNumber 與前一個chunk相同) 沿用前一個chunk的結果
+
+    Args:
+        message_keys (np.ndarray): (n, k) 依封包順序的 message 鍵值
+        sequence_numbers, chunk_type (np.ndarray): 各chunk的 SequenceNumber 與 CHUNK_TYPES 的索引
+        open_messages (set): 之前最後一個chunk為 'C' 的 message 鍵值 (tuple), 分段處理時每段傳入同一個集合, 會直接更新
+
+    Returns:
+        np.ndarray: bool
+    """
+    count = len(chunk_type)
+    if count == 0:
+        return np.zeros(0, dtype=bool)
+    
+    # 同一個 message 的chunk相鄰且保留原本順序
+    order = np.lexsort(message_keys.T[::-1])
+    keys, chunks, sequences = message_keys[order], chunk_type[order], sequence_numbers[order]
+    same = np.concatenate(([False], np.all(keys[1:] == keys[:-1], axis=1)))
+    continued = np.concatenate(([False], chunks[:-1] == CHUNK_TYPES.index('C')))
+    is_start = ~same | ~continued
+    
+    # 每個 message 在這一段的第一個chunk, 若之前的最後一個chunk為 'C' 則不是開頭
+    firsts = np.flatnonzero(~same)
+    seen = set()
+    for key in open_messages:
+        matched = firsts[np.all(keys[firsts] == key, axis=1)]
+        is_start[matched] = False
+        if len(matched):
+            seen.add(key)
+    
+    retransmitted = same & np.concatenate(([False], sequences[1:] == sequences[:-1]))
+    is_start = is_start[np.maximum.accumulate(np.where(retransmitted, 0, np.arange(count)))]
+    
+    lasts = np.append(firsts[1:] - 1, count - 1)
+    open_messages -= seen
+    open_messages.update(map(tuple, keys[lasts[chunks[lasts] == CHUNK_TYPES.index('C')]].tolist()))
+    
+    starts = np.empty(count, dtype=bool)
+    starts[order] = is_start
+    return starts
+
+def decode_headers(buf, payload_offsets, payload_lengths, is_request, connections=None, open_messages=None):
+    """解碼每個 TCP payload 開頭的 OPC UA message 標頭
+
+    Args:
+        buf (np.ndarray): 整個擷取檔的 uint8 陣列
+        payload_offsets, payload_lengths (np.ndarray): TCP payload 的起點與長度
+        is_request (np.ndarray): 是否為送往 server (OPC_PORT) 的封包, 決定 RequestHeader/ResponseHeader 的格式
+        connections (np.ndarray, optional): (n, k) 各封包的單向連線鍵值 (例如 IP、port), 用來區分不同連線的 message, 預設視為同一個連線
+        open_messages (set, optional): 見 message_starts, 分段解碼同一個擷取檔時每段傳入同一個集合
+
+    Returns:
+        dict: message_type (MESSAGE_TYPES 的索引), chunk_type (CHUNK_TYPES 的索引), secure_channel_id,
+              sequence_number, request_id, type_id (body 的 TypeId, 見 SERVICE_NAMES), request_handle, 無法解析的欄位為0
+    """
+    count = len(payload_offsets)
+    start = payload_offsets.astype(np.int64)
+    end = np.minimum(start + payload_lengths, len(buf))
+    has_header = start + 8 <= end
+
+    # Message header: MessageType(3) + ChunkType(1) + MessageSize(4)
+    type_bytes = _read_le(buf, start, 1, has_header) << 16 | _read_le(buf, start + 1, 1, has_header) << 8 | _read_le(buf, start + 2, 1, has_header)
+    message_type = np.zeros(count, dtype=np.int64)
+    for value, code in _code_lookup(_MESSAGE_TYPE_CODES, 3).items():
+        message_type[has_header & (type_bytes == value)] = code
+    chunk_byte = _read_le(buf, start + 3, 1, has_header)
+    chunk_type = np.zeros(count, dtype=np.int64)
+    for value, code in _code_lookup(_CHUNK_TYPE_CODES, 1).items():
+        chunk_type[(message_type != 0) & (chunk_byte == value)] = code
+
+    # SecureChannelId: OPN/MSG/CLO 才有
+    is_opn = message_type == MESSAGE_TYPES.index('OPN')
+    is_symmetric = (message_type == MESSAGE_TYPES.index('MSG')) | (message_type == MESSAGE_TYPES.index('CLO'))
+    has_channel = (is_opn | is_symmetric) & (start + 12 <= end)
+    secure_channel_id = _read_le(buf, start + 8, 4, has_channel)
+
+    # Security header: symmetric 為 TokenId, asymmetric 為 SecurityPolicyUri + SenderCertificate + ReceiverCertificateThumbprint
+    sequence_header = np.where(is_symmetric, start + 16, 0)
+    position, valid = start + 12, has_channel & is_opn
+    for _ in range(3):
+        position, valid = _skip_byte_string(buf, position, end, valid)
+    sequence_header = np.where(valid, position, sequence_header)
+    has_sequence = (valid | (has_channel & is_symmetric)) & (sequence_header + 8 <= end)
+    sequence_number = _read_le(buf, sequence_header, 4, has_sequence)
+    request_id = _read_le(buf, sequence_header + 4, 4, has_sequence)
+
+    # Body: TypeId + RequestHeader(AuthenticationToken, Timestamp, RequestHandle) 或 ResponseHeader(Timestamp, RequestHandle)
+    # 只有 message 第一個 Final/Continue chunk 的開頭是 body 的開始, 後續chunk的開頭是 body 中間的內容
+    has_body = has_sequence & ((chunk_type == CHUNK_TYPES.index('F')) | (chunk_type == CHUNK_TYPES.index('C')))
+    chunk_index = np.flatnonzero(has_sequence)
+    connections = np.zeros((count, 0), dtype=np.int64) if connections is None else np.asarray(connections, dtype=np.int64).reshape(count, -1)
+    message_keys = np.column_stack([connections, secure_channel_id, request_id])[chunk_index]
+    has_body[chunk_index] &= message_starts(message_keys, sequence_number[chunk_index], chunk_type[chunk_index], set() if open_messages is None else open_messages)
+    type_id = _numeric_node_id(buf, sequence_header + 8, end, has_body)
+    position, valid = _skip_node_id(buf, sequence_header + 8, end, has_body)
+    token_position, token_valid = _skip_node_id(buf, position, end, valid & is_request)
+    position = np.where(is_request, token_position, position) + 8
+    valid = np.where(is_request, token_valid, valid) & (position + 4 <= end)
+    request_handle = _read_le(buf, position, 4, valid)
+
+    return {
+        'message_type': message_type, 'chunk_type': chunk_type,
+        'secure_channel_id': secure_channel_id, 'sequence_number': sequence_number, 'request_id': request_id,
+        'type_id': type_id, 'request_handle': request_handle,
+    }
@@ -0,0 +1,850 @@
+import os
+import mmap
+import struct
+import socket
+import hashlib
+import tempfile
+import itertools
+import traceback
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+
+import opcua_decoder
+import flow_sampling
+
+#? 原生的 pcap/pcapng 解析器，取代 pyshark 逐封包解析
+#? 只解 Ethernet/IPv4/TCP 標頭 (外加少量OPC UA欄位)，結果放在 numpy structured array 中
+
+# 解碼邏輯或欄位有變動時需更新，讓舊的快取失效
+DECODER_VERSION = 5
+CACHE_DIR_NAME = '.capture_cache'
+
+# iter_capture_chunks 每段解碼的封包數
+CHUNK_PACKETS = 1 << 16
+
+# 每個封包解出來的欄位
+PACKET_DTYPE = np.dtype([
+    ('number', np.uint32),      # frame number, 與 Wireshark 相同從1開始
+    ('timestamp', np.float64),  # sniff timestamp (秒)
+    ('length', np.uint32),      # frame 原始長度
+    ('ip_proto', np.uint8),     # IPv4 protocol, 0代表非IPv4封包
+    ('src_ip', np.uint32),
+    ('dst_ip', np.uint32),
+    ('src_port', np.uint16),
+    ('dst_port', np.uint16),
+    ('flags', np.uint8),        # TCP flags (FIN, SYN, RST, PSH, ACK, URG, ECE, CWR)
+    ('seq', np.uint32),         # 相對 sequence number (同 Wireshark tcp.seq)
+    ('ack', np.uint32),         # 相對 acknowledgment number (同 Wireshark tcp.ack)
+    ('tcp_len', np.uint32),     # TCP segment 長度
+    ('ack_rtt', np.float64),    # 同 Wireshark tcp.analysis.ack_rtt, 沒有則為 NaN
+    ('opc_type', np.uint8),     # OPC UA message type, 對應 OPC_MESSAGE_TYPES
+    ('opc_chunk', np.uint8),    # OPC UA chunk type, 對應 opcua_decoder.CHUNK_TYPES
+    ('opc_channel', np.uint32), # OPC UA SecureChannelId, 0代表沒有
+    ('opc_seq', np.uint32),     # OPC UA SequenceNumber
+    ('opc_request_id', np.uint32), # OPC UA RequestId (sequence header)
+    ('opc_type_id', np.uint32), # OPC UA body 的 TypeId, 對應 opcua_decoder.SERVICE_NAMES
+    ('req_handle', np.uint32),  # OPC UA RequestHandle, 0代表沒有
+    ('sample_unit', np.uint32), # 抽樣分析時封包所屬的抽樣單位, 0代表一律保留 (沒有抽樣時都是0), 見 flow_sampling.sampling_mask
+    ('rtt_unit', np.uint32),    # 抽樣分析時 ack_rtt 樣本所屬的抽樣單位 (被確認的資料段的單位)
+])
+
+# TCP flags 位元
+FIN, SYN, RST, PSH, ACK, URG, ECE, CWR = (1 << bit for bit in range(8))
+
+OPC_PORT = opcua_decoder.OPC_PORT
+OPC_MESSAGE_TYPES = opcua_decoder.MESSAGE_TYPES
+
+# Link-layer types
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+
+_PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1e-6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e-6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e-9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e-9),
+}
+_PCAPNG_SHB = 0x0A0D0D0A
+
+def ip_to_str(ip):
+    """輔助函式, 將整數IPv4轉成字串
+    """
+    return socket.inet_ntoa(struct.pack('!I', int(ip)))
+
+def ip_to_int(ip):
+    """輔助函式, 將字串IPv4轉成整數
+    """
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+# PART 1: 走訪檔案中的封包紀錄
+# Python 迴圈只用 struct.unpack_from 讀出每筆紀錄的長度以找到下一筆, 不複製封包內容;
+# 紀錄標頭的其他欄位再以 numpy 從整個檔案的 uint8 陣列一次讀出, 每段填入預先配置的陣列
+def _gather(buf, positions, dtype, count):
+    """輔助函式, 從 buf 的多個位置各讀出 count 個連續的 dtype 數值
+
+    Returns:
+        np.ndarray: (len(positions), count)
+    """
+    dtype = np.dtype(dtype)
+    index = positions[:, None] + np.arange(count * dtype.itemsize)
+    return buf[index].view(dtype)
+
+def _record_chunk(offsets, caplens, origlens, timestamps, linktypes):
+    """輔助函式, 一段封包紀錄: 封包資料起點、擷取長度、原始長度、時間戳記、link type
+    """
+    return {'offset': offsets, 'caplen': caplens, 'origlen': origlens, 'timestamp': timestamps, 'linktype': linktypes}
+
+def _pcap_record_chunks(data, buf, chunk_size):
+    """走訪 classic pcap 的封包紀錄
+
+    Yields:
+        dict: _record_chunk, 每段最多 chunk_size 筆
+    """
+    endian, ts_unit = _PCAP_MAGIC[bytes(data[:4])]
+    linktype = struct.unpack_from(endian + 'I', data, 20)[0] & 0x0FFFFFFF
+    caplen_at = struct.Struct(endian + 'I').unpack_from
+    size = len(data)
+    offset = 24
+
+    while offset + 16 <= size:
+        positions = np.empty(chunk_size, dtype=np.int64)
+        count = 0
+        while count < chunk_size and offset + 16 <= size:
+            next_offset = offset + 16 + caplen_at(data, offset + 8)[0]
+            if next_offset > size: # 檔案被截斷 (例如擷取程式被中止), 最後一筆不完整的紀錄略過
+                size = offset
+                break
+            positions[count] = offset
+            offset = next_offset
+            count += 1
+
+        if count == 0:
+            break
+        positions = positions[:count]
+        ts_sec, ts_frac, caplens, origlens = _gather(buf, positions, endian + 'u4', 4).T.astype(np.int64)
+        yield _record_chunk(positions + 16, caplens, origlens, ts_sec + ts_frac * ts_unit, np.full(count, linktype, dtype=np.int64))
+
+def _pcapng_if_tsresol(data, endian, offset, end):
+    """輔助函式, 從 Interface Description Block 的 options 中取得時間解析度
+    """
+    while offset + 4 <= end:
+        code, length = struct.unpack_from(endian + 'HH', data, offset)
+        if code == 0: # opt_endofopt
+            break
+        if code == 9 and length >= 1: # if_tsresol
+            value = data[offset + 4]
+            return 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+        offset += 4 + ((length + 3) & ~3)
+
+    return 1e-6
+
+def _pcapng_packet_blocks(buf, bodies, block_types, big_endian, if_bases, interfaces):
+    """輔助函式, 一次讀出一段 pcapng 封包區塊 (EPB/SPB/PB) 的紀錄欄位
+    """
+    count = len(bodies)
+    offsets, caplens, origlens = (np.zeros(count, dtype=np.int64) for _ in range(3))
+    timestamps = np.zeros(count)
+    linktypes = np.zeros(count, dtype=np.int64)
+    if_linktypes, if_snaplens, if_units = (np.array(column) for column in zip(*interfaces)) if interfaces else (np.zeros(0),) * 3
+
+    for block_type in (6, 3, 2):
+        for big in (False, True):
+            selected = np.flatnonzero((block_types == block_type) & (big_endian == big))
+            if len(selected) == 0:
+                continue
+            endian = '>' if big else '<'
+            body = bodies[selected]
+
+            if block_type == 6: # Enhanced Packet Block
+                if_id, ts_high, ts_low, caplen, origlen = _gather(buf, body, endian + 'u4', 5).T.astype(np.int64)
+                offsets[selected] = body + 20
+            elif block_type == 3: # Simple Packet Block, 沒有時間戳記
+                if_id = np.zeros(len(body), dtype=np.int64)
+                origlen = _gather(buf, body, endian + 'u4', 1)[:, 0].astype(np.int64)
+                snaplen = if_snaplens[if_bases[selected]]
+                caplen = np.where(snaplen > 0, np.minimum(origlen, snaplen), origlen)
+                offsets[selected] = body + 4
+            else: # (obsolete) Packet Block
+                if_id = _gather(buf, body, endian + 'u2', 1)[:, 0].astype(np.int64)
+                ts_high, ts_low, caplen, origlen = _gather(buf, body + 4, endian + 'u4', 4).T.astype(np.int64)
+                offsets[selected] = body + 20
+
+            if_index = if_bases[selected] + if_id
+            caplens[selected] = caplen
+            origlens[selected] = origlen
+            linktypes[selected] = if_linktypes[if_index]
+            if block_type != 3:
+                timestamps[selected] = ((ts_high << 32) | ts_low) * if_units[if_index]
+
+    return _record_chunk(offsets, caplens, origlens, timestamps, linktypes)
+
+def _pcapng_record_chunks(data, buf, chunk_size):
+    """走訪 pcapng 的封包紀錄 (EPB/SPB/PB)
+
+    Yields:
+        dict: _record_chunk, 每段最多 chunk_size 筆
+    """
+    endian = '<'
+    interfaces = [] # 所有 Section 的 [(linktype, snaplen, ts_unit)], 以 if_base + interface id 取得
+    if_base = 0
+    size = len(data)
+    offset = 0
+
+    def new_chunk():
+        return np.empty(chunk_size, dtype=np.int64), np.empty(chunk_size, dtype=np.int64), np.empty(chunk_size, dtype=bool), np.empty(chunk_size, dtype=np.int64)
+    bodies, block_types, big_endian, if_bases = new_chunk()
+    count = 0
+
+    while offset + 12 <= size:
+        block_type = struct.unpack_from(endian + 'I', data, offset)[0]
+
+        if block_type == _PCAPNG_SHB: # 每個 Section 可能有不同的 byte order
+            endian = '<' if data[offset + 8:offset + 12] == b'\x4d\x3c\x2b\x1a' else '>'
+            if_base = len(interfaces)
+
+        block_len = struct.unpack_from(endian + 'I', data, offset + 4)[0]
+        if block_len < 12 or offset + block_len > size: # 檔案被截斷
+            break
+        body = offset + 8
+
+        if block_type == 1: # Interface Description Block
+            linktype, _, snaplen = struct.unpack_from(endian + 'HHI', data, body)
+            interfaces.append((linktype, snaplen, _pcapng_if_tsresol(data, endian, body + 8, offset + block_len - 4)))
+        elif block_type in (6, 3, 2): # Enhanced Packet Block, Simple Packet Block, (obsolete) Packet Block
+            bodies[count], block_types[count], big_endian[count], if_bases[count] = body, block_type, endian == '>', if_base
+            count += 1
+            if count == chunk_size:
+                yield _pcapng_packet_blocks(buf, bodies, block_types, big_endian, if_bases, interfaces)
+                bodies, block_types, big_endian, if_bases = new_chunk()
+                count = 0
+
+        offset += block_len
+
+    if count:
+        yield _pcapng_packet_blocks(buf, bodies[:count], block_types[:count], big_endian[:count], if_bases[:count], interfaces)
+
+def iter_record_chunks(data, chunk_size=CHUNK_PACKETS):
+    """依檔頭判斷 pcap/pcapng 並分段走訪封包紀錄
+
+    Args:
+        data (bytes | mmap.mmap): 整個擷取檔
+
+    Yields:
+        dict: 各欄位為 np.ndarray 的一段封包紀錄, 見 _record_chunk
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if bytes(data[:4]) in _PCAP_MAGIC:
+        yield from _pcap_record_chunks(data, buf, chunk_size)
+    elif len(data) >= 4 and struct.unpack_from('<I', data, 0)[0] == _PCAPNG_SHB:
+        yield from _pcapng_record_chunks(data, buf, chunk_size)
+    else:
+        raise ValueError('Unknown capture file format')
+
+# 封包紀錄加上 frame number 的陣列, 可以直接傳給 decode_records; 主程序依時間切分紀錄、交給子程序解碼時使用
+RECORD_DTYPE = np.dtype([
+    ('number', np.int64), ('offset', np.int64), ('caplen', np.int64), ('origlen', np.int64), ('timestamp', np.float64), ('linktype', np.int64),
+])
+
+def iter_record_arrays(data, chunk_size=CHUNK_PACKETS):
+    """分段走訪封包紀錄 (不解碼封包內容), 每段轉成 RECORD_DTYPE 陣列
+
+    Yields:
+        np.ndarray: RECORD_DTYPE 陣列
+    """
+    number = 1
+    for records in iter_record_chunks(data, chunk_size):
+        array = np.empty(len(records['offset']), dtype=RECORD_DTYPE)
+        array['number'] = np.arange(number, number + len(array))
+        for name, column in records.items():
+            array[name] = column
+        number += len(array)
+        yield array
+
+# PART 2: 向量化解碼標頭欄位
+def _read_be(buf, pos, size, valid):
+    """輔助函式, 從 buf 的多個位置讀取 big-endian 整數, 無效位置回傳0
+    """
+    pos = np.where(valid, pos, 0)
+    value = np.zeros(len(pos), dtype=np.int64)
+    for i in range(size):
+        value = (value << 8) | buf[pos + i]
+    return np.where(valid, value, 0)
+
+def decode_headers(buf, offsets, caplens, linktypes):
+    """解碼 Ethernet/IPv4/TCP 標頭
+
+    Args:
+        buf (np.ndarray): 整個擷取檔的 uint8 陣列
+        offsets, caplens, linktypes (np.ndarray): 每個封包的資料起點、擷取長度、link type
+
+    Returns:
+        dict: 欄位名稱 -> np.ndarray
+    """
+    n = len(offsets)
+    end = offsets + caplens
+
+    # Link layer
+    ethertype = np.zeros(n, dtype=np.int64)
+    l3 = offsets.copy()
+
+    is_eth = (linktypes == LINKTYPE_ETHERNET) & (caplens >= 14)
+    ethertype[is_eth] = _read_be(buf, offsets + 12, 2, is_eth)[is_eth]
+    l3[is_eth] += 14
+    is_vlan = is_eth & (ethertype == 0x8100) & (caplens >= 18)
+    ethertype[is_vlan] = _read_be(buf, offsets + 16, 2, is_vlan)[is_vlan]
+    l3[is_vlan] += 4
+
+    is_sll = (linktypes == LINKTYPE_LINUX_SLL) & (caplens >= 16)
+    ethertype[is_sll] = _read_be(buf, offsets + 14, 2, is_sll)[is_sll]
+    l3[is_sll] += 16
+
+    is_raw = (linktypes == LINKTYPE_RAW) & (caplens >= 1)
+    ethertype[is_raw] = np.where(_read_be(buf, offsets, 1, is_raw)[is_raw] >> 4 == 4, 0x0800, 0)
+
+    # IPv4
+    is_ip = (ethertype == 0x0800) & (l3 + 20 <= end)
+    ver_ihl = _read_be(buf, l3, 1, is_ip)
+    is_ip &= (ver_ihl >> 4) == 4
+    ihl = (ver_ihl & 0x0F) * 4
+    ip_total_len = _read_be(buf, l3 + 2, 2, is_ip)
+    frag = _read_be(buf, l3 + 6, 2, is_ip) & 0x1FFF
+    ip_proto = _read_be(buf, l3 + 9, 1, is_ip)
+    src_ip = _read_be(buf, l3 + 12, 4, is_ip)
+    dst_ip = _read_be(buf, l3 + 16, 4, is_ip)
+
+    # TCP/UDP
+    l4 = l3 + ihl
+    has_ports = is_ip & (frag == 0) & ((ip_proto == 6) | (ip_proto == 17)) & (l4 + 4 <= end)
+    src_port = _read_be(buf, l4, 2, has_ports)
+    dst_port = _read_be(buf, l4 + 2, 2, has_ports)
+
+    is_tcp = has_ports & (ip_proto == 6) & (l4 + 20 <= end)
+    seq = _read_be(buf, l4 + 4, 4, is_tcp)
+    ack = _read_be(buf, l4 + 8, 4, is_tcp)
+    tcp_hdr_len = (_read_be(buf, l4 + 12, 1, is_tcp) >> 4) * 4
+    flags = _read_be(buf, l4 + 13, 1, is_tcp)
+    tcp_len = np.where(is_tcp, np.maximum(ip_total_len - ihl - tcp_hdr_len, 0), 0)
+
+    return {
+        'ip_proto': np.where(is_ip & (is_tcp | (ip_proto != 6)), ip_proto, 0), # 無法解析的TCP封包 (分片或截斷) 視為非IP封包
+        'src_ip': src_ip, 'dst_ip': dst_ip,
+        'src_port': src_port, 'dst_port': dst_port,
+        'flags': flags, 'seq': seq, 'ack': ack, 'tcp_len': tcp_len,
+        'payload_offset': l4 + tcp_hdr_len,
+    }
+
+# 解碼前的篩選: 只看標頭欄位決定是否保留, 被略過的frame (background) 只計數, 不建立封包欄位也不解碼OPC UA
+def new_packet_filter(hosts=None, port=OPC_PORT, sampling=None):
+    """建立封包篩選條件: 只保留一端為 port、且一端為 hosts 之一的TCP封包
+
+    Args:
+        hosts ([int], optional): 目標主機IP (整數), None 代表不限主機
+        port (int): TCP埠, 預設為 OPC UA 的 4840
+        sampling (dict, optional): flow_sampling.new_sampling 的抽樣狀態, 符合條件的封包中只保留被抽中的封包
+
+    Returns:
+        dict: 篩選條件, 'background' 累計被略過的frame數, 'unsampled' 累計符合條件但沒有被抽中的封包數
+    """
+    return {'hosts': None if hosts is None else np.asarray(hosts, dtype=np.int64), 'port': port, 'sampling': sampling, 'background': 0, 'unsampled': 0}
+
+def restart_filter(packet_filter):
+    """輔助函式, 再走訪一次同一個擷取檔時使用的篩選條件: 計數從0開始, 抽樣狀態從檔案開頭開始 (與第一次選出相同的封包)
+    """
+    if packet_filter is None:
+        return None
+    return dict(packet_filter, background=0, unsampled=0, sampling=flow_sampling.restart(packet_filter['sampling']))
+
+def filter_mask(fields, packet_filter, buf, timestamps):
+    """輔助函式, decode_headers 的結果中哪些封包符合篩選條件, 有抽樣狀態時再依標頭抽樣 (見 flow_sampling.sampling_mask)
+
+    Returns:
+        np.ndarray: 符合條件的封包
+        np.ndarray: 其中被抽中的封包, 沒有抽樣時與前者相同
+        dict: 抽樣時各封包的 sample_unit 與 rtt_unit (見 PACKET_DTYPE), 沒有抽樣時為 None
+    """
+    port = packet_filter['port']
+    keep = (fields['ip_proto'] == 6) & ((fields['src_port'] == port) | (fields['dst_port'] == port))
+    if packet_filter['hosts'] is not None:
+        keep &= np.isin(fields['src_ip'], packet_filter['hosts']) | np.isin(fields['dst_ip'], packet_filter['hosts'])
+    if packet_filter['sampling'] is None:
+        return keep, keep, None
+    
+    index = np.flatnonzero(keep)
+    sampled = np.zeros_like(keep)
+    units = {name: np.zeros(len(keep), dtype=np.uint32) for name in ('sample_unit', 'rtt_unit')}
+    sampled[index], units['sample_unit'][index], units['rtt_unit'][index] = flow_sampling.sampling_mask(
+        buf, {name: column[index] for name, column in fields.items()}, timestamps[index], packet_filter['sampling'])
+    return keep, sampled, units
+
+def filter_key(packet_filter):
+    """輔助函式, 篩選條件的識別字串, 用於快取檔名
+    """
+    if packet_filter is None:
+        return ''
+    hosts = 'all' if packet_filter['hosts'] is None else ','.join(str(host) for host in sorted(packet_filter['hosts'].tolist()))
+    return '-' + hashlib.sha256(f"{hosts}:{packet_filter['port']}".encode()).hexdigest()[:16]
+
+# PART 3: TCP 分析欄位 (相對序號、ack_rtt)
+def new_tcp_state(bases=None, max_next_seq=None, unacked=None):
+    """建立TCP分析狀態, 讓 annotate_tcp_analysis 可以分段處理同一個擷取檔
+
+    Args:
+        bases (dict, optional): (src, dst) -> 相對序號起點, 由 scan_flow_bases 事先取得時,
+            反向flow尚未出現的封包也能算出與整檔解碼相同的相對ack
+        max_next_seq (dict, optional): (src, dst) -> 先前資料段最大的相對 next seq
+        unacked (dict, optional): (src, dst) -> 尚未被確認的資料段 deque([(相對 next seq, 時間)]);
+            與 max_next_seq 由 advance_tcp_state 取得時, 從擷取檔中間開始分析也能得到與整檔解碼相同的 ack_rtt 與重傳判斷
+    """
+    return {'bases': {} if bases is None else bases, 'unacked': {} if unacked is None else unacked, 'max_next_seq': {} if max_next_seq is None else max_next_seq}
+
+def _flow_keys(packets, tcp_index):
+    """輔助函式, 為每個TCP封包找出單向flow (src_ip<<16|src_port, dst_ip<<16|dst_port)
+
+    Returns:
+        ([(int, int)], np.ndarray, np.ndarray): 各flow、每個封包的flow編號、各flow第一個封包的位置
+    """
+    src = (packets['src_ip'][tcp_index].astype(np.uint64) << np.uint64(16)) | packets['src_port'][tcp_index].astype(np.uint64)
+    dst = (packets['dst_ip'][tcp_index].astype(np.uint64) << np.uint64(16)) | packets['dst_port'][tcp_index].astype(np.uint64)
+
+    # 依 (src, dst) 穩定排序後分組, 與 np.unique(axis=0) 的結果相同但快很多
+    order = np.lexsort((dst, src))
+    sorted_src, sorted_dst = src[order], dst[order]
+    is_first = np.concatenate(([True], (sorted_src[1:] != sorted_src[:-1]) | (sorted_dst[1:] != sorted_dst[:-1])))
+    flow_id = np.empty(len(order), dtype=np.int64)
+    flow_id[order] = np.cumsum(is_first) - 1
+    return list(zip(sorted_src[is_first].tolist(), sorted_dst[is_first].tolist())), flow_id, order[is_first]
+
+def _first_bases(packets, tcp_index, first_index):
+    """輔助函式, 以各flow第一個封包計算相對序號起點 (SYN為其seq, 否則為seq-1)
+    """
+    first = tcp_index[first_index]
+    return (packets['seq'][first].astype(np.int64) - np.where(packets['flags'][first] & SYN, 0, 1)).tolist()
+
+def _relative_numbers(columns, tcp_index, flows, flow_id, first_index, bases):
+    """輔助函式, 以各flow的相對序號起點計算相對 seq/ack, 還沒有起點的flow以其第一個封包記錄 (bases 會直接更新)
+
+    Args:
+        columns (np.ndarray | dict): 封包陣列或 decode_headers 的結果, 使用 flags/seq/ack 欄位 (原始值)
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray): TCP封包的 flags、相對seq、相對ack
+    """
+    base = np.array([bases.setdefault(flow, first_base) for flow, first_base in zip(flows, _first_bases(columns, tcp_index, first_index))], dtype=np.int64)
+
+    flags = columns['flags'][tcp_index].astype(np.int64)
+    raw_seq = columns['seq'][tcp_index].astype(np.int64)
+    raw_ack = columns['ack'][tcp_index].astype(np.int64)
+
+    has_reverse = np.array([(dst, src) in bases for src, dst in flows], dtype=bool)[flow_id]
+    reverse_base = np.array([bases.get((dst, src), 0) for src, dst in flows], dtype=np.int64)[flow_id]
+    rev_base = np.where(has_reverse, reverse_base, raw_ack - 1)
+
+    seq = (raw_seq - base[flow_id]) % (1 << 32)
+    ack = np.where(flags & ACK, (raw_ack - rev_base) % (1 << 32), 0)
+    return flags, seq, ack
+
+def annotate_tcp_analysis(packets, state=None):
+    """計算 Wireshark 預設的相對序號與 tcp.analysis.ack_rtt
+
+    相對序號的起點為每個方向第一個封包 (SYN為其seq, 否則為seq-1);
+    ack_rtt 為 ACK 封包與其剛好確認的資料封包之間的時間差
+
+    Args:
+        packets (np.ndarray): 依順序的一段封包, seq/ack 為原始值, 會直接更新
+        state (dict, optional): new_tcp_state 建立的狀態, 分段處理時每段傳入同一個狀態
+    """
+    state = new_tcp_state() if state is None else state
+    tcp_index = np.flatnonzero(packets['ip_proto'] == 6)
+    if len(tcp_index) == 0:
+        return
+
+    flows, flow_id, first_index = _flow_keys(packets, tcp_index)
+    flags, seq, ack = _relative_numbers(packets, tcp_index, flows, flow_id, first_index, state['bases'])
+    packets['seq'][tcp_index] = seq
+    packets['ack'][tcp_index] = ack
+
+    # ack_rtt: 每個方向只記錄往前推進的資料段 (nextseq 遞增), 重傳的資料段不列入
+    timestamps = packets['timestamp'][tcp_index].tolist()
+    next_seq = (seq + packets['tcp_len'][tcp_index] + ((flags & (SYN | FIN)) != 0)).tolist()
+    is_segment = (packets['tcp_len'][tcp_index] > 0) | ((flags & (SYN | FIN)) != 0)
+
+    unacked = [state['unacked'].setdefault(flow, deque()) for flow in flows]
+    reverse_unacked = [state['unacked'].get((dst, src)) for src, dst in flows]
+    max_next_seq = [state['max_next_seq'].get(flow, -1) for flow in flows]
+    ack_rtt = packets['ack_rtt']
+
+    for i, (fid, flag, ack_value, segment) in enumerate(zip(flow_id.tolist(), flags.tolist(), ack.tolist(), is_segment.tolist())):
+        pending = reverse_unacked[fid]
+        if flag & ACK and pending is not None:
+            while pending and pending[0][0] <= ack_value:
+                acked_seq, acked_time = pending.popleft()
+                if acked_seq == ack_value:
+                    ack_rtt[tcp_index[i]] = timestamps[i] - acked_time
+
+        if segment and next_seq[i] > max_next_seq[fid]:
+            max_next_seq[fid] = next_seq[i]
+            unacked[fid].append((next_seq[i], timestamps[i]))
+
+    state['max_next_seq'].update(zip(flows, max_next_seq))
+
+# PART 4: OPC UA 欄位
+def _decode_opcua_headers(buf, columns, payload_offsets, open_messages=None):
+    """輔助函式, 以 opcua_decoder 解碼 OPC_PORT 上 TCP payload 至少8 bytes 的封包
+
+    Args:
+        columns (np.ndarray | dict): 封包陣列或 decode_headers 的結果
+
+    Returns:
+        (np.ndarray, dict): 解碼的封包位置, opcua_decoder.decode_headers 的結果 (沒有這類封包時為 None)
+    """
+    candidates = np.flatnonzero(
+        (columns['ip_proto'] == 6) & (columns['tcp_len'] >= 8) &
+        ((columns['src_port'] == OPC_PORT) | (columns['dst_port'] == OPC_PORT))
+    )
+    if len(candidates) == 0:
+        return candidates, None
+
+    connections = np.column_stack([columns[name][candidates] for name in ('src_ip', 'src_port', 'dst_ip', 'dst_port')])
+    return candidates, opcua_decoder.decode_headers(buf, payload_offsets[candidates], columns['tcp_len'][candidates].astype(np.int64),
+                                                    columns['dst_port'][candidates] == OPC_PORT, connections, open_messages)
+
+def decode_opcua_fields(data, packets, payload_offsets, open_messages=None):
+    """以 opcua_decoder 從 OPC_PORT 上的 TCP payload 解出 OPC UA 標頭欄位
+
+    Args:
+        open_messages (set, optional): 尚未結束的多chunk message, 分段解碼時每段傳入同一個集合 (見 opcua_decoder.message_starts)
+    """
+    candidates, fields = _decode_opcua_headers(np.frombuffer(data, dtype=np.uint8), packets, payload_offsets, open_messages)
+    if fields is None:
+        return
+    for name, field in (('opc_type', 'message_type'), ('opc_chunk', 'chunk_type'), ('opc_channel', 'secure_channel_id'),
+                        ('opc_seq', 'sequence_number'), ('opc_request_id', 'request_id'), ('opc_type_id', 'type_id'),
+                        ('req_handle', 'request_handle')):
+        packets[name][candidates] = fields[field]
+
+# 主要介面
+@contextmanager
+def map_capture(capture_file):
+    """以唯讀 mmap 開啟擷取檔
+
+    發生例外時先清除 traceback 中各 frame 的區域變數 (指向 mmap 的 numpy view), mmap 才能關閉,
+    否則關閉時的 BufferError 會蓋掉原本的例外
+    """
+    with open(capture_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            yield data
+        except BaseException as e:
+            traceback.clear_frames(e.__traceback__)
+            raise
+
+def decode_records(data, records, first_number=1, packet_filter=None, open_messages=None):
+    """將一段封包紀錄解碼成 PACKET_DTYPE 陣列, seq/ack 仍為原始值 (見 annotate_tcp_analysis)
+
+    Args:
+        data (bytes | mmap.mmap): 整個擷取檔
+        records (dict): iter_record_chunks 的一段封包紀錄
+        first_number (int): 第一筆紀錄的 frame number
+        packet_filter (dict, optional): new_packet_filter 的篩選條件, 只回傳符合的封包 (frame number 不變)
+        open_messages (set, optional): 分段解碼同一個擷取檔時每段傳入同一個集合, 見 decode_opcua_fields
+    """
+    count = len(records['offset'])
+    if count == 0:
+        return np.zeros(0, dtype=PACKET_DTYPE)
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    fields = decode_headers(buf, records['offset'], records['caplen'], records['linktype'])
+    numbers, timestamps, lengths = np.arange(first_number, first_number + count), records['timestamp'], records['origlen']
+    if packet_filter is not None:
+        matched, keep, units = filter_mask(fields, packet_filter, buf, timestamps)
+        packet_filter['background'] += count - int(np.count_nonzero(matched))
+        if units is not None:
+            packet_filter['unsampled'] += int(np.count_nonzero(matched)) - int(np.count_nonzero(keep))
+            flow_sampling.count_packets({name: column[matched] for name, column in fields.items()}, timestamps[matched], numbers[matched], packet_filter['sampling'])
+            fields.update(units)
+        fields = {name: column[keep] for name, column in fields.items()}
+        numbers, timestamps, lengths = numbers[keep], timestamps[keep], lengths[keep]
+
+    packets = np.zeros(len(numbers), dtype=PACKET_DTYPE)
+    packets['number'] = numbers
+    packets['timestamp'] = timestamps
+    packets['length'] = lengths
+    packets['ack_rtt'] = np.nan
+
+    for name in ('ip_proto', 'src_ip', 'dst_ip', 'src_port', 'dst_port', 'flags', 'seq', 'ack', 'tcp_len', 'sample_unit', 'rtt_unit'):
+        if name in fields:
+            packets[name] = fields[name]
+
+    decode_opcua_fields(data, packets, fields['payload_offset'], open_messages)
+
+    return packets
+
+def read_capture(capture_file, chunk_size=CHUNK_PACKETS, packet_filter=None):
+    """以 mmap 讀取整個 pcap/pcapng 檔, 每個 frame 一筆
+
+    Args:
+        packet_filter (dict, optional): new_packet_filter 的篩選條件, 只保留符合的封包
+
+    Returns:
+        np.ndarray: PACKET_DTYPE 陣列
+    """
+    if os.path.getsize(capture_file) == 0:
+        return np.zeros(0, dtype=PACKET_DTYPE)
+
+    chunks = []
+    number = 1
+    open_messages = set()
+    with map_capture(capture_file) as data:
+        record_chunks = iter_record_chunks(data, chunk_size)
+        try:
+            for records in record_chunks:
+                chunks.append(decode_records(data, records, number, packet_filter, open_messages))
+                number += len(records['offset'])
+        finally:
+            record_chunks.close()
+
+    packets = np.concatenate(chunks) if chunks else np.zeros(0, dtype=PACKET_DTYPE)
+    annotate_tcp_analysis(packets)
+
+    return packets
+
+def update_flow_bases(data, records, bases, packet_filter=None):
+    """記錄一段封包紀錄中每個單向flow的相對序號起點 (有篩選條件時只記錄符合的flow), 已記錄過的flow不變
+
+    Args:
+        records (dict): iter_record_chunks 的一段封包紀錄, 需依檔案中的順序傳入
+        bases (dict): (src, dst) -> 相對序號起點, 會直接更新
+
+    Returns:
+        [(int, int)]: 這段紀錄中出現的flow
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    fields = decode_headers(buf, records['offset'], records['caplen'], records['linktype'])
+    tcp_index = np.flatnonzero((fields['ip_proto'] == 6) if packet_filter is None else filter_mask(fields, packet_filter, buf, records['timestamp'])[1])
+    if len(tcp_index) == 0:
+        return []
+
+    flows, flow_id, first_index = _flow_keys(fields, tcp_index)
+    for flow, base in zip(flows, _first_bases(fields, tcp_index, first_index)):
+        bases.setdefault(flow, base)
+    return flows
+
+def advance_tcp_state(data, records, state, packet_filter=None, open_messages=None):
+    """只解標頭, 將 annotate_tcp_analysis 的狀態推進到這段封包紀錄之後 (不計算 ack_rtt), 有 open_messages 時一併更新尚未結束的多chunk message;
+    結果與 decode_records + annotate_tcp_analysis 處理同一段封包後的狀態相同, 從下一段封包開始分析不需要先解碼之前的封包
+
+    unacked 的計算: 往前推進的資料段 (next seq 大於同一flow先前的最大值) 會被加入, 之後反向flow的ACK只要 ack 不小於其 next seq 就會移除,
+    因此留下的是之後的 ack 都比它小的資料段
+
+    Args:
+        records (dict): iter_record_chunks 的一段封包紀錄, 需依檔案中的順序傳入
+        state (dict): new_tcp_state 建立的狀態, 會直接更新; unacked 中有變動的flow換成新的 deque (不修改原本的 deque), 沒有資料段的flow不保留
+        packet_filter (dict, optional): new_packet_filter 的篩選條件 (與 decode_records 相同), 有抽樣狀態時會一併更新
+        open_messages (set, optional): 見 decode_opcua_fields
+
+    Returns:
+        [(int, int)]: 這段紀錄中出現的flow
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    fields = decode_headers(buf, records['offset'], records['caplen'], records['linktype'])
+    timestamps = records['timestamp']
+    if packet_filter is not None:
+        keep = filter_mask(fields, packet_filter, buf, timestamps)[1]
+        fields = {name: column[keep] for name, column in fields.items()}
+        timestamps = timestamps[keep]
+    if open_messages is not None:
+        _decode_opcua_headers(buf, fields, fields['payload_offset'], open_messages)
+
+    tcp_index = np.flatnonzero(fields['ip_proto'] == 6)
+    if len(tcp_index) == 0:
+        return []
+    flows, flow_id, first_index = _flow_keys(fields, tcp_index)
+    flags, seq, ack = _relative_numbers(fields, tcp_index, flows, flow_id, first_index, state['bases'])
+    next_seq = seq + fields['tcp_len'][tcp_index] + ((flags & (SYN | FIN)) != 0)
+    is_segment = (fields['tcp_len'][tcp_index] > 0) | ((flags & (SYN | FIN)) != 0)
+
+    # 依flow排列 (同一個flow內維持順序), 加上 flow編號<<34 的偏移量後一次 maximum.accumulate 即為各flow內的累計最大值
+    count, flow_count = len(tcp_index), len(flows)
+    order = np.argsort(flow_id, kind='stable')
+    sorted_flow = flow_id[order]
+    group_start = np.concatenate(([True], sorted_flow[1:] != sorted_flow[:-1]))
+    offset = sorted_flow << 34
+    prior_max = np.array([state['max_next_seq'].get(flow, -1) for flow in flows], dtype=np.int64)[sorted_flow]
+    running = np.maximum(np.maximum.accumulate(offset + np.where(is_segment, next_seq, -1)[order]) - offset, prior_max)
+    previous = np.where(group_start, prior_max, np.concatenate(([-1], running[:-1])))
+    is_new = is_segment[order] & (next_seq[order] > previous)
+    group_end = np.append(np.flatnonzero(group_start)[1:], count) - 1
+    state['max_next_seq'].update(zip([flows[i] for i in sorted_flow[group_end].tolist()], running[group_end].tolist()))
+
+    # 各flow的ACK (依flow、位置排列) 之後的最大 ack: 反向累計最大值, 偏移量讓編號小的flow在反向時較大
+    is_ack = ((flags & ACK) != 0)[order]
+    ack_flow, ack_position, ack_value = sorted_flow[is_ack], order[is_ack], ack[order][is_ack]
+    ack_offset = (flow_count - ack_flow) << 34
+    later_max = np.maximum.accumulate((ack_offset + ack_value)[::-1])[::-1] - ack_offset
+    ack_keys = ack_flow * (count + 1) + ack_position
+    flow_index = {flow: i for i, flow in enumerate(flows)}
+    reverse = np.array([flow_index.get((dst, src), -1) for src, dst in flows], dtype=np.int64)
+
+    def max_ack_after(acking_flow, position):
+        """輔助函式, 各 acking_flow (flow編號, -1 代表不在這段紀錄中) 在 position 之後的ACK中最大的 ack, 沒有時為 -1
+        """
+        if len(ack_keys) == 0:
+            return np.full(len(acking_flow), -1, dtype=np.int64)
+        k = np.searchsorted(ack_keys, acking_flow * (count + 1) + position, side='right')
+        clipped = np.minimum(k, len(ack_keys) - 1)
+        found = (acking_flow >= 0) & (k < len(ack_keys)) & (ack_flow[clipped] == acking_flow)
+        return np.where(found, later_max[clipped], -1)
+
+    # 之前留下的資料段: 這段紀錄中反向flow所有ACK的最大 ack
+    unacked = state['unacked']
+    for acking_flow, (src, dst) in enumerate(flows):
+        pending = unacked.get((dst, src))
+        if pending:
+            max_ack = int(max_ack_after(np.array([acking_flow]), np.array([-1]))[0])
+            if pending[0][0] <= max_ack:
+                unacked[(dst, src)] = deque(entry for entry in pending if entry[0] > max_ack)
+
+    # 這段紀錄中新增的資料段: 之後反向flow的ACK的最大 ack
+    new_index = np.flatnonzero(is_new)
+    new_flow = sorted_flow[new_index]
+    remaining = next_seq[order][new_index] > max_ack_after(reverse[new_flow], order[new_index])
+    new_index, new_flow = new_index[remaining], new_flow[remaining]
+    entries = zip(next_seq[order][new_index].tolist(), timestamps[tcp_index][order][new_index].tolist())
+    for fid, group in itertools.groupby(zip(new_flow.tolist(), entries), key=lambda item: item[0]):
+        unacked[flows[fid]] = deque([*unacked.get(flows[fid], ()), *(entry for _, entry in group)])
+
+    for flow in [*flows, *((dst, src) for src, dst in flows)]:
+        if flow in unacked and not unacked[flow]:
+            del unacked[flow]
+    return flows
+
+def scan_flow_bases(data, chunk_size=CHUNK_PACKETS, packet_filter=None):
+    """先走訪一次擷取檔, 只記錄每個單向flow的相對序號起點 (有篩選條件時只記錄符合的flow)
+
+    Returns:
+        dict: (src, dst) -> 相對序號起點, 供 new_tcp_state 使用
+    """
+    bases = {}
+    for records in iter_record_chunks(data, chunk_size):
+        update_flow_bases(data, records, bases, packet_filter)
+    return bases
+
+def iter_capture_chunks(capture_file, chunk_size=CHUNK_PACKETS, packet_filter=None):
+    """以 mmap 逐段解碼擷取檔, 記憶體用量只和單段封包數與flow數有關, 與擷取檔長度無關
+
+    結果與 read_capture 相同, 只是每次最多回傳 chunk_size 個 frame (有篩選條件時為其中符合的封包)
+
+    Yields:
+        np.ndarray: PACKET_DTYPE 陣列
+    """
+    if os.path.getsize(capture_file) == 0:
+        return
+
+    with map_capture(capture_file) as data:
+        tcp_state = new_tcp_state(scan_flow_bases(data, chunk_size, restart_filter(packet_filter)))
+        record_chunks = iter_record_chunks(data, chunk_size)
+        number = 1
+        open_messages = set()
+
+        try:
+            for records in record_chunks:
+                packets = decode_records(data, records, number, packet_filter, open_messages)
+                annotate_tcp_analysis(packets, tcp_state)
+                number += len(records['offset'])
+                yield packets
+        finally:
+            record_chunks.close() # 先釋放對 mmap 的參考, mmap 才能關閉
+
+def capture_start_time(capture_file):
+    """只讀取擷取檔第一個 frame 的時間戳記, 用來對齊同一個scenario中各擷取檔的時間間隔
+
+    Returns:
+        float: epoch 秒, 擷取檔沒有任何 frame 時回傳 None
+    """
+    if os.path.getsize(capture_file) == 0:
+        return None
+
+    with map_capture(capture_file) as data:
+        record_chunks = iter_record_chunks(data, 1)
+        try:
+            records = next(record_chunks, None)
+            return float(records['timestamp'][0]) if records is not None and len(records['timestamp']) else None
+        finally:
+            record_chunks.close()
+
+# 解碼結果快取
+def capture_hash(capture_file, chunk_size=1 << 20):
+    """計算擷取檔內容的 sha256
+    """
+    digest = hashlib.sha256()
+    with open(capture_file, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_path(capture_file, cache_dir=None, packet_filter=None):
+    """輔助函式, 取得擷取檔對應的快取檔路徑, 預設放在擷取檔旁的 .capture_cache 資料夾, 不同篩選條件分開快取
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(capture_file)), CACHE_DIR_NAME)
+    return os.path.join(cache_dir, f'{capture_hash(capture_file)}-v{DECODER_VERSION}{filter_key(packet_filter)}.npz')
+
+def save_cache(packets, path, background=0):
+    """以欄位為單位存成 .npz, 先寫入暫存檔再更名, 避免平行執行時讀到寫一半的檔案
+
+    Args:
+        background (int): 篩選時略過的frame數
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            np.savez(file, background=background, **{name: packets[name] for name in PACKET_DTYPE.names})
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def load_cache(path, packet_filter=None, allocate=None):
+    """載入快取, 並將快取中記錄的略過frame數加到 packet_filter
+
+    Args:
+        allocate (callable, optional): allocate(封包數) 回傳要寫入的 PACKET_DTYPE 陣列 (例如 shared memory 上的 view), 預設為新的陣列
+    """
+    with np.load(path) as columns:
+        count = len(columns['number'])
+        packets = np.empty(count, dtype=PACKET_DTYPE) if allocate is None else allocate(count)
+        for name in PACKET_DTYPE.names:
+            packets[name] = columns[name]
+        background = int(columns['background']) if 'background' in columns.files else 0
+    if packet_filter is not None:
+        packet_filter['background'] += background
+    return packets
+
+def load_capture(capture_file, cache_dir=None, use_cache=True, packet_filter=None):
+    """讀取擷取檔, 若已有相同內容、解碼版本與篩選條件的快取則直接載入
+
+    Args:
+        capture_file (str): 擷取封包檔案路徑
+        cache_dir (str, optional): 快取資料夾, 預設為擷取檔旁的 .capture_cache
+        use_cache (bool): False 時一律重新解碼且不寫入快取
+        packet_filter (dict, optional): new_packet_filter 的篩選條件, 只保留符合的封包; 有抽樣狀態時不使用快取 (快取一律是完整的解碼結果)
+
+    Returns:
+        np.ndarray: PACKET_DTYPE 陣列
+    """
+    if not use_cache or (packet_filter is not None and packet_filter['sampling'] is not None):
+        return read_capture(capture_file, packet_filter=packet_filter)
+
+    path = cache_path(capture_file, cache_dir, packet_filter)
+    if os.path.exists(path):
+        try:
+            return load_cache(path, packet_filter)
+        except (OSError, ValueError, KeyError): # 快取損毀或欄位不符, 重新解碼
+            pass
+
+    background = 0 if packet_filter is None else packet_filter['background']
+    packets = read_capture(capture_file, packet_filter=packet_filter)
+    save_cache(packets, path, 0 if packet_filter is None else packet_filter['background'] - background)
+    return packets
@@ -0,0 +1,59 @@
+import traceback
+import numpy as np
+from multiprocessing import shared_memory
+
+import pcap_reader
+
+#? 主程序與分析子程序之間以 shared memory 傳遞解碼後的封包陣列
+#? 主程序把封包直接寫入 shared memory (不先建立私有陣列再複製)，子程序只收到 descriptor (名稱與筆數)，直接在同一塊記憶體上建立 numpy view，不經過 pickle
+#? 關閉 shared memory 前必須先釋放所有由它建立的 view, 否則 close() 會引發 BufferError, 因此 view 只在 apply_to_packets 呼叫的函式內存在
+
+def create_packets(count):
+    """建立可容納 count 個封包的 shared memory
+
+    Returns:
+        SharedMemory: 由建立者在子程序都處理完後 release
+        dict: 給子程序 apply_to_packets 的 descriptor
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(count * pcap_reader.PACKET_DTYPE.itemsize, 1))
+    return shm, {'name': shm.name, 'count': count}
+
+def load_cache(path, packet_filter=None):
+    """將 pcap_reader 的快取直接載入新的 shared memory
+
+    Returns:
+        SharedMemory, dict: 見 create_packets
+    """
+    blocks = []
+    def allocate(count):
+        blocks.append(create_packets(count))
+        return np.ndarray((count,), dtype=pcap_reader.PACKET_DTYPE, buffer=blocks[-1][0].buf)
+
+    try:
+        pcap_reader.load_cache(path, packet_filter, allocate) # 不保留回傳的 view
+    except BaseException as e:
+        traceback.clear_frames(e.__traceback__) # traceback 中的 frame 仍指向 view
+        for shm, _ in blocks:
+            release(shm)
+        raise
+    return blocks[0]
+
+def apply_to_packets(descriptor, function, *args):
+    """依 descriptor 取得 shared memory 中的封包陣列 (不複製), 回傳 function(packets, *args)
+
+    function 結束後 (包括發生例外時) 才關閉 shared memory, 回傳值不可包含封包陣列的 view
+    """
+    shm = shared_memory.SharedMemory(name=descriptor['name'])
+    try:
+        return function(np.ndarray((descriptor['count'],), dtype=pcap_reader.PACKET_DTYPE, buffer=shm.buf), *args)
+    except BaseException as e:
+        traceback.clear_frames(e.__traceback__) # 例外保留的 frame 仍指向 view, 先清除才能關閉
+        raise
+    finally:
+        shm.close()
+
+def release(shm):
+    """建立者釋放 shared memory
+    """
+    shm.close()
+    shm.unlink()
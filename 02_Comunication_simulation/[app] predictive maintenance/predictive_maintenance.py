@@ -1,11 +1,16 @@
 import os
 import re
+import sys
 import asyncio
 import asyncua
 import logging
-import time
 from asyncua import ua, Client
 
+# 共用模組的唯一原始檔在上一層的 02_Comunication_simulation (image 中與app一起複製到 /app)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tick_scheduler
+import latency_stats
+
 _logger = logging.getLogger(__name__)
 
 # Node IDs
@@ -20,53 +25,104 @@ Node_Dict = {
 }
 
 polling_interval = 0.1 # seconds
+access_mode = 'polling' # 'polling' 或 'subscription', 可由環境變數 PM_ACCESS_MODE 覆寫
+tick_policy = 'skip' # 讀取超過一個週期時錯過的tick: 'skip' 略過, 'coalesce' 合併成一個立即觸發
 
-async def read_values(client, node_ids):
-    return [await client.get_node(node_id).read_value() for node_id in node_ids]
+# polling 模式每個tick讀取的節點 #TODO CmdTorque, ActOverride, CmdOverride 讀取不到值
+Polling_Nodes = ['ActLoad', 'ActTorque', 'InitialOperationDate', 'AlarmIdentifier']
+# latency_stats 的節點群組: 每次 Read 讀取 Polling_Nodes, subscription 監控 Node_Dict 的所有節點
+Polling_Group = latency_stats.node_group(Polling_Nodes)
+Monitored_Group = latency_stats.node_group(Node_Dict)
 
-async def main(server_urls):
-    tasks = [server_task(url) for url in server_urls]
-    await asyncio.gather(*tasks)
+def build_read_parameters(node_names):
+    """預先建立 Read service 的參數 (ReadValueId 列表), 每個tick重複使用
+    """
+    parameters = ua.ReadParameters()
+    for name in node_names:
+        read_value_id = ua.ReadValueId()
+        read_value_id.NodeId = Node_Dict[name]
+        read_value_id.AttributeId = ua.AttributeIds.Value
+        parameters.NodesToRead.append(read_value_id)
+    return parameters
+
+Read_Parameters = build_read_parameters(Polling_Nodes)
+
+async def read_values(client, read_parameters):
+    """以單一 Read service 讀取多個節點
+
+    Returns:
+        [ua.DataValue]: 依 NodesToRead 順序, 讀取失敗的節點 StatusCode 不為 Good (不會拋出例外)
+    """
+    return await client.uaclient.read(read_parameters)
+
+async def poll_nodes(client, url):
+    """polling 模式: 每個tick以一次 Read service 讀取 Polling_Nodes 的值, tick 由 tick_scheduler 在固定格線上觸發
+    """
+    loop = asyncio.get_running_loop()
+    scheduler = tick_scheduler.TickScheduler(polling_interval, tick_policy, url)
+    async for _ in scheduler.ticks():
+        start_time = loop.time()
+        data_values = await read_values(client, Read_Parameters)
+        latency_stats.record('read', url, Polling_Group, (loop.time() - start_time) * 1000)
+        
+        for name, data_value in zip(Polling_Nodes, data_values):
+            if data_value.StatusCode.is_good():
+                _logger.info("%s: %s", name, data_value.Value.Value)
+            else:
+                _logger.warning("%s: %s", name, data_value.StatusCode)
+
+class DataChangeHandler:
+    """subscription 模式: 接收 monitored item 的資料變化通知
+    """
+    def __init__(self, url):
+        self.url = url
+        self.node_names = {node_id: name for name, node_id in Node_Dict.items()}
+        self.initialized_items = set() # 已收到第一個通知的 monitored item
+    
+    def datachange_notification(self, node, val, data):
+        # 第一個通知是訂閱當下的現值 (時間戳記為上次變化), 不計入通知的資料年齡
+        if data.subscription_data.client_handle in self.initialized_items:
+            latency_stats.record_notification(self.url, Monitored_Group, data.monitored_item.Value)
+        self.initialized_items.add(data.subscription_data.client_handle)
+        _logger.info("%s: %s", self.node_names.get(node.nodeid, node.nodeid), val)
+    
+    def status_change_notification(self, status):
+        _logger.warning(f"Subscription status at {self.url}: {status}")
+
+async def monitor_nodes(client, url):
+    """subscription 模式: 每個server建立一個subscription, Node_Dict 的所有節點都是 monitored item, 取樣與發布間隔皆為 polling_interval
+    """
+    subscription = await client.create_subscription(polling_interval * 1000, DataChangeHandler(url))
+    handles = await subscription.subscribe_data_change([client.get_node(node_id) for node_id in Node_Dict.values()], sampling_interval=polling_interval * 1000)
+    for name, handle in zip(Node_Dict, handles):
+        if isinstance(handle, ua.StatusCode): # 無法監控的節點不影響其他節點
+            _logger.warning(f"Cannot monitor {name} at {url}: {handle}")
     
-async def server_task(url):
+    while True:
+        await asyncio.sleep(1)
+        await client.check_connection() # 連線中斷時拋出例外, 由 server_task 重新連線
+
+async def server_task(url, access_mode, connect=Client):
+    loop = asyncio.get_running_loop()
+    disconnected_at = None # 連線中斷的時間, 用來計算重新連線所需時間
+    group = Monitored_Group if access_mode == 'subscription' else Polling_Group
     while True:
         try:
-            async with Client(url=url) as client:
+            async with connect(url=url) as client: # wrapper.py 開啟 SHARE_SESSIONS 時, connect 與其他app共用同一個server的連線
                 _logger.info(f"Connected to Server at {url}")
+                if disconnected_at is not None:
+                    latency_stats.record('reconnect', url, group, (loop.time() - disconnected_at) * 1000)
+                    disconnected_at = None
                 
-                while True:
-            
-                    start_time = time.time()
-                
-                    actual_load = await client.get_node(Node_Dict['ActLoad']).read_value()
-                    _logger.info("ActLoad: %s", actual_load)
-                    
-                    actual_torque = await client.get_node(Node_Dict['ActTorque']).read_value()
-                    _logger.info("ActTorque: %s", actual_torque)
-                    
-                    #TODO 這邊有問題，讀取不到值
-                    # command_torque = await client.get_node(Node_Dict['CmdTorque']).read_value()
-                    # _logger.info("CmdTorque: %s", command_torque)
-                    
-                    # actual_override = await client.get_node(Node_Dict['ActOverride']).read_value()
-                    # _logger.info("ActOverride: %s", actual_override)
-                    
-                    # command_override = await client.get_node(Node_Dict['CmdOverride']).read_value()
-                    # _logger.info("CmdOverride: %s", command_override)
-                    
-                    initial_operation_date = await client.get_node(Node_Dict['InitialOperationDate']).read_value()
-                    _logger.info("InitialOperationDate: %s", initial_operation_date)
-                    
-                    alarm_identifier = await client.get_node(Node_Dict['AlarmIdentifier']).read_value()
-                    _logger.info("AlarmIdentifier: %s", alarm_identifier)
-                    
-                    elapsed = time.time() - start_time
-                    sleep_time = max(polling_interval - elapsed, 0)
-                    
-                    await asyncio.sleep(sleep_time) # 大概還會誤差0.01秒
+                if access_mode == 'subscription':
+                    await monitor_nodes(client, url)
+                else:
+                    await poll_nodes(client, url)
                 
         except (OSError, asyncua.ua.uaerrors._base.UaError, asyncio.TimeoutError) as e:
             _logger.error(f"Connection failed: {e}")
+            if disconnected_at is None:
+                disconnected_at = loop.time()
             _logger.info("Attempting to reconnect in 5 seconds...")
             await asyncio.sleep(5)
         
@@ -74,7 +130,7 @@ async def server_task(url):
             _logger.exception("An unexpected error occurred: ", exc_info=e)
             break
 
-async def main():    
+async def main(connect=Client):    
     # read env variables from file
     # with open('env_variables.env', 'r') as f:
     #     for line in f:
@@ -99,8 +155,17 @@ async def main():
         print("No valid IPs found.")
         return  
     
+    # 存取模式: 每個tick輪詢 (polling) 或訂閱資料變化 (subscription)
+    mode = os.getenv('PM_ACCESS_MODE') or access_mode
+    if mode not in ('polling', 'subscription'):
+        _logger.error(f'Unknown access mode: {mode}')
+        exit(1)
+    
+    # client 端延遲統計的輸出 (環境變數指定時)
+    await latency_stats.start_exporters()
+    
     server_urls = [f"opc.tcp://{ip}:4840" for ip in server_ips]
-    tasks = [server_task(url) for url in server_urls]
+    tasks = [server_task(url, mode, connect) for url in server_urls]
     await asyncio.gather(*tasks)
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+_logger = logging.getLogger(__name__)
+
+#? client 端的延遲直方圖: 依 (指標, server, 節點群組) 分開累計, 作為驗證封包分析 (01_opc_traffic_analyze) 指標的基準
+#? 節點群組是一起存取的節點集合 (一次 Read service 或一個 subscription 的 monitored item), 以 node_group() 的名稱標示, 不同app存取相同的節點集合時合併累計
+#? 以文字格式 (Prometheus exposition) 提供: 環境變數 LATENCY_STATS_PORT 指定時開啟本機 HTTP endpoint, LATENCY_STATS_FILE 指定時定期寫入檔案
+#? 同一個process (wrapper.py) 中的所有app共用同一份統計與輸出
+#? 唯一的原始檔在 02_Comunication_simulation, 建置 image 與直接執行app的方式與 tick_scheduler.py 相同
+
+# 指標: 'read' Read service 的往返時間,
+#       'notification_age' subscription 通知的接收時間 - server 取樣時間 (ServerTimestamp), 包含等待發布的時間 (最多一個 publishing interval), 不是網路延遲,
+#       'reconnect' 連線中斷到重新連上的時間
+BUCKET_BOUNDS = [0.1 * 2 ** k for k in range(21)] # 毫秒, 0.1ms ~ 約105秒, 超過最後一個的樣本只計入 +Inf
+
+_histograms = {} # (指標, server, 群組) -> 直方圖
+_exporters = [] # 已啟動的輸出 (保留參照)
+_started = False
+
+def new_histogram():
+    return {'buckets': [0] * len(BUCKET_BOUNDS), 'count': 0, 'sum': 0.0, 'max': 0.0}
+
+def node_group(node_names):
+    """節點群組的名稱: 排序後的節點名稱以 '+' 連接
+    """
+    return '+'.join(sorted(node_names))
+
+def record(metric, server, group, value_ms):
+    """累計一個樣本 (毫秒)
+    """
+    histogram = _histograms.setdefault((metric, server, group), new_histogram())
+    for i, bound in enumerate(BUCKET_BOUNDS):
+        if value_ms <= bound:
+            histogram['buckets'][i] += 1
+            break
+    histogram['count'] += 1
+    histogram['sum'] += value_ms
+    histogram['max'] = max(histogram['max'], value_ms)
+
+def record_notification(server, group, data_value):
+    """由 subscription 通知的 DataValue 計算通知的資料年齡 ('notification_age'), 沒有時間戳記時略過 (各容器共用主機時鐘)
+    """
+    timestamp = data_value.ServerTimestamp or data_value.SourceTimestamp
+    if timestamp is None:
+        return
+    if timestamp.tzinfo is None: # asyncua 的時間戳記為 UTC
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    record('notification_age', server, group, (datetime.now(timezone.utc) - timestamp).total_seconds() * 1000)
+
+def escape_label(value):
+    """標籤值的跳脫 (文字格式): 反斜線、雙引號與換行, 節點名稱可能包含這些字元
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render():
+    """所有直方圖的文字格式 (累積的 bucket 計數)
+    """
+    lines = ['# TYPE opcua_client_latency_ms histogram']
+    for (metric, server, group), histogram in sorted(_histograms.items()):
+        labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in (('metric', metric), ('server', server), ('group', group)))
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, histogram['buckets']):
+            cumulative += count
+            lines.append(f'opcua_client_latency_ms_bucket{{{labels},le="{bound:g}"}} {cumulative}')
+        lines.append(f'opcua_client_latency_ms_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+        lines.append(f'opcua_client_latency_ms_sum{{{labels}}} {histogram["sum"]:.3f}')
+        lines.append(f'opcua_client_latency_ms_count{{{labels}}} {histogram["count"]}')
+        lines.append(f'opcua_client_latency_ms_max{{{labels}}} {histogram["max"]:.3f}')
+    return '\n'.join(lines) + '\n'
+
+async def handle_request(reader, writer):
+    """輔助函式, 任何 HTTP 請求都回傳 render() 的內容
+    """
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError): # 寫入時再處理中斷的連線
+        pass
+    body = render().encode()
+    try:
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n' + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError) as e: # 請求端提早中斷連線, 不影響之後的請求
+        _logger.debug(f"Latency stats request aborted: {e}")
+    finally:
+        writer.close()
+
+async def dump_periodically(path, interval):
+    """每隔 interval 秒將 render() 的內容寫入檔案 (先寫暫存檔再取代, 讀取端不會看到寫到一半的內容)
+    """
+    while True:
+        await asyncio.sleep(interval)
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(f'# {time.strftime("%Y-%m-%d %H:%M:%S")}\n')
+            file.write(render())
+        os.replace(f'{path}.tmp', path)
+
+async def start_exporters():
+    """依環境變數啟動輸出, 同一個process只啟動一次
+
+    - LATENCY_STATS_PORT: 本機 HTTP endpoint 的 port
+    - LATENCY_STATS_FILE: 定期寫入的檔案路徑, 間隔為 LATENCY_STATS_INTERVAL 秒 (預設10)
+    """
+    global _started
+    if _started: # 同一個process的其他app已經啟動
+        return
+    _started = True
+    
+    port = os.getenv('LATENCY_STATS_PORT')
+    if port:
+        server = await asyncio.start_server(handle_request, '127.0.0.1', int(port))
+        _exporters.append(server)
+        _logger.info(f"Latency stats at http://127.0.0.1:{port}/")
+    path = os.getenv('LATENCY_STATS_FILE')
+    if path:
+        _exporters.append(asyncio.create_task(dump_periodically(path, float(os.getenv('LATENCY_STATS_INTERVAL') or 10))))
+        _logger.info(f"Latency stats dumped to {path}")
@@ -0,0 +1,93 @@
+import math
+import asyncio
+import logging
+
+_logger = logging.getLogger(__name__)
+
+#? app 輪詢迴圈共用的 tick 排程: 以 loop.time() (monotonic) 的截止時間在絕對格線 (起點 + k*interval) 上觸發, 不會累積誤差, 也不受系統時間調整影響
+#? 記錄每個tick的延遲 (實際觸發時間 - 截止時間) 與超時次數, 這些抖動正是 QoS 標籤要量測的對象
+#? 唯一的原始檔在 02_Comunication_simulation: 各 [app] 的 image 以此資料夾建置並由 Dockerfile 複製, 直接執行app時由上一層載入, wrapped image 則由 wrap.py 複製 (與 wrapper.py 相同)
+
+POLICIES = ('skip', 'coalesce')
+
+class TickScheduler:
+    """固定週期的 tick 排程
+
+    tick 的工作超過下一個截止時間 (超時) 時, 錯過的截止時間依 policy 處理:
+    - 'skip': 全部略過, 下一個tick在格線上下一個未來的截止時間觸發
+    - 'coalesce': 合併成一個tick立即觸發, 之後回到格線
+    """
+    def __init__(self, interval, policy='skip', name='', report_interval=60):
+        """
+        Args:
+            interval (float): tick 週期 -秒
+            policy (str): 見 POLICIES
+            name (str): 統計紀錄中的名稱 (例如 server URL)
+            report_interval (float): 每隔多久 (秒) 輸出一次統計, 0代表不輸出
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown tick policy: {policy}')
+        self.interval = interval
+        self.policy = policy
+        self.name = name
+        self.report_interval = report_interval
+        self.stats = new_stats()
+
+    async def ticks(self):
+        """依序產生 tick 編號 (格線上的 k), 呼叫端在每次迭代中完成該tick的工作
+        """
+        loop = asyncio.get_running_loop()
+        origin = loop.time()
+        tick = 0
+        next_report = origin + self.report_interval
+        while True:
+            deadline = origin + tick * self.interval
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            record_lateness(self.stats, loop.time() - deadline)
+
+            yield tick
+
+            # 工作結束時已經過了幾個截止時間 (不含本次)
+            now = loop.time()
+            missed = math.floor((now - deadline) / self.interval)
+            if missed >= 1:
+                self.stats['overruns'] += 1
+                if self.policy == 'skip':
+                    self.stats['skipped'] += missed
+                    tick += missed + 1
+                else:
+                    self.stats['skipped'] += missed - 1
+                    tick += missed
+            else:
+                tick += 1
+
+            if self.report_interval and now >= next_report:
+                _logger.info("Tick stats %s: %s", self.name, summary(self.stats))
+                next_report = now + self.report_interval
+
+def new_stats():
+    return {
+        'ticks': 0, # 觸發的tick數
+        'overruns': 0, # 工作超過下一個截止時間的tick數
+        'skipped': 0, # 因超時而略過或合併的截止時間數
+        'lateness_sum': 0.0, 'lateness_sumsq': 0.0, 'lateness_max': 0.0, # 秒
+    }
+
+def record_lateness(stats, lateness):
+    stats['ticks'] += 1
+    stats['lateness_sum'] += lateness
+    stats['lateness_sumsq'] += lateness * lateness
+    stats['lateness_max'] = max(stats['lateness_max'], lateness)
+
+def summary(stats):
+    """將累計值轉成平均、標準差與最大延遲 (毫秒)
+    """
+    count = stats['ticks']
+    mean = stats['lateness_sum'] / count if count else 0.0
+    variance = max(stats['lateness_sumsq'] / count - mean * mean, 0.0) if count else 0.0
+    return {
+        'ticks': count, 'overruns': stats['overruns'], 'skipped': stats['skipped'],
+        'lateness_mean_ms': round(mean * 1000, 3), 'lateness_std_ms': round(math.sqrt(variance) * 1000, 3), 'lateness_max_ms': round(stats['lateness_max'] * 1000, 3),
+    }
@@ -4,6 +4,11 @@ import itertools
 import subprocess
 from datetime import datetime
 
+# Modules shared by the apps, not apps themselves. The only source is in this folder:
+# the [app] images are built from this folder (their Dockerfiles COPY the modules from here),
+# and the modules are copied into every wrapped folder (like wrapper.py)
+SHARED_MODULES = ['tick_scheduler.py', 'latency_stats.py']
+
 # Function to extract initials from folder names
 def get_initials(name):
     return ''.join([word[0] for word in name.split() if word.isalpha()])
@@ -33,14 +38,14 @@ def modify_wrapper_py(subfolder_path, python_scripts):
     with open(wrapper_path, 'r') as file:
         wrapper_content = file.readlines()
 
-    # Find the line to insert new commands
-    insert_index = next(i for i, line in enumerate(wrapper_content) if 'process = []' in line) + 1
+    # Find the app list (all apps run in the wrapper's process)
+    replacement_index = next(i for i, line in enumerate(wrapper_content) if line.startswith('APP_MODULES = '))
 
-    # Generate new process.append() commands
-    new_process_commands = [f"    process.append(subprocess.Popen(['python3', '{os.path.basename(script)}']))\n" for script in python_scripts]
+    # Module names of the apps
+    app_modules = [os.path.splitext(os.path.basename(script))[0] for script in python_scripts]
 
-    # Insert the new lines
-    wrapper_content[insert_index:insert_index] = new_process_commands
+    # Replace the line
+    wrapper_content[replacement_index] = f"APP_MODULES = {app_modules}\n"
 
     # Write back to wrapper.py
     with open(wrapper_path, 'w') as file:
@@ -55,12 +60,13 @@ if not os.path.exists(wrapped_folder):
 python_files = {}
 for root, dirs, files in os.walk('.'):
     if '[app]' in os.path.basename(root):
-        python_files_in_dir = [os.path.join(root, file) for file in files if file.endswith('.py')]
+        python_files_in_dir = [os.path.join(root, file) for file in files if file.endswith('.py') and file not in SHARED_MODULES]
         if python_files_in_dir:
             python_files[root] = python_files_in_dir
-            
-        # 以下在Windows OS未經測試
-        os.chdir(root)
+
+        # Only the app folders have a Dockerfile (not the wrapped folder)
+        if 'Dockerfile' not in files:
+            continue
 
         # Format image_name: remove '[app]', strip spaces, and replace spaces with underscores
         dir_name = os.path.basename(root)
@@ -68,8 +74,9 @@ for root, dirs, files in os.walk('.'):
         tag = 'ver2'
         image_name = f"{image_name.lower()}:{tag}"
 
-        subprocess.run(['sudo', 'docker', 'build', '--pull', '--rm', '-f', 'Dockerfile', '-t', image_name, '.'])
-        os.chdir('..')
+        # 以下在Windows OS未經測試
+        # Built from this folder, the app's Dockerfile copies its folder and the shared modules
+        subprocess.run(['sudo', 'docker', 'build', '--pull', '--rm', '-f', os.path.join(root, 'Dockerfile'), '-t', image_name, '.'])
 
 # Generate combinations and create subfolders
 for num in range(2, len(python_files) + 1):
@@ -93,12 +100,14 @@ for subfolder in os.listdir(wrapped_folder):
     if os.path.isdir(subfolder_path):
         shutil.copy(wrapper_path, subfolder_path)
         shutil.copy(dockerfile_path, subfolder_path)
+        for module in SHARED_MODULES:
+            shutil.copy(module, subfolder_path)
         
         # List of python scripts in the current subfolder
-        python_scripts_in_subfolder = [f for f in os.listdir(subfolder_path) if f.endswith('.py') and f != 'wrapper.py']
+        python_scripts_in_subfolder = [f for f in os.listdir(subfolder_path) if f.endswith('.py') and f != 'wrapper.py' and f not in SHARED_MODULES]
         
         modify_wrapper_py(subfolder_path, python_scripts_in_subfolder)
-        modify_dockerfile(subfolder_path, python_scripts_in_subfolder)
+        modify_dockerfile(subfolder_path, python_scripts_in_subfolder + SHARED_MODULES)
         
         # 以下在Windows OS未經測試
         os.chdir(subfolder_path)
@@ -1,11 +1,71 @@
-import subprocess
-
-def run_all_scripts():
-    print("Running all scripts concurrently")
-    process = []
-    
-    for p in process:
-        p.wait()
-        
+import os
+import asyncio
+import logging
+import importlib
+from contextlib import asynccontextmanager
+from asyncua import Client
+
+_logger = logging.getLogger(__name__)
+
+#? 在同一個process、同一個event loop中執行多個app, app 清單由 wrap.py 產生, 每個 app 模組需提供 main(connect)
+#? 預設每個 (app, server) 各自建立 Client (session), 與 02_training_data_collect 預期的session數 (app 數 x device 數) 相同
+#? 環境變數 SHARE_SESSIONS=1 時, 同一個server URL的所有app共用一個 Client, 封包中的session數會變少, 此時的擷取不適用於 02_training_data_collect
+
+APP_MODULES = []
+
+class ClientPool:
+    """依 server URL 共用 Client: 第一個使用者建立連線, 最後一個使用者離開時中斷連線
+
+    任一使用者因例外離開時, 該連線標記為失效, 之後的使用者會建立新的連線 (仍在使用舊連線的app會自行遇到錯誤並重新連線)
+    """
+    def __init__(self):
+        self.entries = {} # url -> {'client', 'users', 'broken'}
+        self.locks = {} # url -> asyncio.Lock, 避免同時建立多個連線
+
+    @asynccontextmanager
+    async def connect(self, url):
+        async with self.locks.setdefault(url, asyncio.Lock()):
+            entry = self.entries.get(url)
+            if entry is None or entry['broken']:
+                client = Client(url=url)
+                await client.connect()
+                entry = {'client': client, 'users': 0, 'broken': False}
+                self.entries[url] = entry
+            entry['users'] += 1
+
+        try:
+            yield entry['client']
+        except BaseException:
+            entry['broken'] = True
+            raise
+        finally:
+            entry['users'] -= 1
+            if entry['users'] == 0:
+                if self.entries.get(url) is entry:
+                    del self.entries[url]
+                try:
+                    await entry['client'].disconnect()
+                except Exception as e: # 連線可能已經中斷
+                    _logger.info(f"Disconnect from {url} failed: {e}")
+
+def share_sessions():
+    return os.getenv('SHARE_SESSIONS', '').lower() in ('1', 'true', 'yes')
+
+async def run_app(name, connect):
+    """執行單一app, app 結束或設定錯誤 (exit) 不影響其他app
+    """
+    try:
+        await importlib.import_module(name).main(connect=connect)
+    except SystemExit:
+        _logger.error(f"{name} exited")
+    except Exception as e:
+        _logger.exception(f"{name} stopped: ", exc_info=e)
+
+async def run_all_apps():
+    connect = ClientPool().connect if share_sessions() else Client # Client: 每個app各自連線
+    print(f"Running all apps on one event loop (shared sessions: {connect is not Client})")
+    await asyncio.gather(*(run_app(name, connect) for name in APP_MODULES))
+
 if __name__ == '__main__':
-    run_all_scripts()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_all_apps())
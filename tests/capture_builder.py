@@ -0,0 +1,166 @@
+import struct
+
+#? 測試用的合成擷取檔: 以 Ethernet/IPv4/TCP frame 組出一段 OPC UA 連線, 寫成 classic pcap 與 pcapng
+#? 時間以微秒整數表示, 讀回的時間戳記為 BASE_TIME + 微秒 * 1e-6
+
+BASE_TIME = 1_700_000_000
+CLIENT_IP, SERVER_IP, OTHER_IP = '10.0.0.1', '10.0.0.2', '10.0.0.9'
+CLIENT_PORT, OPC_PORT = 50000, 4840
+CLIENT_ISN, SERVER_ISN = 1000, 5000
+
+FIN, SYN, RST, PSH, ACK = 0x01, 0x02, 0x04, 0x08, 0x10
+
+def ip_bytes(ip):
+    return bytes(int(part) for part in ip.split('.'))
+
+def tcp_frame(src, dst, src_port, dst_port, seq, ack, flags, payload=b''):
+    """Ethernet + IPv4 + TCP (無 options) 的 frame
+    """
+    tcp = struct.pack('>HHIIBBHHH', src_port, dst_port, seq, ack, 5 << 4, flags, 65535, 0, 0)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp) + len(payload), 0, 0x4000, 64, 6, 0, ip_bytes(src), ip_bytes(dst))
+    return b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00' + ip + tcp + payload
+
+def udp_frame(src, dst, src_port, dst_port, payload=b''):
+    udp = struct.pack('>HHHH', src_port, dst_port, 8 + len(payload), 0)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + len(udp) + len(payload), 0, 0x4000, 64, 17, 0, ip_bytes(src), ip_bytes(dst))
+    return b'\x00\x11\x22\x33\x44\x55\x66\x77\x88\x99\xaa\xbb\x08\x00' + ip + udp + payload
+
+def opc_hello():
+    body = struct.pack('<IIIII', 0, 65536, 65536, 0, 0) + struct.pack('<i', -1) # EndpointUrl 為 null
+    return b'HELF' + struct.pack('<I', 8 + len(body)) + body
+
+def opc_acknowledge():
+    body = struct.pack('<IIIII', 0, 65536, 65536, 0, 0)
+    return b'ACKF' + struct.pack('<I', 8 + len(body)) + body
+
+def opc_msg(channel, sequence_number, request_id, type_id=0, request_handle=0, is_request=True, chunk=b'F', body=None):
+    """MSG chunk, 沒有給 body 時以 FourByte NodeId 的 TypeId 加上 RequestHeader/ResponseHeader 組成
+    """
+    if body is None:
+        body = struct.pack('<BBH', 0x01, 0, type_id) + (b'\x00\x00' if is_request else b'') + struct.pack('<qI', 0, request_handle) + bytes(8)
+    payload = struct.pack('<III', 1, sequence_number, request_id) + body # TokenId, SequenceNumber, RequestId
+    return b'MSG' + chunk + struct.pack('<II', 12 + len(payload), channel) + payload
+
+def new_connection():
+    """一條 client -> server 的TCP連線, 記錄兩個方向目前的原始 seq
+    """
+    return {'client_seq': CLIENT_ISN, 'server_seq': SERVER_ISN}
+
+def send(connection, from_client, flags, payload=b'', advance=True):
+    """依連線狀態產生一個 frame, advance=False 時不推進 seq (用於重傳)
+    """
+    if from_client:
+        frame = tcp_frame(CLIENT_IP, SERVER_IP, CLIENT_PORT, OPC_PORT, connection['client_seq'], connection['server_seq'], flags, payload)
+        key = 'client_seq'
+    else:
+        frame = tcp_frame(SERVER_IP, CLIENT_IP, OPC_PORT, CLIENT_PORT, connection['server_seq'], connection['client_seq'], flags, payload)
+        key = 'server_seq'
+    if advance:
+        connection[key] += len(payload) + bool(flags & (SYN | FIN))
+    return frame
+
+def opcua_session_frames():
+    """合成的 OPC UA 連線 (約2.5秒), frame number 從1開始:
+
+    1-3 三向交握, 4 HEL, 5 ACK message, 6 背景UDP, 7/8 Read request/response (RequestHandle 7), 9 純ACK,
+    10 Write request (RequestHandle 8), 11 重傳的 Write request, 12 Write response,
+    13/14 Browse request 的兩個chunk (C, F), 15 Browse response (RequestHandle 9), 16 RST
+
+    Returns:
+        [(int, bytes)]: (微秒, frame)
+    """
+    connection = new_connection()
+    frames = []
+    def add(micros, *args, **kwargs):
+        frames.append((micros, send(connection, *args, **kwargs)))
+
+    add(0, True, SYN)
+    add(1_000, False, SYN | ACK)
+    add(1_500, True, ACK)
+    frames.append((50_000, udp_frame(OTHER_IP, SERVER_IP, 5353, 5353, b'background')))
+    add(10_000, True, PSH | ACK, opc_hello())
+    add(12_000, False, PSH | ACK, opc_acknowledge())
+    add(100_000, True, PSH | ACK, opc_msg(3, 1, 1, 631, 7))
+    add(105_000, False, PSH | ACK, opc_msg(3, 1, 1, 634, 7, is_request=False))
+    add(106_000, True, ACK)
+    write_request = opc_msg(3, 2, 2, 673, 8)
+    add(300_000, True, PSH | ACK, write_request, advance=False)
+    add(500_000, True, PSH | ACK, write_request)
+    add(504_000, False, PSH | ACK, opc_msg(3, 2, 2, 676, 8, is_request=False))
+    add(1_200_000, True, PSH | ACK, opc_msg(3, 3, 3, 527, 9, chunk=b'C'))
+    add(1_201_000, True, PSH | ACK, opc_msg(3, 4, 3, chunk=b'F', body=struct.pack('<BBH', 0x01, 0, 631) + bytes(24)))
+    add(1_210_000, False, PSH | ACK, opc_msg(3, 3, 3, 530, 9, is_request=False))
+    add(2_500_000, True, RST | ACK)
+
+    frames.sort(key=lambda frame: frame[0])
+    return frames
+
+def long_gap_frames():
+    """約41秒的 OPC UA 連線, 確認與多chunk message 相隔超過數秒 (跨越平行分析的時間片段):
+
+    0~14秒每秒一組 Read request/response, 14.5秒的 Write request 直到22.5秒才由 Write response 確認 (ack_rtt 與延遲皆為8秒),
+    30秒送出 Browse request 的第一個chunk (C), 36秒才送出最後一個chunk (F), 之後每秒一組 Read, 41秒 RST;
+    最後一個chunk的內容開頭剛好像是同一個 RequestHandle 的 Read request, 不知道前一個chunk為 C 時會被誤認為請求
+
+    Returns:
+        [(int, bytes)]: (微秒, frame)
+    """
+    connection = new_connection()
+    frames = []
+    def add(micros, *args, **kwargs):
+        frames.append((micros, send(connection, *args, **kwargs)))
+    def read(second, sequence_number):
+        add(second * 1_000_000, True, PSH | ACK, opc_msg(3, sequence_number, sequence_number, 631, sequence_number))
+        add(second * 1_000_000 + 5_000, False, PSH | ACK, opc_msg(3, sequence_number, sequence_number, 634, sequence_number, is_request=False))
+        add(second * 1_000_000 + 6_000, True, ACK)
+
+    add(0, True, SYN)
+    add(1_000, False, SYN | ACK)
+    add(1_500, True, ACK)
+    add(10_000, True, PSH | ACK, opc_hello())
+    add(12_000, False, PSH | ACK, opc_acknowledge())
+    for second in range(1, 15):
+        read(second, second)
+    add(14_500_000, True, PSH | ACK, opc_msg(3, 15, 15, 673, 15))
+    add(22_500_000, False, PSH | ACK, opc_msg(3, 15, 15, 676, 15, is_request=False))
+    add(22_501_000, True, ACK)
+    add(30_000_000, True, PSH | ACK, opc_msg(3, 16, 16, 527, 16, chunk=b'C'))
+    add(30_001_000, False, ACK)
+    add(36_000_000, True, PSH | ACK, opc_msg(3, 17, 16, 631, 16, chunk=b'F'))
+    add(36_010_000, False, PSH | ACK, opc_msg(3, 16, 16, 530, 16, is_request=False))
+    for second in range(37, 41):
+        read(second, second)
+    add(41_000_000, True, RST | ACK)
+    return frames
+
+# 擷取檔格式
+def pcap_bytes(frames, nanoseconds=False):
+    """classic pcap (little-endian, Ethernet)
+    """
+    units = 1_000 if nanoseconds else 1
+    header = struct.pack('<IHHiIII', 0xA1B23C4D if nanoseconds else 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)
+    records = [
+        struct.pack('<IIII', BASE_TIME + micros // 1_000_000, micros % 1_000_000 * units, len(frame), len(frame)) + frame
+        for micros, frame in frames
+    ]
+    return header + b''.join(records)
+
+def _pcapng_block(block_type, body):
+    body += bytes(-len(body) % 4)
+    return struct.pack('<II', block_type, 12 + len(body)) + body + struct.pack('<I', 12 + len(body))
+
+def pcapng_bytes(frames):
+    """pcapng (SHB + 一個 if_tsresol 為奈秒的 Ethernet IDB + EPB)
+    """
+    section = _pcapng_block(0x0A0D0D0A, struct.pack('<IHHq', 0x1A2B3C4D, 1, 0, -1))
+    interface = _pcapng_block(1, struct.pack('<HHI', 1, 0, 65535) + struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0))
+    packets = []
+    for micros, frame in frames:
+        nanos = (BASE_TIME * 1_000_000 + micros) * 1_000
+        packets.append(_pcapng_block(6, struct.pack('<IIIII', 0, nanos >> 32, nanos & 0xFFFFFFFF, len(frame), len(frame)) + frame))
+    return section + interface + b''.join(packets)
+
+def timestamp(micros):
+    """讀回的時間戳記 (與 pcap_reader 相同的計算方式)
+    """
+    return BASE_TIME + micros // 1_000_000 + (micros % 1_000_000) * 1e-6
@@ -0,0 +1,54 @@
+import sys
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+#? 測試直接匯入 01_PacketAnalyze 與 02_Comunication_simulation 的模組, 請在03_Programs資料夾下執行 python -m pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path[:0] = [str(ROOT / '01_PacketAnalyze'), str(ROOT / '02_Comunication_simulation')]
+
+import pcap_reader
+import capture_builder
+
+# 已納入版本控制的實際擷取檔 (約300秒、10個session, 含斷線重聯與RST), client 與各server的 ip_quota 見該資料夾的 computers.csv
+SCENARIO_CAPTURE = ROOT / '03_scenario_generation' / 'experiment_0' / 'scenario_0' / 'comp1.pcap'
+SCENARIO_CLIENT_IP = '10.0.0.230'
+SCENARIO_IP_QUOTA = {f'10.0.0.{host}': 1 for host in (120, 121, 122, 123, 124, 125, 134, 135, 136, 137)}
+
+@pytest.fixture(scope='session')
+def analyzer():
+    """01_opc_traffic_analyze.py (檔名以數字開頭, 無法直接 import), 登記在 sys.modules 中, 子程序才能找到平行分析的函式
+    """
+    spec = importlib.util.spec_from_file_location('opc_traffic_analyze', ROOT / '01_PacketAnalyze' / '01_opc_traffic_analyze.py')
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def scenario_packets():
+    return pcap_reader.read_capture(str(SCENARIO_CAPTURE))
+
+@pytest.fixture(scope='session')
+def session_frames():
+    return capture_builder.opcua_session_frames()
+
+@pytest.fixture(scope='session')
+def synthetic_pcap(tmp_path_factory, session_frames):
+    path = tmp_path_factory.mktemp('captures') / 'session.pcap'
+    path.write_bytes(capture_builder.pcap_bytes(session_frames))
+    return str(path)
+
+@pytest.fixture(scope='session')
+def synthetic_pcapng(tmp_path_factory, session_frames):
+    path = tmp_path_factory.mktemp('captures') / 'session.pcapng'
+    path.write_bytes(capture_builder.pcapng_bytes(session_frames))
+    return str(path)
+
+@pytest.fixture(scope='session')
+def long_gap_pcap(tmp_path_factory):
+    path = tmp_path_factory.mktemp('captures') / 'long_gap.pcap'
+    path.write_bytes(capture_builder.pcap_bytes(capture_builder.long_gap_frames()))
+    return str(path)
@@ -0,0 +1,102 @@
+import math
+
+import numpy as np
+import pytest
+
+import pcap_reader
+import opcua_decoder
+from conftest import SCENARIO_CLIENT_IP, SCENARIO_IP_QUOTA
+from capture_builder import CLIENT_IP, SERVER_IP
+
+def reference_metrics(packets, server_ip, delay_services):
+    """逐封包計算單一session的雙向指標, 語意與原本以 pyshark 逐一走訪封包的 bilateral_metrics 相同:
+
+    - 所有 ack_rtt 都列入 RTT, HEL 封包列入 h_messages
+    - RST 為異常封包; seq 不大於同方向先前的最大seq (只有非RST、非純ACK的封包會更新) 視為 retransmission
+    - 非異常封包中, 回應與之前最後一個 (SecureChannelId, RequestHandle) 相同的請求配對, 每個請求只配對一次
+    """
+    rtt, delays = [], []
+    h_messages, e_messages = [], []
+    max_seq = {False: 0, True: 0}
+    last_requests = {} # (SecureChannelId, RequestHandle) -> [時間, service, 是否已配對]
+
+    for packet in packets:
+        number, timestamp, flags, seq = int(packet['number']), float(packet['timestamp']), int(packet['flags']), int(packet['seq'])
+        is_response = int(packet['src_ip']) == server_ip
+
+        if not math.isnan(packet['ack_rtt']):
+            rtt.append(float(packet['ack_rtt']))
+        if opcua_decoder.MESSAGE_TYPES[packet['opc_type']] == 'HEL':
+            h_messages.append(number)
+
+        if flags & pcap_reader.RST or seq <= max_seq[is_response]:
+            e_messages.append(number)
+            continue
+
+        if packet['req_handle']:
+            key = (int(packet['opc_channel']), int(packet['req_handle']))
+            if not is_response:
+                service = opcua_decoder.SERVICE_NAMES.get(int(packet['opc_type_id']))
+                last_requests[key] = [timestamp, service if service in delay_services else 'Other', False]
+            elif key in last_requests and not last_requests[key][2]:
+                request_time, service, _ = last_requests[key]
+                delays.append((timestamp - request_time, service))
+                last_requests[key][2] = True
+
+        if flags != pcap_reader.ACK:
+            max_seq[is_response] = seq
+
+    return {
+        'rtt': rtt, 'delays': delays, 'h_messages': h_messages, 'e_messages': e_messages,
+        'avg_rtt': round(sum(rtt) * 1000 / len(rtt), 3) if rtt else 0,
+        'avd_req_resp_delay': round(sum(delay for delay, _ in delays) * 1000 / len(delays), 3) if delays else 0,
+    }
+
+def assert_matches_reference(analyzer, b_metrics, reference):
+    assert b_metrics['h_messages'] == reference['h_messages']
+    assert b_metrics['e_messages'] == reference['e_messages']
+    assert b_metrics['rtt_count'] == len(reference['rtt'])
+    assert b_metrics['rtt_sum'] == pytest.approx(sum(reference['rtt']), rel=1e-12, abs=1e-15)
+    assert b_metrics['delay_count'] == len(reference['delays'])
+    assert b_metrics['delay_sum'] == pytest.approx(sum(delay for delay, _ in reference['delays']), rel=1e-12, abs=1e-15)
+    assert b_metrics['avg_rtt'] == pytest.approx(reference['avg_rtt'], abs=1e-3)
+    assert b_metrics['avd_req_resp_delay'] == pytest.approx(reference['avd_req_resp_delay'], abs=1e-3)
+    for service in analyzer.DELAY_SERVICES:
+        service_delays = [delay * 1000 for delay, name in reference['delays'] if name == service]
+        total, count = b_metrics['service_delays'][service]
+        assert count == len(service_delays)
+        assert total == pytest.approx(sum(service_delays), rel=1e-12, abs=1e-12)
+
+def test_synthetic_session(analyzer, synthetic_pcap):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    b_metrics = analyzer.bilateral_metrics(packets[packets['ip_proto'] == 6], f'{CLIENT_IP}-{SERVER_IP}')
+    reference = reference_metrics(packets[packets['ip_proto'] == 6], pcap_reader.ip_to_int(SERVER_IP), analyzer.DELAY_SERVICES)
+
+    assert_matches_reference(analyzer, b_metrics, reference)
+    # SYN 與 SYN-ACK (相對seq為0, 不大於初始的最大seq)、重傳的 Write request、RST; 多chunk的 Browse request 以第一個chunk配對
+    assert b_metrics['e_messages'] == [1, 2, 11, 16]
+    assert b_metrics['h_messages'] == [4]
+    assert b_metrics['service_delays']['Read'] == (pytest.approx(5.0, abs=1e-3), 1)
+    assert b_metrics['service_delays']['Write'] == (pytest.approx(204.0, abs=1e-3), 1) # 重傳的請求為異常封包, 與第一次送出的請求配對
+    assert b_metrics['service_delays']['Browse'] == (pytest.approx(10.0, abs=1e-3), 1)
+
+@pytest.mark.parametrize('time_interval', [1, 10])
+def test_scenario_capture(analyzer, scenario_packets, time_interval):
+    client_ip = pcap_reader.ip_to_int(SCENARIO_CLIENT_IP)
+    checked = {'sessions': 0, 'errors': 0, 'hello': 0, 'delays': 0}
+
+    for _, packet_list in analyzer.iter_time_windows([scenario_packets], time_interval):
+        packets, flows, _ = analyzer.group_window_flows(packet_list, client_ip, len(SCENARIO_IP_QUOTA))
+        session_ranges = list(flows.values())
+        session_ips = [(client_ip, analyzer.flow_id_parts(flow_id)[1]) for flow_id in flows]
+
+        for b_metrics, ranges, (_, server_ip) in zip(analyzer.window_bilateral_metrics(packets, session_ranges, session_ips), session_ranges, session_ips):
+            session_packets = np.concatenate([packets[start:end] for start, end in ranges])
+            assert_matches_reference(analyzer, b_metrics, reference_metrics(session_packets, server_ip, analyzer.DELAY_SERVICES))
+            checked['sessions'] += 1
+            checked['errors'] += len(b_metrics['e_messages'])
+            checked['hello'] += len(b_metrics['h_messages'])
+            checked['delays'] += b_metrics['delay_count']
+
+    # 擷取檔中確實有異常封包、重聯與配對, 比對才有意義
+    assert checked['errors'] > 0 and checked['hello'] > 0 and checked['delays'] > 1000
@@ -0,0 +1,83 @@
+import functools
+import math
+
+import numpy as np
+import pytest
+
+import pcap_reader
+import flow_sampling
+from conftest import SCENARIO_CAPTURE, SCENARIO_CLIENT_IP, SCENARIO_IP_QUOTA
+
+CLIENTS = {SCENARIO_CLIENT_IP: SCENARIO_IP_QUOTA}
+
+def analyze(analyzer, time_intervals, sample_rate=None, workers=None):
+    return analyzer.analyze_capture_resolutions(str(SCENARIO_CAPTURE), CLIENTS, time_intervals, use_cache=False, workers=workers, sample_rate=sample_rate)
+
+def test_unit_totals():
+    groups = np.array([0, 0, 0, 1, 1, 0, 1])
+    units = np.array([0, 5, 5, 7, 8, 9, 5], dtype=np.uint32)
+    values = np.array([1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0])
+    totals = flow_sampling.unit_totals(groups, units, values, 3)
+    # 第0組: 確定納入的樣本 1, 單位5 (總和5, 2個樣本), 單位9 (6, 1); 第1組的單位5與第0組的不同
+    assert totals[0].tolist() == [1, 1, 11, 3, 2, 5 ** 2 + 6 ** 2, 5 * 2 + 6 * 1, 2 ** 2 + 1, 2 ** 2 + 3 ** 2 + 6 ** 2]
+    assert totals[1].tolist() == [0, 0, 16, 3, 3, 4 ** 2 + 5 ** 2 + 7 ** 2, 4 + 5 + 7, 3, 4 ** 2 + 5 ** 2 + 7 ** 2]
+    assert totals[2].tolist() == [0] * len(flow_sampling.UNIT_TOTALS)
+
+def test_ratio_interval_uses_units():
+    # 每個單位內的樣本值相同: 以單位為群集的變異數比把樣本視為獨立時大
+    unit_values, unit_sizes, sample_rate = [1.0, 2.0, 4.0, 8.0], [1, 3, 2, 4], 0.5
+    units = np.repeat(np.arange(1, 5), unit_sizes).astype(np.uint32)
+    values = np.repeat(unit_values, unit_sizes)
+    totals = flow_sampling.unit_totals(np.zeros(len(values), dtype=np.int64), units, values, 1)[0]
+
+    x, y = np.array(unit_sizes, dtype=float), np.array(unit_values) * unit_sizes
+    ratio = y.sum() / x.sum()
+    variance = (1 - sample_rate) / sample_rate ** 2 * 4 / 3 * np.sum((y - ratio * x) ** 2) / (x.sum() / sample_rate) ** 2
+    assert flow_sampling.ratio_estimate(totals, sample_rate) == pytest.approx(ratio)
+    assert flow_sampling.ratio_interval(totals, sample_rate) == pytest.approx(flow_sampling.CONFIDENCE_Z * math.sqrt(variance))
+    assert flow_sampling.design_effect(totals) > 1
+
+def test_fewer_than_two_units():
+    single = flow_sampling.unit_totals(np.zeros(3, dtype=np.int64), np.array([0, 3, 3], dtype=np.uint32), np.array([1.0, 2.0, 3.0]), 1)[0]
+    assert math.isnan(flow_sampling.ratio_interval(single, 0.5))
+    assert math.isnan(flow_sampling.design_effect(single))
+
+    window_means = flow_sampling.new_window_mean_totals()
+    flow_sampling.add_window_mean(window_means, single, 3, 0.5)
+    estimate, interval = flow_sampling.window_mean_estimate(window_means, single, 2.0, 1, 0.5)
+    assert estimate == 2.0 and math.isnan(interval)
+
+    # 抽樣前就沒有樣本時為確定的0
+    empty = flow_sampling.new_window_mean_totals()
+    flow_sampling.add_window_mean(empty, flow_sampling.new_unit_totals(), 0, 0.5)
+    assert flow_sampling.window_mean_estimate(empty, flow_sampling.new_unit_totals(), 0.0, 1, 0.5) == (0.0, 0.0)
+
+def test_kept_packets():
+    # 抽樣比例低時只解碼少部分的封包, HEL 與 RST 一律保留
+    capture_file = str(SCENARIO_CAPTURE)
+    packets = pcap_reader.read_capture(capture_file)
+    sampling = flow_sampling.new_sampling(0.05, 1, pcap_reader.capture_start_time(capture_file))
+    sampled = pcap_reader.read_capture(capture_file, packet_filter=pcap_reader.new_packet_filter(None, pcap_reader.OPC_PORT, sampling))
+    assert len(sampled) < 0.1 * len(packets)
+    hello = pcap_reader.OPC_MESSAGE_TYPES.index('HEL')
+    assert np.count_nonzero(sampled['opc_type'] == hello) == np.count_nonzero(packets['opc_type'] == hello) > 0
+    assert np.count_nonzero(sampled['flags'] & pcap_reader.RST) == np.count_nonzero(packets['flags'] & pcap_reader.RST) > 0
+
+def test_sampled_shards(analyzer):
+    sequential = analyze(analyzer, [1, 10], 0.3)
+    assert repr(analyze(analyzer, [1, 10], 0.3, workers=2)) == repr(sequential) # 信賴區間可能為 NaN
+
+def test_interval_coverage(analyzer, monkeypatch):
+    # 不同雜湊種子的抽樣結果中, 信賴區間涵蓋完整分析結果的比例接近95%
+    full = analyze(analyzer, [10])[10][SCENARIO_CLIENT_IP]
+    new_sampling = flow_sampling.new_sampling
+    covered, total = 0, 0
+    for seed in range(10):
+        monkeypatch.setattr(flow_sampling, 'new_sampling', functools.partial(new_sampling, seed=seed))
+        for expected, row in zip(full, analyze(analyzer, [10], 0.3)[10][SCENARIO_CLIENT_IP]):
+            assert row['Session'] == expected['Session']
+            assert row['Average Reconnection Count'] == expected['Average Reconnection Count']
+            for column in ('Average RTT', 'Average Req Resp Delay', 'Average Read Delay'):
+                covered += abs(row[column] - expected[column]) <= row[f'{column} CI'] + 1e-4
+                total += 1
+    assert covered / total >= 0.85
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import latency_sketch
+
+@pytest.fixture
+def samples():
+    return np.random.default_rng(7).lognormal(mean=1.0, sigma=1.2, size=20_000)
+
+def test_quantiles_within_relative_accuracy(samples):
+    sketch = latency_sketch.group_sketches(np.zeros(len(samples)), samples, 1)[0]
+    qs = [0.01, 0.5, 0.9, 0.95, 0.99]
+    estimates = latency_sketch.quantiles(sketch, qs)
+
+    # 估計值與排序後相同 rank 的樣本相差不超過 RELATIVE_ACCURACY
+    exact = np.sort(samples)[[int(np.floor(q * (len(samples) - 1))) for q in qs]]
+    np.testing.assert_allclose(estimates, exact, rtol=latency_sketch.RELATIVE_ACCURACY * 1.01)
+
+def test_out_of_range_values():
+    sketch = latency_sketch.group_sketches(np.zeros(3), [0.0, 1e-5, 1e7], 1)[0]
+    assert sketch[0] == 2 and sketch[-1] == 1
+    assert latency_sketch.quantiles(latency_sketch.new_sketch(), [0.5, 0.99]) == [0.0, 0.0]
+
+def test_merge_equals_whole(samples):
+    whole = latency_sketch.group_sketches(np.zeros(len(samples)), samples, 1)[0]
+    half = len(samples) // 2
+    merged = latency_sketch.group_sketches(np.zeros(half), samples[:half], 1)[0]
+    latency_sketch.merge(merged, latency_sketch.group_sketches(np.zeros(len(samples) - half), samples[half:], 1)[0])
+
+    np.testing.assert_array_equal(merged, whole)
+    assert latency_sketch.quantiles(merged, [0.5, 0.99]) == latency_sketch.quantiles(whole, [0.5, 0.99])
+
+def test_compact_round_trip(samples):
+    sketch = latency_sketch.group_sketches(np.zeros(100), samples[:100], 1)[0]
+    index, counts = latency_sketch.compact(sketch)
+    assert len(index) < latency_sketch.BUCKET_COUNT
+    np.testing.assert_array_equal(latency_sketch.expand((index, counts)), sketch)
+
+def test_group_sketches():
+    groups = np.array([0, 2, 2, 0, 2])
+    values = np.array([1.0, 10.0, 20.0, 3.0, 30.0])
+    sketches = latency_sketch.group_sketches(groups, values, 3)
+
+    assert sketches.shape == (3, latency_sketch.BUCKET_COUNT)
+    assert sketches.sum(axis=1).tolist() == [2, 0, 3]
+    assert latency_sketch.quantiles(sketches[2], [0.5])[0] == pytest.approx(20.0, rel=latency_sketch.RELATIVE_ACCURACY)
+
+def test_rank_values_clip():
+    sketch = latency_sketch.group_sketches(np.zeros(3), [1.0, 2.0, 4.0], 1)[0]
+    low, high = latency_sketch.rank_values(sketch, [-5, 10])
+    assert low == pytest.approx(1.0, rel=latency_sketch.RELATIVE_ACCURACY)
+    assert high == pytest.approx(4.0, rel=latency_sketch.RELATIVE_ACCURACY)
+
+def test_group_jitter():
+    groups = np.array([0, 0, 0, 1, 1, 2])
+    values = np.array([1.0, 4.0, 2.0, 10.0, 10.5, 7.0])
+    totals, counts = latency_sketch.group_jitter(groups, values, 3)
+
+    np.testing.assert_allclose(totals, [3.0 + 2.0, 0.5, 0.0])
+    assert counts.tolist() == [2, 1, 0]
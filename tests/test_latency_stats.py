@@ -0,0 +1,26 @@
+import pytest
+
+import latency_stats
+
+@pytest.fixture(autouse=True)
+def histograms(monkeypatch):
+    monkeypatch.setattr(latency_stats, '_histograms', {})
+
+def test_render_buckets():
+    for value_ms in (0.05, 0.3, 0.3, 1e6):
+        latency_stats.record('read', 'opc.tcp://cnc1:4840', 'A+B', value_ms)
+    lines = latency_stats.render().splitlines()
+    labels = 'metric="read",server="opc.tcp://cnc1:4840",group="A+B"'
+    # 累積的 bucket 計數, 超過最後一個 bucket 的樣本只計入 +Inf
+    assert f'opcua_client_latency_ms_bucket{{{labels},le="0.1"}} 1' in lines
+    assert f'opcua_client_latency_ms_bucket{{{labels},le="0.4"}} 3' in lines
+    assert f'opcua_client_latency_ms_bucket{{{labels},le="{latency_stats.BUCKET_BOUNDS[-1]:g}"}} 3' in lines
+    assert f'opcua_client_latency_ms_bucket{{{labels},le="+Inf"}} 4' in lines
+    assert f'opcua_client_latency_ms_count{{{labels}}} 4' in lines
+
+def test_render_escapes_label_values():
+    latency_stats.record('read', 'cnc1', latency_stats.node_group(['Tool "T1"', 'C:\\spindle\nload']), 1.0)
+    lines = latency_stats.render().splitlines()
+    # 反斜線、雙引號與換行跳脫後, 每個樣本仍在同一行
+    assert len(lines) == 1 + len(latency_stats.BUCKET_BOUNDS) + 4
+    assert 'opcua_client_latency_ms_count{metric="read",server="cnc1",group="C:\\\\spindle\\nload+Tool \\"T1\\""} 1' in lines
@@ -0,0 +1,83 @@
+import numpy as np
+
+import opcua_decoder
+import pcap_reader
+import capture_builder
+
+def decode(payloads, is_request, connections=None, open_messages=None):
+    """把多個 TCP payload 接成一個 buffer 後解碼
+    """
+    offsets = np.cumsum([0] + [len(payload) for payload in payloads[:-1]])
+    buf = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+    return opcua_decoder.decode_headers(buf, offsets, np.array([len(payload) for payload in payloads]), np.asarray(is_request), connections, open_messages)
+
+def test_message_types():
+    fields = decode([capture_builder.opc_hello(), capture_builder.opc_acknowledge(), capture_builder.opc_msg(3, 1, 1, 631, 7), b'GET / HTTP/1.1\r\n'],
+                    [True, False, True, True])
+    assert [opcua_decoder.MESSAGE_TYPES[code] for code in fields['message_type']] == ['HEL', 'ACK', 'MSG', '']
+    assert [opcua_decoder.CHUNK_TYPES[code] for code in fields['chunk_type']] == ['F', 'F', 'F', '']
+    # 沒有 SecureChannel 的 message 其餘欄位為0
+    assert fields['secure_channel_id'].tolist() == [0, 0, 3, 0]
+
+def test_request_and_response_headers():
+    fields = decode([capture_builder.opc_msg(3, 10, 20, 631, 7), capture_builder.opc_msg(3, 11, 20, 634, 7, is_request=False)], [True, False])
+
+    assert fields['sequence_number'].tolist() == [10, 11]
+    assert fields['request_id'].tolist() == [20, 20]
+    assert fields['type_id'].tolist() == [631, 634]
+    assert [opcua_decoder.SERVICE_NAMES[type_id] for type_id in fields['type_id']] == ['Read', 'Read']
+    # RequestHeader 多了 AuthenticationToken, 兩者的 RequestHandle 都要讀到
+    assert fields['request_handle'].tolist() == [7, 7]
+
+def test_truncated_payload():
+    message = capture_builder.opc_msg(3, 1, 1, 631, 7)
+    fields = decode([message[:6], message[:22], message[:30]], [True, True, True])
+
+    assert fields['message_type'].tolist() == [0, opcua_decoder.MESSAGE_TYPES.index('MSG'), opcua_decoder.MESSAGE_TYPES.index('MSG')]
+    assert fields['request_id'].tolist() == [0, 0, 1] # sequence header 不完整
+    assert fields['request_handle'].tolist() == [0, 0, 0] # body 不完整
+
+def test_continued_chunks_have_no_body():
+    # 後續chunk的開頭是 body 中間的內容, 即使看起來像 TypeId 也不解
+    continuation = capture_builder.opc_msg(3, 2, 5, chunk=b'F', body=np.array([0x01, 0, 0x77, 0x02], dtype=np.uint8).tobytes() + bytes(20))
+    fields = decode([capture_builder.opc_msg(3, 1, 5, 527, 9, chunk=b'C'), continuation, capture_builder.opc_msg(3, 3, 6, 631, 10)], [True, True, True])
+
+    assert fields['type_id'].tolist() == [527, 0, 631]
+    assert fields['request_handle'].tolist() == [9, 0, 10]
+
+def test_retransmitted_first_chunk_keeps_body():
+    first = capture_builder.opc_msg(3, 1, 5, 527, 9, chunk=b'C')
+    fields = decode([first, first], [True, True])
+    assert fields['type_id'].tolist() == [527, 527]
+
+def test_open_messages_across_calls():
+    open_messages = set()
+    connections = np.array([[1, 2]])
+    first = decode([capture_builder.opc_msg(3, 1, 5, 527, 9, chunk=b'C')], [True], connections, open_messages)
+    assert first['type_id'].tolist() == [527]
+    assert open_messages == {(1, 2, 3, 5)}
+
+    continuation = capture_builder.opc_msg(3, 2, 5, chunk=b'F', body=capture_builder.opc_msg(3, 1, 5, 631, 1)[24:])
+    # 另一條連線上同 RequestId 的 message 不是後續chunk
+    other = decode([continuation], [True], np.array([[7, 8]]), open_messages)
+    assert other['type_id'].tolist() == [631]
+
+    second = decode([continuation], [True], connections, open_messages)
+    assert second['type_id'].tolist() == [0]
+    assert open_messages == set() # Final chunk 結束 message
+
+def test_message_starts():
+    keys = np.array([[1, 5], [1, 6], [1, 5], [1, 5]])
+    chunk_type = np.array([opcua_decoder.CHUNK_TYPES.index(name) for name in ('C', 'F', 'C', 'F')])
+    starts = opcua_decoder.message_starts(keys, np.array([1, 1, 2, 3]), chunk_type, set())
+    assert starts.tolist() == [True, True, False, False]
+
+def test_capture_fields(synthetic_pcap):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    by_number = {int(packet['number']): packet for packet in packets}
+
+    assert opcua_decoder.MESSAGE_TYPES[by_number[4]['opc_type']] == 'HEL'
+    assert (by_number[7]['opc_type_id'], by_number[7]['req_handle']) == (631, 7)
+    assert (by_number[8]['opc_type_id'], by_number[8]['req_handle']) == (634, 7)
+    assert (by_number[13]['opc_type_id'], by_number[14]['opc_type_id']) == (527, 0)
+    assert by_number[15]['opc_request_id'] == 3
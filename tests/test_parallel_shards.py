@@ -0,0 +1,35 @@
+import csv
+
+import pytest
+
+from capture_builder import CLIENT_IP, SERVER_IP
+from conftest import SCENARIO_CAPTURE, SCENARIO_CLIENT_IP, SCENARIO_IP_QUOTA
+
+def analyze(analyzer, capture_file, clients, time_intervals, window_file, workers=None):
+    """Returns: analyze_capture_resolutions 的結果, 基本時間間隔的各session指標 (window_output_file 的內容)
+    """
+    result = analyzer.analyze_capture_resolutions(str(capture_file), clients, time_intervals, use_cache=False, window_output_file=str(window_file), workers=workers)
+    with open(window_file, newline='') as file:
+        return result, list(csv.DictReader(file))
+
+@pytest.mark.parametrize('time_intervals', [[1], [1, 10]])
+def test_long_gaps_across_shards(analyzer, long_gap_pcap, tmp_path, time_intervals):
+    # 8秒後才確認的 Write request 跨越16秒的片段邊界, Browse request 的兩個chunk跨越32秒的邊界
+    assert analyzer.shard_duration([1]) == 16
+    clients = {CLIENT_IP: {SERVER_IP: 1}}
+    sequential, sequential_windows = analyze(analyzer, long_gap_pcap, clients, time_intervals, tmp_path / 'sequential.csv')
+    parallel, parallel_windows = analyze(analyzer, long_gap_pcap, clients, time_intervals, tmp_path / 'parallel.csv', workers=2)
+    assert parallel == sequential
+    assert parallel_windows == sequential_windows
+
+    # 22秒的時間間隔: Write response 的 ack_rtt 為8秒, 其ACK為1毫秒
+    assert float(next(row for row in sequential_windows if row['Capture Duration'] == '22')['RTT']) == pytest.approx(4000.5, abs=1e-3)
+    if 10 in sequential: # Request-Response 只在同一個時間間隔內配對, 10秒的時間間隔才有 Browse 的配對
+        row = sequential[10][CLIENT_IP][0]
+        assert row['Average Browse Delay'] == pytest.approx(6010.0, abs=1e-3)
+        assert row['Average Read Delay'] == pytest.approx(5.0, abs=1e-3)
+
+def test_scenario_shards(analyzer, tmp_path):
+    clients = {SCENARIO_CLIENT_IP: SCENARIO_IP_QUOTA}
+    sequential = analyze(analyzer, SCENARIO_CAPTURE, clients, [1], tmp_path / 'sequential.csv')
+    assert analyze(analyzer, SCENARIO_CAPTURE, clients, [1], tmp_path / 'parallel.csv', workers=3) == sequential
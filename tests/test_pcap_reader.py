@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+import pcap_reader
+import capture_builder
+from capture_builder import BASE_TIME, CLIENT_IP, SERVER_IP, OPC_PORT, SYN, RST, ACK
+
+def assert_same_packets(packets, expected, timestamp_tolerance=0.0):
+    assert packets.dtype == pcap_reader.PACKET_DTYPE
+    assert len(packets) == len(expected)
+    for name in pcap_reader.PACKET_DTYPE.names:
+        if name in ('timestamp', 'ack_rtt'):
+            np.testing.assert_allclose(packets[name], expected[name], atol=timestamp_tolerance * 2, rtol=0)
+        else:
+            np.testing.assert_array_equal(packets[name], expected[name], err_msg=name)
+
+def test_frame_numbers_and_timestamps(synthetic_pcap, session_frames):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+
+    np.testing.assert_array_equal(packets['number'], np.arange(1, len(session_frames) + 1))
+    np.testing.assert_array_equal(packets['timestamp'], [capture_builder.timestamp(micros) for micros, _ in session_frames])
+    np.testing.assert_array_equal(packets['length'], [len(frame) for _, frame in session_frames])
+    assert packets['ip_proto'].tolist() == [6] * 5 + [17] + [6] * 10
+
+def test_pcapng_matches_pcap(synthetic_pcap, synthetic_pcapng):
+    # pcapng 的時間解析度為奈秒, 與 pcap 的微秒時間戳記只差在浮點誤差
+    assert_same_packets(pcap_reader.read_capture(synthetic_pcapng), pcap_reader.read_capture(synthetic_pcap), timestamp_tolerance=1e-6)
+
+def test_nanosecond_pcap(tmp_path, session_frames, synthetic_pcap):
+    path = tmp_path / 'session_ns.pcap'
+    path.write_bytes(capture_builder.pcap_bytes(session_frames, nanoseconds=True))
+    assert_same_packets(pcap_reader.read_capture(str(path)), pcap_reader.read_capture(synthetic_pcap), timestamp_tolerance=1e-6)
+
+def test_header_fields(synthetic_pcap):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    syn, hello, background = packets[0], packets[3], packets[5]
+
+    assert (syn['src_ip'], syn['dst_ip']) == (pcap_reader.ip_to_int(CLIENT_IP), pcap_reader.ip_to_int(SERVER_IP))
+    assert (syn['src_port'], syn['dst_port'], syn['flags']) == (capture_builder.CLIENT_PORT, OPC_PORT, SYN)
+    assert hello['tcp_len'] == len(capture_builder.opc_hello())
+    assert (background['ip_proto'], background['dst_port'], background['flags'], background['tcp_len']) == (17, 5353, 0, 0) # UDP 沒有TCP欄位
+    assert packets[-1]['flags'] == RST | ACK
+
+def test_relative_sequence_numbers(synthetic_pcap):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    tcp = packets[packets['ip_proto'] == 6]
+
+    # 與 Wireshark 相同: SYN 為0, 之後的資料從1開始, ack 為對方的相對序號
+    assert tcp['seq'][:4].tolist() == [0, 0, 1, 1]
+    assert tcp['ack'][:4].tolist() == [0, 1, 1, 1]
+    hello_length = len(capture_builder.opc_hello())
+    assert tcp['ack'][4] == 1 + hello_length # ACK message 確認 HEL
+    # 重傳的 Write request 與第一次的 seq 相同
+    assert tcp['seq'][8] == tcp['seq'][9]
+
+def test_ack_rtt(synthetic_pcap):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    ack_rtt = dict(zip(packets['number'].tolist(), packets['ack_rtt'].tolist()))
+
+    for number, expected in {2: 0.001, 3: 0.0005, 5: 0.002, 8: 0.005, 9: 0.001, 12: 0.204}.items():
+        assert ack_rtt[number] == pytest.approx(expected, abs=1e-6)
+    # 沒有確認任何資料段的封包 (SYN、重傳) 沒有 ack_rtt
+    assert np.isnan(ack_rtt[1]) and np.isnan(ack_rtt[11])
+
+def test_truncated_last_record(tmp_path, session_frames):
+    data = capture_builder.pcap_bytes(session_frames)
+    path = tmp_path / 'truncated.pcap'
+    path.write_bytes(data[:-10]) # 擷取程式被中止, 最後一筆紀錄不完整
+
+    packets = pcap_reader.read_capture(str(path))
+    assert len(packets) == len(session_frames) - 1
+
+    path.write_bytes(capture_builder.pcapng_bytes(session_frames)[:-10])
+    assert len(pcap_reader.read_capture(str(path))) == len(session_frames) - 1
+
+def test_unknown_format(tmp_path):
+    path = tmp_path / 'not_a_capture.pcap'
+    path.write_bytes(b'not a capture file')
+    with pytest.raises(ValueError):
+        pcap_reader.read_capture(str(path))
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7])
+def test_chunks_match_whole_file(synthetic_pcapng, chunk_size):
+    # 分段解碼 (含跨段的多chunk message 與 ack_rtt) 與整檔解碼相同
+    chunks = list(pcap_reader.iter_capture_chunks(synthetic_pcapng, chunk_size=chunk_size))
+    assert max(len(chunk) for chunk in chunks) <= chunk_size
+    assert_same_packets(np.concatenate(chunks), pcap_reader.read_capture(synthetic_pcapng))
+
+def test_packet_filter(synthetic_pcap):
+    packet_filter = pcap_reader.new_packet_filter([pcap_reader.ip_to_int(CLIENT_IP)])
+    packets = pcap_reader.read_capture(synthetic_pcap, packet_filter=packet_filter)
+
+    assert 6 not in packets['number'].tolist() # 背景UDP被略過, frame number 不變
+    assert len(packets) == 15 and packet_filter['background'] == 1
+
+    other_host = pcap_reader.new_packet_filter([pcap_reader.ip_to_int('10.0.0.99')])
+    assert len(pcap_reader.read_capture(synthetic_pcap, packet_filter=other_host)) == 0
+
+def test_cache_round_trip(synthetic_pcap, tmp_path):
+    packets = pcap_reader.load_capture(synthetic_pcap, cache_dir=str(tmp_path))
+    cached = pcap_reader.load_capture(synthetic_pcap, cache_dir=str(tmp_path))
+    assert_same_packets(cached, packets)
+    assert list(tmp_path.iterdir())
+
+def test_capture_start_time(synthetic_pcapng):
+    assert pcap_reader.capture_start_time(synthetic_pcapng) == pytest.approx(BASE_TIME, abs=1e-6)
+
+@pytest.mark.parametrize('split', [20, 48, 50, 55, 60])
+def test_advance_tcp_state(long_gap_pcap, split):
+    # 只解標頭推進狀態後從中間開始解碼, 與整檔解碼相同 (8秒後才確認的資料段、相隔6秒的多chunk message)
+    whole = pcap_reader.read_capture(long_gap_pcap)
+    with pcap_reader.map_capture(long_gap_pcap) as data:
+        records = np.concatenate(list(pcap_reader.iter_record_arrays(data)))
+        tcp_state, open_messages = pcap_reader.new_tcp_state(), set()
+        pcap_reader.advance_tcp_state(data, records[:split], tcp_state, open_messages=open_messages)
+        packets = pcap_reader.decode_records(data, records[split:], split + 1, open_messages=open_messages)
+        del records
+    pcap_reader.annotate_tcp_analysis(packets, tcp_state)
+    assert_same_packets(packets, whole[split:])
+
+def test_advance_tcp_state_matches_annotation(long_gap_pcap):
+    with pcap_reader.map_capture(long_gap_pcap) as data:
+        advanced, annotated = pcap_reader.new_tcp_state(), pcap_reader.new_tcp_state()
+        advanced_messages, annotated_messages = set(), set()
+        for records in pcap_reader.iter_record_arrays(data, chunk_size=5):
+            pcap_reader.advance_tcp_state(data, records, advanced, open_messages=advanced_messages)
+            pcap_reader.annotate_tcp_analysis(pcap_reader.decode_records(data, records, int(records['number'][0]), open_messages=annotated_messages), annotated)
+            assert advanced['max_next_seq'] == annotated['max_next_seq']
+            assert advanced['unacked'] == {flow: pending for flow, pending in annotated['unacked'].items() if pending}
+            assert advanced_messages == annotated_messages
+        del records
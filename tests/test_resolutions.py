@@ -0,0 +1,40 @@
+import pytest
+
+from conftest import SCENARIO_CAPTURE, SCENARIO_CLIENT_IP, SCENARIO_IP_QUOTA
+
+CLIENTS = {SCENARIO_CLIENT_IP: SCENARIO_IP_QUOTA}
+
+def analyze(analyzer, time_intervals, **kwargs):
+    return analyzer.analyze_capture_resolutions(SCENARIO_CAPTURE, CLIENTS, time_intervals, use_cache=False, **kwargs)
+
+@pytest.fixture(scope='module')
+def direct(analyzer):
+    # 分別只計算一個時間間隔長度的結果
+    return {time_interval: analyze(analyzer, [time_interval])[time_interval] for time_interval in (1, 5, 10)}
+
+def test_resolutions_match_direct_runs(analyzer, direct):
+    # 較長的時間間隔由基本時間間隔的封包組成後各自追蹤session, 與直接以該長度分析相同
+    result = analyze(analyzer, [1, 5, 10])
+    for time_interval, rows in direct.items():
+        assert result[time_interval] == rows
+    assert len(result[10][SCENARIO_CLIENT_IP]) == 10
+
+def test_window_rows_match_direct_runs(analyzer, tmp_path):
+    window_files = {name: tmp_path / f'{name}.csv' for name in ('both', 'direct')}
+    analyze(analyzer, [1, 10], window_output_file=str(window_files['both']))
+    analyze(analyzer, [1], window_output_file=str(window_files['direct']))
+    # 只輸出基本時間間隔的各session指標
+    assert window_files['both'].read_text() == window_files['direct'].read_text()
+
+def test_parallel_resolutions(analyzer, direct, tmp_path):
+    time_intervals = [1, 10]
+    expected = {time_interval: direct[time_interval] for time_interval in time_intervals}
+    # 子程序各自解碼時間片段, 以及由 shared memory 讀取快取
+    assert analyze(analyzer, time_intervals, workers=2) == expected
+    analyzer.analyze_capture_resolutions(SCENARIO_CAPTURE, CLIENTS, time_intervals, cache_dir=str(tmp_path))
+    assert analyzer.analyze_capture_resolutions(SCENARIO_CAPTURE, CLIENTS, time_intervals, cache_dir=str(tmp_path), workers=2) == expected
+
+def test_shard_duration(analyzer):
+    assert analyzer.shard_duration([1]) == analyzer.SHARD_WINDOWS
+    assert analyzer.shard_duration([1, 10]) == 20
+    assert analyzer.shard_duration([2, 3, 60]) == 60
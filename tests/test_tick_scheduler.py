@@ -0,0 +1,102 @@
+import json
+import types
+import asyncio
+import fnmatch
+
+import pytest
+
+import tick_scheduler
+from conftest import ROOT
+
+class FakeClock:
+    """取代 event loop 的時間與 asyncio.sleep: sleep 直接推進時間, tick 的工作以 work 推進時間
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.now += delay
+
+    def work(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(tick_scheduler, 'asyncio', types.SimpleNamespace(get_running_loop=lambda: clock, sleep=clock.sleep))
+    return clock
+
+def run_ticks(clock, scheduler, work_times):
+    """執行 len(work_times) 個tick, 每個tick的工作時間依序取自 work_times
+
+    Returns:
+        [(int, float)]: 各tick的編號與觸發時間
+    """
+    async def run():
+        fired = []
+        ticks = scheduler.ticks()
+        for seconds in work_times:
+            fired.append((await ticks.__anext__(), clock.time()))
+            clock.work(seconds)
+        await ticks.aclose()
+        return fired
+    return asyncio.run(run())
+
+def test_on_time_ticks_follow_grid(clock):
+    scheduler = tick_scheduler.TickScheduler(1.0, report_interval=0)
+    fired = run_ticks(clock, scheduler, [0.2, 0.7, 0.1, 0.0])
+
+    assert fired == [(0, 0.0), (1, 1.0), (2, 2.0), (3, 3.0)]
+    assert (scheduler.stats['ticks'], scheduler.stats['overruns'], scheduler.stats['skipped']) == (4, 0, 0)
+    assert scheduler.stats['lateness_max'] == 0.0
+
+def test_skip_policy(clock):
+    scheduler = tick_scheduler.TickScheduler(1.0, 'skip', report_interval=0)
+    # tick 0 的工作到 2.5 秒才結束: 截止時間 1、2 都被略過, 下一個tick在格線上的 3 秒觸發
+    fired = run_ticks(clock, scheduler, [2.5, 0.1, 0.1])
+
+    assert fired == [(0, 0.0), (3, 3.0), (4, 4.0)]
+    assert (scheduler.stats['ticks'], scheduler.stats['overruns'], scheduler.stats['skipped']) == (3, 1, 2)
+    assert scheduler.stats['lateness_max'] == 0.0
+
+def test_coalesce_policy(clock):
+    scheduler = tick_scheduler.TickScheduler(1.0, 'coalesce', report_interval=0)
+    # 錯過的截止時間 1、2 合併成一個tick (編號2) 立即觸發, 之後回到格線
+    fired = run_ticks(clock, scheduler, [2.5, 0.1, 0.1])
+
+    assert fired == [(0, 0.0), (2, 2.5), (3, 3.0)]
+    assert (scheduler.stats['ticks'], scheduler.stats['overruns'], scheduler.stats['skipped']) == (3, 1, 1)
+    assert scheduler.stats['lateness_max'] == pytest.approx(0.5)
+
+def test_overrun_by_less_than_one_interval(clock):
+    # 工作超過下一個截止時間但未超過兩個: skip 略過1個, coalesce 不略過 (晚一點觸發)
+    for policy, expected_fired, expected_skipped in (('skip', [(0, 0.0), (2, 2.0)], 1), ('coalesce', [(0, 0.0), (1, 1.5)], 0)):
+        clock.now = 0.0
+        scheduler = tick_scheduler.TickScheduler(1.0, policy, report_interval=0)
+        assert run_ticks(clock, scheduler, [1.5, 0.0]) == expected_fired
+        assert (scheduler.stats['overruns'], scheduler.stats['skipped']) == (1, expected_skipped)
+
+def test_summary(clock):
+    scheduler = tick_scheduler.TickScheduler(1.0, 'coalesce', report_interval=0)
+    run_ticks(clock, scheduler, [2.5, 0.1, 0.1])
+    summary = tick_scheduler.summary(scheduler.stats)
+
+    assert summary['ticks'] == 3 and summary['overruns'] == 1 and summary['skipped'] == 1
+    assert summary['lateness_mean_ms'] == pytest.approx(500 / 3, abs=1e-3)
+    assert summary['lateness_max_ms'] == 500.0
+    assert tick_scheduler.summary(tick_scheduler.new_stats())['lateness_mean_ms'] == 0.0
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        tick_scheduler.TickScheduler(1.0, 'drop')
+
+@pytest.mark.parametrize('dockerfile', sorted((ROOT / '02_Comunication_simulation').glob('[[]app] */Dockerfile')), ids=lambda path: path.parent.name)
+def test_app_image_copies_shared_modules(dockerfile):
+    # image 以 02_Comunication_simulation 建置, COPY 的來源 (match pattern) 須涵蓋app本身的資料夾與共用模組
+    context = dockerfile.parent.parent
+    sources = [source for line in dockerfile.read_text().splitlines() if line.startswith('COPY [') for source in json.loads(line[len('COPY '):])[:-1]]
+    copied = {path.name for source in sources for path in context.iterdir() if fnmatch.fnmatchcase(path.name, source)}
+    assert {dockerfile.parent.name, 'tick_scheduler.py', 'latency_stats.py'} <= copied
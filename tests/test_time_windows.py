@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import pcap_reader
+
+def packets_at(timestamps):
+    packets = np.zeros(len(timestamps), dtype=pcap_reader.PACKET_DTYPE)
+    packets['number'] = np.arange(1, len(timestamps) + 1)
+    packets['timestamp'] = timestamps
+    return packets
+
+def windows(analyzer, chunks, time_interval, grid_origin=None):
+    return [(number, window['number'].tolist()) for number, window in analyzer.iter_time_windows(chunks, time_interval, grid_origin)]
+
+def test_fixed_grid_with_empty_windows(analyzer):
+    packets = packets_at([100.2, 100.9, 101.3, 103.5])
+
+    # 格線起點為第一個封包, 左閉右開, 沒有封包的時間間隔也會回傳
+    assert windows(analyzer, [packets], 1) == [(0, [1, 2]), (1, [3]), (2, []), (3, [4])]
+
+def test_grid_origin(analyzer):
+    packets = packets_at([100.2, 100.9, 101.0, 103.5])
+    assert windows(analyzer, [packets], 2, grid_origin=99.0) == [(0, [1, 2]), (1, [3]), (2, [4])]
+
+def test_windows_spanning_chunks(analyzer):
+    packets = packets_at(np.arange(0, 10, 0.3) + 50.0)
+    whole = windows(analyzer, [packets], 2)
+
+    for size in (1, 4, 7):
+        chunks = [packets[start:start + size] for start in range(0, len(packets), size)]
+        assert windows(analyzer, [*chunks[:2], packets[:0], *chunks[2:]], 2) == whole
+
+def test_window_views_do_not_copy(analyzer):
+    packets = packets_at([0.0, 0.5, 1.5])
+    first = next(analyzer.iter_time_windows([packets], 1))[1]
+    assert first.base is packets
+
+def test_boundary_rounding(analyzer):
+    # grid_origin + k*time_interval 在浮點數下不一定等於 timestamp 的運算結果, 邊界上的封包仍屬於後一個時間間隔
+    origin = 1_700_000_000.1
+    assert analyzer.window_number(origin + 3 * 0.1, origin, 0.1) == 3
+    assert analyzer.window_number(np.nextafter(origin + 3 * 0.1, 0), origin, 0.1) == 2
+
+@pytest.mark.parametrize('time_interval', [1, 2])
+def test_capture_windows(analyzer, synthetic_pcap, time_interval):
+    packets = pcap_reader.read_capture(synthetic_pcap)
+    result = list(analyzer.iter_time_windows([packets], time_interval))
+
+    assert [number for number, _ in result] == list(range(len(result)))
+    assert sum(len(window) for _, window in result) == len(packets)
+    assert len(result) == 2.5 // time_interval + 1